@@ -0,0 +1,227 @@
+# File: admission.py
+
+import logging
+import math
+import time
+from collections import OrderedDict
+from aiohttp import web
+from util import logger_config
+from metrics import REGISTRY
+from peers import PEER_HEADER
+
+logger_config.setup_logger()
+
+# Header naming the publisher a request is rate limited as, set by a trusted proxy
+PUBLISHER_HEADER = "X-Publisher-Id"
+
+REJECTED = REGISTRY.counter(
+    "broker_publish_rejected_total",
+    "Client publish requests answered with 429, by reason.",
+    ("reason",),
+)
+
+
+class TokenBucket:
+    """
+    Refills at ``rate`` tokens per second up to ``burst``. A request may
+    take more tokens than are left (a large batch), leaving the bucket in
+    debt until it refills, so batches larger than ``burst`` still get through.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    # Refills are float sums; a request arriving exactly on time may fall short by this much
+    EPSILON = 1e-9
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, count=1, now=None):
+        """
+        Take ``count`` tokens if the bucket has enough.
+
+        :return: 0 if taken, otherwise seconds until the request would fit.
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(count, self.burst)
+        if self.tokens + self.EPSILON < needed:
+            return (needed - self.tokens) / self.rate
+        self.tokens -= count
+        return 0
+
+
+class AdmissionControl:
+    """
+    Admission control for client publishes, so that overload is refused at
+    the door instead of piling up in the replication retry queue.
+
+    - Load shedding: once ``failed_queue`` holds ``queue_high_water``
+      replications, publishes are refused until it drains below half that.
+    - In-flight cap: at most ``max_in_flight`` publish requests are handled
+      at a time.
+    - Rate limits: token buckets per publisher and per topic, counted in
+      messages. A publisher is the client's address; the ``X-Publisher-Id``
+      and ``X-Forwarded-For`` headers are only believed on connections from
+      ``trusted_proxies``, since any client can set them.
+
+    Refusals are ``429 Too Many Requests`` with a ``Retry-After`` header (and
+    the exact wait in the JSON body). Requests from other brokers (forwarded
+    publishes, replication) are never refused: they were admitted by the
+    broker the client called.
+    """
+
+    ROUTES = ("/publish", "/publish_batch", "/publish_blob")
+
+    def __init__(
+        self,
+        queue_size,
+        max_in_flight=512,
+        queue_high_water=1000,
+        publisher_rate=0,
+        publisher_burst=None,
+        topic_rate=0,
+        topic_burst=None,
+        shed_retry_after=1.0,
+        max_buckets=10000,
+        trusted_proxies=(),
+    ):
+        """
+        :param queue_size: Callable returning the replication retry queue length.
+        :param max_in_flight: Concurrent client publish requests allowed (0 for no cap).
+        :param queue_high_water: Retry queue length at which publishes are shed (0 to never shed).
+        :param publisher_rate: Messages per second per publisher (0 for no limit).
+        :param publisher_burst: Publisher bucket size (default: one second of ``publisher_rate``).
+        :param topic_rate: Messages per second per topic (0 for no limit).
+        :param topic_burst: Topic bucket size (default: one second of ``topic_rate``).
+        :param shed_retry_after: Retry-After, in seconds, while shedding or at the in-flight cap.
+        :param max_buckets: Token buckets kept per kind; the least recently used are dropped.
+        :param trusted_proxies: Addresses (e.g. the registry's) whose publisher headers are believed.
+        """
+        self.queue_size = queue_size
+        self.max_in_flight = max_in_flight
+        self.queue_high_water = queue_high_water
+        self.publisher_rate = publisher_rate
+        self.publisher_burst = publisher_burst or max(1, publisher_rate)
+        self.topic_rate = topic_rate
+        self.topic_burst = topic_burst or max(1, topic_rate)
+        self.shed_retry_after = shed_retry_after
+        self.max_buckets = max_buckets
+        self.trusted_proxies = set(trusted_proxies)
+        self.in_flight = 0
+        self.shedding = False
+        self.publisher_buckets = OrderedDict()
+        self.topic_buckets = OrderedDict()
+
+    @staticmethod
+    def is_client_request(request):
+        """Only requests from clients are subject to admission control."""
+        return PEER_HEADER not in request.headers
+
+    def publisher_of(self, request):
+        """
+        Key a request is rate limited by: the connecting address, unless that
+        is a trusted proxy, which may name the publisher (``X-Publisher-Id``)
+        or the address it forwards for. ``X-Forwarded-For`` is read from the
+        right, skipping trusted proxies, since clients can prepend anything.
+        """
+        if request.remote not in self.trusted_proxies:
+            return request.remote
+        publisher = request.headers.get(PUBLISHER_HEADER)
+        if publisher:
+            return publisher
+        forwarded = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+        for hop in reversed(forwarded):
+            if hop not in self.trusted_proxies:
+                return hop
+        return forwarded[0] if forwarded else request.remote
+
+    @staticmethod
+    def reject(reason, retry_after):
+        """429 response telling the client when to retry."""
+        REJECTED.inc(reason)
+        logging.debug(
+            "Publish rejected (%s), retry after %.3fs", reason, retry_after, extra=logger_config.RATE_LIMITED
+        )
+        return web.json_response(
+            {
+                "status": "error",
+                "message": f"Publish rejected: {reason}.",
+                "reason": reason,
+                "retry_after": round(retry_after, 3),
+            },
+            status=429,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+    def overloaded(self):
+        """Check the retry queue against the high-water mark, with hysteresis."""
+        if not self.queue_high_water:
+            return False
+        size = self.queue_size()
+        if not self.shedding and size >= self.queue_high_water:
+            self.shedding = True
+            logging.warning(
+                f"Replication retry queue at {size}; shedding publishes until it drains."
+            )
+        elif self.shedding and size < self.queue_high_water // 2:
+            self.shedding = False
+            logging.info(f"Replication retry queue down to {size}; accepting publishes again.")
+        return self.shedding
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """aiohttp middleware shedding and capping client publishes before their body is read."""
+        if request.path not in self.ROUTES or not self.is_client_request(request):
+            return await handler(request)
+        if self.overloaded():
+            return self.reject("overloaded", self.shed_retry_after)
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return self.reject("too_many_in_flight", self.shed_retry_after)
+        self.in_flight += 1
+        try:
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    def _bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+            if len(buckets) > self.max_buckets:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def check_rate(self, request, topic, count=1):
+        """
+        Charge ``count`` messages to the publisher's and the topic's buckets.
+
+        :return: None if admitted, otherwise the 429 response to send.
+        """
+        if not self.is_client_request(request):
+            return None
+        now = time.monotonic()
+        publisher_bucket = None
+        if self.publisher_rate:
+            publisher = self.publisher_of(request)
+            publisher_bucket = self._bucket(
+                self.publisher_buckets, publisher, self.publisher_rate, self.publisher_burst
+            )
+            wait = publisher_bucket.take(count, now)
+            if wait:
+                return self.reject("publisher_rate", wait)
+        if self.topic_rate:
+            wait = self._bucket(
+                self.topic_buckets, topic, self.topic_rate, self.topic_burst
+            ).take(count, now)
+            if wait:
+                if publisher_bucket is not None:
+                    publisher_bucket.tokens += count  # Not published after all
+                return self.reject("topic_rate", wait)
+        return None
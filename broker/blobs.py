@@ -0,0 +1,268 @@
+# File: blobs.py
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from collections import namedtuple
+import aiohttp
+from aiohttp import web
+from util import logger_config
+from peers import PEER_HEADER
+
+logger_config.setup_logger()
+
+# Stored in the message column instead of the payload:
+# "blob:sha256:<hex digest>:<size>:<content type>"
+REFERENCE_PREFIX = "blob:sha256:"
+_REFERENCE = re.compile(r"^blob:sha256:([0-9a-f]{64}):(\d+):(.*)$", re.DOTALL)
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+# Blob transfers between brokers can take long; only stalls are timed out
+TRANSFER_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=30)
+
+Blob = namedtuple("Blob", ["digest", "size", "content_type"])
+
+
+def make_reference(digest, size, content_type):
+    """Message text referring to a stored blob."""
+    return f"{REFERENCE_PREFIX}{digest}:{size}:{content_type}"
+
+
+def parse_reference(message):
+    """
+    Parse a blob reference.
+
+    :return: Blob, or None if ``message`` is not a reference.
+    """
+    if not isinstance(message, str) or not message.startswith(REFERENCE_PREFIX):
+        return None
+    match = _REFERENCE.match(message)
+    if match is None:
+        return None
+    return Blob(match.group(1), int(match.group(2)), match.group(3))
+
+
+class BlobTooLarge(Exception):
+    """The uploaded body exceeded the blob store's size limit."""
+
+
+class BlobStore:
+    """
+    Content-addressed store for large message bodies.
+
+    A blob is a file named by the SHA-256 of its content, under a directory
+    fanned out by the first two hex digits. Uploads are streamed to a
+    staging file in fixed-size chunks while being hashed, then renamed into
+    place, so memory per upload stays constant and a blob is either complete
+    or absent. Identical bodies are stored once. Downloads are served with
+    sendfile, and transfers between brokers stream the file.
+
+    The message row only holds a reference (see ``make_reference``), so
+    replication, retries and partition hand-off carry a few dozen bytes; a
+    broker that receives a reference to a blob it lacks pulls the blob from
+    the sender in the background.
+    """
+
+    def __init__(self, root, directory, peers=None, chunk_size=256 * 1024, max_bytes=1024 ** 3):
+        """
+        :param root: Directory holding the blobs.
+        :param directory: PeerDirectory used to reach other brokers.
+        :param peers: Callable returning peer IDs to look for blobs missing locally.
+        :param chunk_size: Bytes read and written at a time.
+        :param max_bytes: Largest blob accepted.
+        """
+        self.root = root
+        self.directory = directory
+        self.peers = peers or (lambda: [])
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.pulls = {}  # Digest -> task pulling it from a peer
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def path(self, digest):
+        """File a blob is stored in."""
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    async def receive(self, stream, expected_digest=None):
+        """
+        Stream a body into a staging file, hashing it on the way.
+
+        :param stream: aiohttp StreamReader (request or response content).
+        :param expected_digest: Digest the content must have (transfers between brokers).
+        :return: Tuple of (digest, size, staging path); pass the path to
+                 ``commit`` to add the blob to the store, or to ``discard``.
+        :raises BlobTooLarge: If the body exceeds ``max_bytes``.
+        :raises ValueError: If the content does not match ``expected_digest``.
+        """
+        loop = asyncio.get_running_loop()
+        hasher = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as temp:
+                async for chunk in stream.iter_chunked(self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise BlobTooLarge(f"Blob exceeds {self.max_bytes} bytes.")
+                    # Hashing and writing release the GIL; keep them off the loop
+                    await loop.run_in_executor(None, self._absorb, hasher, temp, chunk)
+            digest = hasher.hexdigest()
+            if expected_digest is not None and digest != expected_digest:
+                raise ValueError(f"Content hashes to {digest}, expected {expected_digest}.")
+            return digest, size, temp_path
+        except BaseException:
+            self.discard(temp_path)
+            raise
+
+    def commit(self, digest, temp_path):
+        """Move a staged body into the store (atomically; identical content may already be there)."""
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        os.replace(temp_path, self.path(digest))
+
+    @staticmethod
+    def discard(temp_path):
+        """Remove a staged body."""
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _absorb(hasher, temp, chunk):
+        hasher.update(chunk)
+        temp.write(chunk)
+
+    async def push(self, digest, peers, path=None):
+        """
+        Copy a blob to peers that lack it, streaming the file.
+
+        :param path: File to send; defaults to the stored blob.
+        :return: List of booleans, True where the peer has the blob afterwards.
+        """
+        path = path or self.path(digest)
+        return await asyncio.gather(*(self._push_one(digest, peer, path) for peer in peers))
+
+    async def _push_one(self, digest, peer, path):
+        session = self.directory.session(peer)
+        url = self.directory.url(peer, f"/blobs/{digest}")
+        try:
+            async with session.head(url) as response:
+                if response.status == 200:
+                    return True
+            with open(path, "rb") as blob:
+                async with session.put(
+                    url,
+                    data=blob,
+                    timeout=TRANSFER_TIMEOUT,
+                    headers={"Content-Type": "application/octet-stream"},
+                ) as response:
+                    if response.status in (200, 201):
+                        return True
+                    logging.warning(f"Pushing blob {digest[:12]} to Broker {peer} failed (HTTP {response.status})")
+        except Exception as e:
+            logging.warning(f"Pushing blob {digest[:12]} to Broker {peer} failed: {e}")
+        return False
+
+    async def pull(self, digest, peer):
+        """
+        Fetch a blob from a peer into the local store.
+
+        :return: True if the blob is stored locally afterwards.
+        """
+        try:
+            async with self.directory.session(peer).get(
+                self.directory.url(peer, f"/blobs/{digest}"), timeout=TRANSFER_TIMEOUT
+            ) as response:
+                if response.status != 200:
+                    logging.warning(f"Pulling blob {digest[:12]} from Broker {peer} failed (HTTP {response.status})")
+                    return False
+                digest, _, temp_path = await self.receive(response.content, expected_digest=digest)
+                self.commit(digest, temp_path)
+                logging.debug("Pulled blob %s from Broker %s", digest[:12], peer, extra=logger_config.RATE_LIMITED)
+                return True
+        except Exception as e:
+            logging.warning(f"Pulling blob {digest[:12]} from Broker {peer} failed: {e}")
+            return False
+
+    def ensure(self, message, source):
+        """
+        If ``message`` refers to a blob missing locally, pull it from the
+        broker that sent the message, in the background.
+
+        :param source: ID of the sending broker, or None for clients.
+        """
+        blob = parse_reference(message)
+        if blob is None or source is None or blob.digest in self.pulls or self.exists(blob.digest):
+            return
+        task = asyncio.ensure_future(self.pull(blob.digest, source))
+        self.pulls[blob.digest] = task
+        task.add_done_callback(lambda _: self.pulls.pop(blob.digest, None))
+
+    async def handle_get(self, request):
+        """
+        Download a blob (``GET /blobs/{digest}``), served with sendfile.
+
+        A blob this broker lacks is streamed through from the first peer that
+        has it; requests from peers are only answered from the local store.
+        """
+        digest = request.match_info["digest"]
+        if not _DIGEST.match(digest):
+            return web.json_response({"status": "error", "message": "Invalid digest."}, status=400)
+        # Content-addressed, so a blob never changes
+        headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+        if self.exists(digest):
+            return web.FileResponse(self.path(digest), chunk_size=self.chunk_size, headers=headers)
+        if PEER_HEADER not in request.headers:
+            for peer in self.peers():
+                response = await self._relay(request, digest, peer, headers)
+                if response is not None:
+                    return response
+        return web.json_response({"status": "error", "message": "Blob not found."}, status=404)
+
+    async def _relay(self, request, digest, peer, headers):
+        """Stream a blob from a peer to the client, chunk by chunk."""
+        response = None
+        try:
+            async with self.directory.session(peer).get(
+                self.directory.url(peer, f"/blobs/{digest}"), timeout=TRANSFER_TIMEOUT
+            ) as upstream:
+                if upstream.status != 200:
+                    return None
+                response = web.StreamResponse(headers={**headers, "Content-Type": "application/octet-stream"})
+                if upstream.content_length is not None:
+                    response.content_length = upstream.content_length
+                await response.prepare(request)
+                if request.method != "HEAD":
+                    async for chunk in upstream.content.iter_chunked(self.chunk_size):
+                        await response.write(chunk)
+                await response.write_eof()
+                return response
+        except aiohttp.ClientError as e:
+            if response is not None and response.prepared:
+                raise  # Part of the blob was sent; abort the download
+            logging.warning(f"Relaying blob {digest[:12]} from Broker {peer} failed: {e}")
+            return None
+
+    async def handle_put(self, request):
+        """Receive a blob pushed by another broker (``PUT /blobs/{digest}``)."""
+        if PEER_HEADER not in request.headers:
+            return web.json_response({"status": "error", "message": "Only brokers may push blobs."}, status=403)
+        digest = request.match_info["digest"]
+        if not _DIGEST.match(digest):
+            return web.json_response({"status": "error", "message": "Invalid digest."}, status=400)
+        if self.exists(digest):
+            return web.json_response({"status": "success", "digest": digest})
+        try:
+            _, size, temp_path = await self.receive(request.content, expected_digest=digest)
+            self.commit(digest, temp_path)
+        except BlobTooLarge as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=413)
+        except ValueError as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+        return web.json_response({"status": "success", "digest": digest, "size": size}, status=201)
@@ -1,6 +1,10 @@
 import argparse
 import asyncio
+import hashlib
+import json
 import logging
+import os
+import time
 from util import logger_config
 import uuid
 from aiohttp import web
@@ -8,8 +12,19 @@ from heartbeat import Heartbeat
 from election import LeaderElection
 from replication import DataReplication
 from datatable import DataStore  # Database handler
-import aiohttp
 from membership import Membership
+from partitioning import PartitionPlacement
+from load_report import LoadReporter
+from sequencing import SequenceAllocator
+from peers import PEER_HEADER, PeerDirectory
+from metrics import REGISTRY
+from tracing import TRACEPARENT, Tracer
+from profiling import AdminGuard, LoopLagMonitor, MemorySnapshots, SamplingProfiler, handle_tasks
+from admission import AdmissionControl
+from blobs import BlobStore, BlobTooLarge, make_reference
+from compression import BATCH_CONTENT_TYPE, TopicCompressor, pack_messages, unpack_messages
+from filters import SubscriptionFilters
+from partition_cache import PartitionCache
 
 logger_config.setup_logger()
 
@@ -23,62 +38,289 @@ parser.add_argument(
     required=False,
     help="Registry service URL for peer discovery",
 )
+parser.add_argument(
+    "--partitions", type=int, default=8, help="Number of partitions per topic"
+)
+parser.add_argument(
+    "--replication_factor",
+    type=int,
+    default=3,
+    help="Number of brokers holding a copy of each partition",
+)
+parser.add_argument(
+    "--phi_threshold",
+    type=float,
+    default=8.0,
+    help="Heartbeat suspicion level (phi) at which a peer is considered failed",
+)
+parser.add_argument(
+    "--advertise",
+    type=str,
+    required=False,
+    help="Base URL other services use to reach this broker (default http://broker-<id>:<port>)",
+)
+parser.add_argument(
+    "--peer_secret",
+    type=str,
+    default=os.environ.get("PEER_SECRET"),
+    help="Secret shared by all brokers, proving inter-broker requests (default: PEER_SECRET env)",
+)
+parser.add_argument(
+    "--admin_token",
+    type=str,
+    default=os.environ.get("ADMIN_TOKEN"),
+    help="Bearer token allowing /admin requests from other hosts (default: ADMIN_TOKEN env)",
+)
+parser.add_argument(
+    "--log_level",
+    type=str,
+    default=None,
+    help="Default log level (default: LOG_LEVEL env, else INFO)",
+)
+parser.add_argument(
+    "--log_levels",
+    type=str,
+    default=None,
+    help="Per-module log levels, e.g. replication=WARNING,heartbeat=DEBUG (adds to LOG_LEVELS env)",
+)
+parser.add_argument(
+    "--data_dir",
+    type=str,
+    default=".",
+    help="Directory holding the SQLite database (data_store.db), trace spans and blobs",
+)
+parser.add_argument(
+    "--trace_file",
+    type=str,
+    default=None,
+    help="Rotating file receiving message trace spans (Zipkin v2 JSON lines; default: <data_dir>/traces.jsonl)",
+)
+parser.add_argument(
+    "--trace_sample",
+    type=float,
+    default=1.0,
+    help="Fraction of new message traces recorded (0 disables tracing)",
+)
+parser.add_argument(
+    "--max_in_flight",
+    type=int,
+    default=512,
+    help="Client publish requests handled concurrently before answering 429 (0 for no cap)",
+)
+parser.add_argument(
+    "--queue_high_water",
+    type=int,
+    default=1000,
+    help="Replication retry queue length at which client publishes are shed with 429 (0 to never shed)",
+)
+parser.add_argument(
+    "--publisher_rate",
+    type=float,
+    default=0,
+    help="Messages per second allowed per publisher (0 for no limit)",
+)
+parser.add_argument(
+    "--publisher_burst", type=float, default=None, help="Publisher burst size in messages (default: one second's worth)"
+)
+parser.add_argument(
+    "--topic_rate",
+    type=float,
+    default=0,
+    help="Messages per second allowed per topic on this broker (0 for no limit)",
+)
+parser.add_argument(
+    "--topic_burst", type=float, default=None, help="Topic burst size in messages (default: one second's worth)"
+)
+parser.add_argument(
+    "--trusted_proxies",
+    type=str,
+    default="",
+    help="Comma-separated addresses (e.g. the registry's) trusted to set X-Forwarded-For and X-Publisher-Id "
+    "for rate limiting; other clients are limited by their own address",
+)
+parser.add_argument(
+    "--blob_dir",
+    type=str,
+    default=None,
+    help="Directory of the content-addressed store for bodies uploaded to /publish_blob (default: <data_dir>/blobs)",
+)
+parser.add_argument(
+    "--max_blob_bytes",
+    type=int,
+    default=1024 ** 3,
+    help="Largest body accepted by /publish_blob, in bytes",
+)
+parser.add_argument(
+    "--compress_topics",
+    type=str,
+    default="",
+    help="Comma-separated topics stored compressed with trained dictionaries ('*' for all)",
+)
+parser.add_argument(
+    "--dictionary_sample",
+    type=int,
+    default=500,
+    help="Messages a compressed topic needs before its dictionary is trained from them",
+)
+parser.add_argument(
+    "--compression_level", type=int, default=6, help="zlib level for compressed topics (1-9)"
+)
+parser.add_argument(
+    "--filter_ttl",
+    type=float,
+    default=3600,
+    help="Seconds a subscription filter is kept without being read",
+)
+parser.add_argument(
+    "--filter_max_matches",
+    type=int,
+    default=10000,
+    help="Matching sequence numbers kept per subscription filter and partition",
+)
 args = parser.parse_args()
+logger_config.configure_levels(args.log_level, args.log_levels)
 
 # Broker configurations
 BROKER_ID = args.broker_id
 PORT = args.port
 HOST = "0.0.0.0"  # Listen on all interfaces
 REGISTRY_URL = args.registry
+READ_BATCH_SIZE = 5  # Messages returned per topic read
+STARTED_AT = time.monotonic()
+ADVERTISED_URL = args.advertise or f"http://broker-{BROKER_ID}:{PORT}"
 
 # Initialize components
-data_store = DataStore()  # SQLite database for storing messages
-heartbeat = Heartbeat(BROKER_ID)  # Heartbeat without initial peers
-replication = DataReplication(data_store, BROKER_ID, port=PORT)
+directory = PeerDirectory(BROKER_ID, secret=args.peer_secret)  # Advertised peer addresses and pooled connections
+if not args.peer_secret:
+    logging.warning("No --peer_secret set: any request naming a broker in X-Broker-Id is trusted as that peer.")
+os.makedirs(args.data_dir, exist_ok=True)
+tracer = Tracer(
+    f"broker-{BROKER_ID}",
+    (args.trace_file or os.path.join(args.data_dir, "traces.jsonl")) if args.trace_sample > 0 else None,
+    args.trace_sample,
+)
+data_store = DataStore(os.path.join(args.data_dir, "data_store.db"))  # SQLite database for storing messages
+heartbeat = Heartbeat(
+    BROKER_ID, phi_threshold=args.phi_threshold, directory=directory
+)  # Heartbeat without initial peers
+replication = DataReplication(
+    data_store, BROKER_ID, port=PORT, liveness=heartbeat, directory=directory, tracer=tracer
+)
+placement = PartitionPlacement(
+    BROKER_ID,
+    num_partitions=args.partitions,
+    replication_factor=args.replication_factor,
+)
+blob_store = BlobStore(
+    args.blob_dir or os.path.join(args.data_dir, "blobs"), directory, peers=lambda: list(heartbeat.peers), max_bytes=args.max_blob_bytes
+)
+compressor = TopicCompressor(
+    data_store,
+    directory,
+    topics=[topic.strip() for topic in args.compress_topics.split(",") if topic.strip()],
+    sample_size=args.dictionary_sample,
+    level=args.compression_level,
+)
+filters = SubscriptionFilters(
+    directory,
+    peers=lambda: list(heartbeat.peers),
+    ttl=args.filter_ttl,
+    max_matches=args.filter_max_matches,
+)
+admission = AdmissionControl(
+    lambda: replication.failed_queue.qsize(),
+    max_in_flight=args.max_in_flight,
+    queue_high_water=args.queue_high_water,
+    publisher_rate=args.publisher_rate,
+    publisher_burst=args.publisher_burst,
+    topic_rate=args.topic_rate,
+    topic_burst=args.topic_burst,
+    trusted_proxies=[proxy.strip() for proxy in args.trusted_proxies.split(",") if proxy.strip()],
+)
+load_reporter = LoadReporter(BROKER_ID, REGISTRY_URL, ADVERTISED_URL, replication)
+partition_cache = PartitionCache(directory)  # Remote partitions read from owners, invalidated by them
+profiler = SamplingProfiler()  # Started on demand through /admin/profile
+memory_snapshots = MemorySnapshots()
+loop_lag = LoopLagMonitor()
+admin_guard = AdminGuard(args.admin_token, args.peer_secret)
+
+# Metrics served on /metrics; gauges are read at scrape time
+REQUEST_SECONDS = REGISTRY.histogram(
+    "broker_request_seconds",
+    "Handler latency by route, e.g. route=\"/publish\" for publishes.",
+    ("route",),
+)
+REGISTRY.gauge(
+    "broker_replication_failed_queue",
+    "Replications waiting in the retry queue.",
+    lambda: replication.failed_queue.qsize(),
+)
+REGISTRY.gauge(
+    "broker_publishes_in_flight",
+    "Client publish requests being handled.",
+    lambda: admission.in_flight,
+)
+REGISTRY.gauge("broker_peers", "Peers currently tracked.", lambda: len(heartbeat.peers))
+REGISTRY.gauge(
+    "broker_subscription_filters", "Subscription filters registered.", lambda: len(filters.filters)
+)
+REGISTRY.gauge(
+    "broker_topic_messages",
+    "Messages stored locally per topic (table name).",
+    lambda: {(topic,): count for topic, count in data_store.topic_counts().items()},
+    ("topic",),
+)
+ready_after = None  # Seconds from process start until the broker first became ready
 
 
-async def on_membership_change(new_members):
-    """Handle membership changes."""
-    peers = list(new_members - {BROKER_ID})  # Exclude self
-    replication.update_peers(peers)
-    heartbeat.update_peers(peers)
-    logging.info(f"Updated peers on membership change: {peers}")
+async def on_membership_change(new_members, joined, left):
+    """Apply a membership change incrementally to every component."""
+    joined = set(joined) - {BROKER_ID}  # Exclude self
+    replication.apply_membership_delta(joined, left)
+    heartbeat.apply_membership_delta(joined, left)
+    for peer in left:
+        directory.forget(peer)
+    logging.info(f"Membership change: joined {sorted(joined)}, left {sorted(left)}")
+
+    # Move partitions whose replica set changed
+    previous_members = placement.update_members(new_members)
+    if previous_members != placement.ring.nodes:
+        sequencer.drop_blocks()  # Partition primaries may have moved
+        partition_cache.clear()
+        asyncio.create_task(hand_off_partitions(previous_members, joined))
+
+    # Cut the lease short if the leader left
+    await leader_election.apply_membership_delta(joined, left)
+
 
-    # Start leader election if the membership changes
-    await leader_election.start_leader_election()
+async def hand_off_partitions(previous_members, joined):
+    """Share subscription filters with joining brokers, so handed-off messages are matched there, then hand off."""
+    for peer in joined:
+        await filters.share_all(peer)
+    await replication.hand_off_partitions(placement, previous_members)
 
 
 membership = Membership(
-    BROKER_ID, REGISTRY_URL, on_membership_change=on_membership_change
+    BROKER_ID,
+    REGISTRY_URL,
+    on_membership_change=on_membership_change,
+    address=ADVERTISED_URL,
+    liveness=heartbeat,
+    directory=directory,
 )
 # Initialize LeaderElection with dynamic peers (initially empty)
 leader_election = LeaderElection(
-    BROKER_ID, peers=[], membership_service=membership
+    BROKER_ID, peers=[], membership_service=membership, liveness=heartbeat, directory=directory
+)
+sequencer = SequenceAllocator(
+    BROKER_ID, leader_election, directory=directory, last_sequence=data_store.last_sequence
 )
 
 
 async def on_peer_failure(failed_peer):
     """Handle peer failure (invoke registry to remove failed broker)."""
     logging.info(f"Handling failure for peer {failed_peer}")
-    if REGISTRY_URL:
-        try:
-            url = f"{REGISTRY_URL}/remove/{failed_peer}"
-            async with aiohttp.ClientSession() as session:
-                async with session.delete(url) as response:
-                    if response.status == 200:
-                        logging.info(
-                            f"Successfully removed broker {failed_peer} from registry."
-                        )
-                    else:
-                        logging.warning(
-                            f"Failed to remove broker {failed_peer} from registry (HTTP {response.status})."
-                        )
-        except Exception as e:
-            logging.error(f"Error removing broker {failed_peer} from registry: {e}")
-    else:
-        logging.warning(
-            "Registry URL is not defined. Broker removal will not be performed."
-        )
+    await membership.deregister(failed_peer)
 
 
 # Pass the failure callback to Heartbeat
@@ -93,6 +335,7 @@ async def discover_peers():
     replication.update_peers(peers)
     heartbeat.update_peers(peers)
     leader_election.peers = peers  # Update peers for leader election
+    placement.update_members(membership.members)
     logging.info(f"Discovered peers: {peers}")
 
 
@@ -107,7 +350,7 @@ async def build_tree_and_start():
 
         # Start the server and block to keep it open
         app = await start_server()
-        runner = web.AppRunner(app)
+        runner = web.AppRunner(app, access_log=None)  # Request latency is in /metrics
         await runner.setup()
         site = web.TCPSite(runner, HOST, PORT)
         await site.start()
@@ -119,9 +362,266 @@ async def build_tree_and_start():
         logging.exception(f"Error building spanning tree for Broker {BROKER_ID}: {e}")
 
 
+async def forward_publish(replicas, data, trace=None):
+    """
+    Route a publish to the first reachable broker owning its partition.
+
+    :return: The owner's response, or None if none was reachable.
+    """
+    for owner in replicas:
+        url = directory.url(owner, "/publish")
+        span = tracer.start_span("forward", trace, kind="CLIENT", peer=owner)
+        try:
+            async with directory.session(owner).post(
+                url, json={**data, TRACEPARENT: span.traceparent}
+            ) as response:
+                body = await response.json()
+                heartbeat.record_contact(owner)
+                span.finish(status=response.status)
+                return web.json_response(body, status=response.status)
+        except Exception as e:
+            span.finish(error=str(e) or type(e).__name__)
+            logging.warning(f"Forwarding publish to Broker {owner} failed: {e}")
+    return None
+
+
+async def forward_batch(replicas, topic, entries):
+    """
+    Route a batch of publishes to the first reachable broker owning them.
+
+    :return: List of per-message acks from the owner, or None if none was reachable.
+    """
+    for owner in replicas:
+        url = directory.url(owner, "/publish_batch")
+        try:
+            async with directory.session(owner).post(
+                url, json={"topic": topic, "messages": entries}
+            ) as response:
+                if response.status == 200:
+                    heartbeat.record_contact(owner)
+                    return (await response.json())["acks"]
+                logging.warning(
+                    f"Forwarding batch to Broker {owner} failed (HTTP {response.status})"
+                )
+        except Exception as e:
+            logging.warning(f"Forwarding batch to Broker {owner} failed: {e}")
+    return None
+
+
+def owners_ahead(replicas):
+    """
+    Brokers to route a client publish to before numbering it here: the
+    partition's primary numbers its messages, so they are stored in
+    sequence order; the next replicas only stand in while it is unreachable.
+    """
+    return replicas[:replicas.index(BROKER_ID)] if BROKER_ID in replicas else list(replicas)
+
+
+def topic_tag(topic):
+    """
+    Stand-in for a topic inside an ETag. Topics may hold commas, which
+    split If-None-Match lists, and characters an entity tag may not contain.
+    """
+    return hashlib.md5(topic.encode("utf-8")).hexdigest()[:16]
+
+
+def partition_etag(topic, partition, version, after=None, filter_id=None):
+    """Build the validator for one partition from its high-water mark, read cursor and filter."""
+    cursor = "" if after is None else f"-{after}"
+    selection = "" if filter_id is None else f"-{filter_id}"
+    return f'"{topic_tag(topic)}-{partition}-{version}{cursor}{selection}"'
+
+
+def topic_etag(topic, versions, after=None, filter_id=None, shard=None):
+    """Build the validator for a whole topic (or a shard of it) from its partitions' high-water marks, read cursor and filter."""
+    parts = list(versions) + [after] + ([] if filter_id is None else [filter_id]) + ([] if shard is None else [shard])
+    digest = hashlib.md5(",".join(map(str, parts)).encode("utf-8")).hexdigest()[:16]
+    return f'"{topic_tag(topic)}-{digest}"'
+
+
+def parse_cursor(value):
+    """
+    Per-partition read cursor from an ``after`` parameter: the ``next_after``
+    of an earlier read (``"<partition>:<sequence>,..."``), or a single
+    sequence number applying to every partition.
+
+    :return: Dict of partition -> sequence number, None to read from the start.
+    :raises ValueError: If the cursor is malformed.
+    """
+    cursor = dict.fromkeys(range(placement.num_partitions))
+    if value is None:
+        return cursor
+    if ":" not in value:
+        return dict.fromkeys(cursor, int(value))
+    for position in value.split(","):
+        partition, sequence = position.split(":")
+        cursor[int(partition)] = int(sequence)
+    return cursor
+
+
+def parse_shard(value):
+    """
+    Partitions selected by a ``shard`` parameter ``"<index>/<count>"``: those
+    whose number modulo ``count`` is ``index``. Readers querying several
+    brokers at once give each a different index, so every partition is read
+    exactly once.
+
+    :return: List of partition numbers, all of them if ``value`` is None.
+    :raises ValueError: If the shard is malformed.
+    """
+    if value is None:
+        return list(range(placement.num_partitions))
+    index, count = (int(part) for part in value.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(value)
+    return [p for p in range(placement.num_partitions) if p % count == index]
+
+
+def format_cursor(cursor):
+    """The ``next_after`` for a per-partition cursor; None while no partition has been read."""
+    return ",".join(f"{p}:{sequence}" for p, sequence in sorted(cursor.items()) if sequence is not None) or None
+
+
+def sort_key(record):
+    """Order records by sequence number; unnumbered legacy rows go first."""
+    sequence = record.get("sequence")
+    return (sequence is not None, sequence or 0, record["timestamp"], record["message_id"])
+
+
+def not_modified(request, etag):
+    """Check a request's If-None-Match header against the current ETag."""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+
+def local_version(topic, partition, filter_id=None):
+    """Version of a local partition: its highest sequence number, or its filter matches' highest."""
+    if filter_id is not None:
+        return filters.version(filter_id, partition)
+    return data_store.partition_version(topic, partition)
+
+
+def caught_up(version, after):
+    """Whether a cursor already covers everything up to a partition's version."""
+    return after is not None and (version is None or after >= version)
+
+
+async def partition_state(topic, partition, after=None, filter_id=None):
+    """
+    Return the version (highest sequence number) of one partition, and its
+    records if they had to be fetched from another broker.
+
+    A partition is read from its primary, which stores its messages in
+    sequence order. Other replicas may receive them out of order, so a
+    cursor read from one could move past a message still on its way; they
+    only stand in while the brokers ahead of them are unreachable.
+
+    Local partitions only consult the in-memory version. Remote reads are
+    kept in ``partition_cache`` until the owner reports a change, so an idle
+    poll costs no round trip: a cursor at or past the cached version has
+    nothing new, and a read without one gets the cached records. Once the
+    cached read lapses it is revalidated with If-None-Match.
+
+    :param after: Sequence number cursor; only later messages are returned.
+    :param filter_id: Subscription filter; only its matches are returned, and
+                      the version is that of its matches.
+    :return: Tuple of (version, records or None when the partition is read locally).
+    """
+    replicas = placement.replicas_for(topic, partition)
+    ahead = owners_ahead(replicas)
+    if not ahead:
+        return local_version(topic, partition, filter_id), None
+
+    cached, fresh = partition_cache.get(topic, partition, filter_id)
+    if fresh:
+        if caught_up(cached.version, after):
+            return cached.version, []
+        if after is None and cached.records is not None:
+            return cached.version, cached.records
+    headers = {"Accept": BATCH_CONTENT_TYPE}
+    params = {"partition": partition}
+    if after is not None:
+        params["after"] = after
+    if filter_id is not None:
+        params["filter"] = filter_id
+    if cached and after is None and cached.records is not None:
+        headers["If-None-Match"] = cached.etag
+    for owner in ahead:
+        url = directory.url(owner, f"/data/{topic}")
+        for attempt in range(2):
+            generation = partition_cache.generation(topic, partition)
+            started = time.monotonic()
+            try:
+                async with directory.session(owner).get(url, params=params, headers=headers) as response:
+                    if response.status == 304 and "If-None-Match" in headers:
+                        heartbeat.record_contact(owner)
+                        partition_cache.put(
+                            topic, partition, filter_id, generation,
+                            cached.etag, cached.version, cached.records, started,
+                        )
+                        return cached.version, cached.records
+                    if response.status == 200:
+                        body = unpack_messages(await response.read())
+                        heartbeat.record_contact(owner)
+                        records = body["messages"]
+                        # Records come compressed; have their dictionaries ready for inflating
+                        await compressor.fetch_dictionaries(
+                            topic, [record["message"] for record in records], owner
+                        )
+                        partition_cache.put(
+                            topic, partition, filter_id, generation, response.headers.get("ETag"),
+                            body["version"], records if after is None else None, started,
+                        )
+                        return body["version"], records
+                    compiled = filters.filters.get(filter_id)
+                    if response.status == 404 and compiled is not None and attempt == 0:
+                        # The owner joined or restarted since the filter was shared
+                        if await filters.share(compiled, [owner]):
+                            continue
+            except Exception as e:
+                logging.warning(f"Reading {topic}/{partition} from Broker {owner} failed: {e}")
+            break
+    if BROKER_ID in replicas:
+        return local_version(topic, partition, filter_id), None
+    logging.error(f"No replica reachable for {topic}/{partition}")
+    return None, []
+
+
+def local_records(topic, partition, after=None, filter_id=None):
+    """Read a page of a local partition; only a subscription filter's matches if one is given."""
+    if filter_id is None:
+        return data_store.get_records(topic, partition, READ_BATCH_SIZE, after_sequence=after)
+    sequences = filters.sequences(filter_id, partition, after, READ_BATCH_SIZE)
+    return data_store.get_records(topic, partition, None, sequences=sequences) if sequences else []
+
+
+def on_stored(topic, partition, sequence, message):
+    """
+    Update what depends on a partition's contents after one of its messages
+    was stored: subscription filter matches, and cached reads of it here and
+    on the brokers that read it from here.
+    """
+    if filters.active(topic):
+        filters.on_stored(topic, partition, sequence, compressor.inflate(message))
+    partition_cache.changed(topic, partition)
+
+
 # REST API routes
 async def publish(request):
-    """Handle a publish request and replicate the message."""
+    """
+    Handle a publish request and replicate the message.
+
+    Client publishes are routed to the primary of the message's partition,
+    which numbers the message from its block of sequence numbers for that
+    partition (the next replica stands in while the primary is unreachable);
+    replicas sent by other brokers (``replicated``) are stored as-is.
+
+    A ``traceparent`` (W3C Trace Context) in the payload or headers makes
+    this broker's spans part of the caller's trace; otherwise a new trace
+    starts here.
+    """
     try:
         data = await request.json()
         topic = data.get("topic")
@@ -129,64 +629,514 @@ async def publish(request):
         message_id = data.get(
             "message_id", str(uuid.uuid4())
         )  # Generate a message ID if not provided
+        replicated = data.get("replicated", False)
+        rejection = admission.check_rate(request, topic)
+        if rejection is not None:
+            return rejection
+        sender = request.headers.get(PEER_HEADER)
+        if isinstance(message, dict):
+            return web.json_response({"status": "error", "message": "'message' must be a string."}, status=400)
+        if replicated and sender is None:
+            return web.json_response({"status": "error", "message": "Only brokers may send replicas."}, status=403)
+        with tracer.start_span(
+            "receive",
+            data.get(TRACEPARENT) or request.headers.get(TRACEPARENT),
+            kind="SERVER",
+            message_id=message_id,
+            topic=topic,
+            replicated=replicated,
+        ) as span:
+            response = await _publish(
+                data, topic, message, message_id, replicated, span, forwarded=sender is not None and not replicated
+            )
+            span.tags["status"] = response.status
+        # A blob reference from a peer: fetch the blob from it if missing here
+        blob_store.ensure(message, sender)
+        return response
+    except Exception as e:
+        logging.exception(f"Error in publish route: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+
+async def _publish(data, topic, message, message_id, replicated, span, forwarded=False):
+    """
+    Route, number, store and replicate one message inside its ``receive`` span.
+
+    :param forwarded: The message was routed here by another broker, which
+                      could not reach the replicas ahead of this one.
+    """
+    partition = data.get("partition")
+    if partition is None:
+        partition = placement.partition_for(topic, data.get("key") or message_id)
+    replicas = placement.replicas_for(topic, partition)
+    span.tags["partition"] = partition
+
+    if not replicated and not (forwarded and BROKER_ID in replicas):
+        ahead = owners_ahead(replicas)
+        if ahead:
+            response = await forward_publish(
+                ahead, {**data, "message_id": message_id, "partition": partition}, span
+            )
+            if response is not None:
+                return response
+            if BROKER_ID not in replicas:
+                return web.json_response(
+                    {"status": "error", "message": "No replica available for partition."},
+                    status=503,
+                )
+
+    if replicated:
+        sequence = data.get("sequence")
+    else:
+        try:
+            with tracer.start_span("sequence", span):
+                sequence = (await sequencer.assign(topic, {partition: 1}))[partition][0]
+        except ConnectionError as e:
+            logging.error(f"Cannot number message for '{topic}': {e}")
+            return web.json_response({"status": "error", "message": str(e)}, status=503)
+
+    if not replicated:
+        message = compressor.compress(topic, message)  # Replicas get the compressed bytes
+
+    # Store the message in the SQLite database
+    with tracer.start_span("store", span, sequence=sequence):
+        stored = data_store.store_message(topic, message, message_id, partition, sequence)
+    if stored:
+        on_stored(topic, partition, sequence, message)
+        logging.debug(
+            "Message published: %s (ID: %s, sequence %s)",
+            topic,
+            message_id,
+            sequence,
+            extra=logger_config.RATE_LIMITED,
+        )
+
+        # Replicate the message to the other brokers owning the partition
+        if not replicated:
+            await replication.replicate_message(
+                topic, message, message_id, partition, replicas, sequence, trace=span
+            )
+        return web.json_response(
+            {"status": "success", "partition": partition, "sequence": sequence}
+        )
+    else:
+        logging.warning(f"Duplicate message detected: {message_id}")
+        return web.json_response(
+            {"status": "failure", "message": "Duplicate message detected."}
+        )
+
+
+async def publish_blob(request):
+    """
+    Publish a large body, streamed rather than parsed.
+
+    The raw request body (any ``Content-Type``) is written in chunks to the
+    blob store and pushed to the brokers owning the message's partition; the
+    message itself only holds a reference to the blob (see
+    ``blobs.make_reference``), which is then published like any other
+    message. Query parameters: ``topic`` (required), ``message_id``, ``key``.
+
+    The response is the publish ack plus the blob's ``digest`` and ``size``;
+    the body can be downloaded from ``/blobs/{digest}`` on any broker.
+    """
+    try:
+        topic = request.query.get("topic")
+        if not topic:
+            return web.json_response({"status": "error", "message": "Missing 'topic' parameter."}, status=400)
+        rejection = admission.check_rate(request, topic)
+        if rejection is not None:
+            return rejection
+        message_id = request.query.get("message_id") or str(uuid.uuid4())
+        key = request.query.get("key")
+        with tracer.start_span(
+            "receive",
+            request.headers.get(TRACEPARENT),
+            kind="SERVER",
+            message_id=message_id,
+            topic=topic,
+            blob=True,
+        ) as span:
+            with tracer.start_span("upload", span) as upload:
+                try:
+                    digest, size, staged = await blob_store.receive(request.content)
+                except BlobTooLarge as e:
+                    upload.tags["error"] = str(e)
+                    return web.json_response({"status": "error", "message": str(e)}, status=413)
+                upload.tags.update(digest=digest, size=size)
+
+            partition = placement.partition_for(topic, key or message_id)
+            replicas = placement.replicas_for(topic, partition)
+            with tracer.start_span("push", span, digest=digest):
+                pushed = await blob_store.push(
+                    digest, [b for b in replicas if b != BROKER_ID], path=staged
+                )
+            if BROKER_ID in replicas or not all(pushed):
+                # Keep a copy if this broker owns the message, or so owners can pull it
+                blob_store.commit(digest, staged)
+            else:
+                blob_store.discard(staged)
+
+            reference = make_reference(digest, size, request.content_type)
+            data = {"topic": topic, "message": reference, "message_id": message_id, "partition": partition}
+            response = await _publish(data, topic, reference, message_id, False, span)
+            span.tags["status"] = response.status
+            if response.status != 200:
+                return response
+            return web.json_response({**json.loads(response.text), "digest": digest, "size": size})
+    except Exception as e:
+        logging.exception(f"Error in publish_blob route: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
 
-        # Store the message in the SQLite database
-        stored = data_store.store_message(topic, message, message_id)
-        if stored:
-            logging.info(f"Message published: {topic} -> {message} (ID: {message_id})")
 
-            # Replicate the message to other brokers
-            await replication.replicate_message(topic, message, message_id)
-            return web.json_response({"status": "success"})
+async def publish_batch(request):
+    """
+    Handle a batch of publishes for one topic.
+
+    Expected JSON payload (optionally gzip-encoded):
+    {
+        "topic": str,
+        "messages": [{"message": str, "message_id": str, "key": str}, ...]
+    }
+
+    Other brokers send replicas and hand-offs (``"replicated": true``) as a
+    ``BATCH_CONTENT_TYPE`` body instead, which carries compressed messages
+    as raw bytes; only authenticated peers may send either.
+
+    Messages are grouped by the brokers owning their partitions: groups whose
+    primary is this broker are numbered in request order, stored in one
+    transaction each and replicated as one request per peer, other groups
+    are forwarded to their primary. The response carries one ack per
+    message, in request order.
+
+    Each message gets its own ``receive`` span, continuing the trace in the
+    message's ``traceparent`` field or, failing that, the request header.
+    """
+    spans = []
+    try:
+        sender = request.headers.get(PEER_HEADER)
+        if request.content_type == BATCH_CONTENT_TYPE:
+            # Stored messages from another broker, compressed ones as they are
+            if sender is None:
+                return web.json_response(
+                    {"status": "error", "message": "Only brokers may send message batches."}, status=403
+                )
+            try:
+                data = unpack_messages(await request.read())
+            except ValueError as e:
+                return web.json_response({"status": "error", "message": str(e)}, status=400)
         else:
-            logging.warning(f"Duplicate message detected: {message_id}")
+            data = await request.json()
+            if any(isinstance(item.get("message"), dict) for item in data.get("messages", [])):
+                return web.json_response({"status": "error", "message": "Messages must be strings."}, status=400)
+        topic = data.get("topic")
+        replicated = data.get("replicated", False)
+        messages = data.get("messages", [])
+        if replicated and sender is None:
+            return web.json_response({"status": "error", "message": "Only brokers may send replicas."}, status=403)
+        rejection = admission.check_rate(request, topic, len(messages))
+        if rejection is not None:
+            return rejection
+        payloads = [item.get("message") for item in messages]
+        if not await compressor.fetch_dictionaries(topic, payloads, sender):
             return web.json_response(
-                {"status": "failure", "message": "Duplicate message detected."}
+                {"status": "error", "message": "Compression dictionary unavailable."}, status=503
+            )
+
+        groups = {}  # Replica tuple -> entries owned by those brokers
+        entries = []
+        for item in messages:
+            message_id = item.get("message_id") or str(uuid.uuid4())
+            partition = item.get("partition")
+            if partition is None:
+                partition = placement.partition_for(topic, item.get("key") or message_id)
+            span = tracer.start_span(
+                "receive",
+                item.get(TRACEPARENT) or request.headers.get(TRACEPARENT),
+                kind="SERVER",
+                message_id=message_id,
+                topic=topic,
+                partition=partition,
+                replicated=replicated,
+                batch=len(messages),
             )
+            spans.append(span)
+            entry = {
+                "message": item.get("message"),
+                "message_id": message_id,
+                "partition": partition,
+                "sequence": item.get("sequence"),
+                TRACEPARENT: span.traceparent,
+            }
+            entries.append(entry)
+            replicas = (BROKER_ID,) if replicated else tuple(
+                placement.replicas_for(topic, partition)
+            )
+            groups.setdefault(replicas, []).append(entry)
+
+        # A peer forwards a group here only when the replicas ahead of this one were unreachable
+        forwarded = sender is not None and not replicated
+        local = []  # (replicas, entries) numbered and stored here
+        forwards = []  # (replicas, entries, brokers to route them to first)
+        for replicas, group in groups.items():
+            ahead = [] if replicated or (forwarded and BROKER_ID in replicas) else owners_ahead(replicas)
+            if ahead:
+                forwards.append((replicas, group, ahead))
+            else:
+                local.append((replicas, group))
+
+        try:
+            acks = await store_batch(topic, local, replicated)
+            results = await asyncio.gather(
+                *(forward_batch(ahead, topic, group) for _, group, ahead in forwards)
+            )
+            standing_in = []  # Groups whose brokers ahead of this one were unreachable
+            for (replicas, group, _), forwarded_acks in zip(forwards, results):
+                if forwarded_acks is not None:
+                    for ack in forwarded_acks:
+                        acks[ack["message_id"]] = ack
+                elif BROKER_ID in replicas:
+                    standing_in.append((replicas, group))
+                else:
+                    for entry in group:
+                        acks[entry["message_id"]] = {
+                            "message_id": entry["message_id"],
+                            "partition": entry["partition"],
+                            "status": "error",
+                        }
+            acks.update(await store_batch(topic, standing_in, replicated))
+        except ConnectionError as e:
+            logging.error(f"Cannot number batch for '{topic}': {e}")
+            return web.json_response({"status": "error", "message": str(e)}, status=503)
+        for entry in entries:
+            blob_store.ensure(entry["message"], sender)
+
+        logging.debug(
+            "Batch published: %s -> %d messages", topic, len(entries), extra=logger_config.RATE_LIMITED
+        )
+        return web.json_response(
+            {"status": "success", "acks": [acks[entry["message_id"]] for entry in entries]}
+        )
     except Exception as e:
-        logging.exception(f"Error in publish route: {e}")
+        logging.exception(f"Error in publish_batch route: {e}")
         return web.json_response({"status": "error", "message": str(e)}, status=500)
+    finally:
+        for span in spans:
+            span.finish()
+
+
+async def store_batch(topic, groups, replicated):
+    """
+    Number (unless replicated), store and replicate groups of a batch owned
+    by this broker.
+
+    Every message is numbered first, in request order, and all of them are
+    stored before the next ``await``, so each partition's messages are
+    stored in sequence order.
+
+    :param groups: List of (replicas, entries) tuples.
+    :return: Dict of message ID -> ack.
+    :raises ConnectionError: If the messages could not be numbered.
+    """
+    if not replicated and groups:
+        counts = {}
+        for _, group in groups:
+            for entry in group:
+                counts[entry["partition"]] = counts.get(entry["partition"], 0) + 1
+        numbers = {
+            partition: iter(sequences) for partition, sequences in (await sequencer.assign(topic, counts)).items()
+        }
+        for _, group in groups:
+            for entry in group:
+                entry["sequence"] = next(numbers[entry["partition"]])
+
+    acks = {}
+    replications = []
+    for replicas, group in groups:
+        if not replicated:
+            for entry in group:
+                entry["message"] = compressor.compress(topic, entry["message"])
+        stores = [tracer.start_span("store", entry[TRACEPARENT]) for entry in group]
+        stored = data_store.store_messages(topic, group)
+        for store, ok in zip(stores, stored):
+            store.finish(stored=ok)
+        for entry, ok in zip(group, stored):
+            if ok:
+                on_stored(topic, entry["partition"], entry["sequence"], entry["message"])
+            acks[entry["message_id"]] = {
+                "message_id": entry["message_id"],
+                "partition": entry["partition"],
+                "sequence": entry["sequence"],
+                "status": "success" if ok else "duplicate",
+            }
+        new_entries = [entry for entry, ok in zip(group, stored) if ok]
+        if new_entries and not replicated:
+            replications.append((new_entries, replicas))
+    for new_entries, replicas in replications:
+        await replication.replicate_batch(topic, new_entries, replicas)
+    return acks
 
 
 async def get_data(request):
-    """Fetch messages for a specific topic."""
+    """
+    Fetch messages for a specific topic, in topic sequence order.
+
+    With a ``partition`` query parameter only the local copy of that partition
+    is returned (used between brokers); otherwise every partition is read from
+    its primary and the results are merged. With ``after=<cursor>`` only
+    messages after that cursor are returned; ``next_after`` in the response
+    is the cursor for the following read, holding the last sequence number
+    read from each partition (see ``parse_cursor``). Since every replica
+    stores the same numbers, a cursor gives the same answer on any broker.
+
+    Responses carry an ETag derived from the partitions' high-water marks.
+    A request whose If-None-Match matches is answered with 304 before SQLite
+    is read or any JSON is built.
+
+    Messages of compressed topics are read and exchanged between brokers
+    compressed; only the rows returned to a client are decompressed.
+
+    With ``filter=<id>`` (see ``POST /filters``) only the messages matching
+    that subscription filter are returned, read from the filter's matches
+    rather than by scanning the partitions.
+
+    With ``shard=<index>/<count>`` only every ``count``-th partition is read
+    (see ``parse_shard``), and ``next_after`` only moves for those.
+    ``high_water`` holds the version of every partition read, so a reader
+    can tell how far its cursor is behind.
+    """
     try:
         topic = request.match_info.get("topic")
-        messages = data_store.get_messages(topic)  # Fetch messages from SQLite
-        return web.json_response({"topic": topic, "messages": messages})
+        partition = request.query.get("partition")
+        after = request.query.get("after")
+        filter_id = request.query.get("filter")
+        if filter_id is not None and filters.get(filter_id, topic) is None:
+            return web.json_response(
+                {"status": "error", "message": f"Unknown filter for topic '{topic}'."}, status=404
+            )
+        if partition is not None:
+            partition = int(partition)
+            after = int(after) if after is not None else None
+            sender = request.headers.get(PEER_HEADER)
+            if sender is not None:
+                partition_cache.watch(sender, topic, partition)  # Tell it when the partition changes
+            version = local_version(topic, partition, filter_id)
+            etag = partition_etag(topic, partition, version, after, filter_id)
+            if not_modified(request, etag):
+                return web.Response(status=304, headers={"ETag": etag})
+            records = [] if caught_up(version, after) else local_records(topic, partition, after, filter_id)
+            if sender is not None and BATCH_CONTENT_TYPE in request.headers.get("Accept", ""):
+                # Between brokers, compressed messages are sent as stored
+                return web.Response(
+                    body=pack_messages({"topic": topic, "partition": partition, "version": version}, records),
+                    content_type=BATCH_CONTENT_TYPE,
+                    headers={"ETag": etag},
+                )
+            records = compressor.inflate_records(records)
+            return web.json_response(
+                {
+                    "topic": topic,
+                    "partition": partition,
+                    "version": version,
+                    "messages": [record["message"] for record in records],
+                    "records": records,
+                },
+                headers={"ETag": etag},
+            )
+
+        try:
+            cursor = parse_cursor(after)
+        except ValueError:
+            return web.json_response({"status": "error", "message": f"Malformed cursor '{after}'."}, status=400)
+        shard = request.query.get("shard")
+        try:
+            selected = parse_shard(shard)
+        except ValueError:
+            return web.json_response({"status": "error", "message": f"Malformed shard '{shard}'."}, status=400)
+        states = await asyncio.gather(*(partition_state(topic, p, cursor[p], filter_id) for p in selected))
+        etag = topic_etag(topic, [version for version, _ in states], format_cursor(cursor), filter_id, shard)
+        if not_modified(request, etag):
+            return web.Response(status=304, headers={"ETag": etag})
+
+        records = []
+        for p, (version, remote_records) in zip(selected, states):
+            if remote_records is None:
+                remote_records = [] if caught_up(version, cursor[p]) else local_records(topic, p, cursor[p], filter_id)
+            records.extend(remote_records)
+        # Each partition's records are in sequence order, so the page holds a
+        # prefix of every partition and its cursor moves to the last one taken
+        records = compressor.inflate_records(sorted(records, key=sort_key)[:READ_BATCH_SIZE])
+        for record in records:
+            if record["sequence"] is not None:
+                cursor[record["partition"]] = record["sequence"]
+        messages = [record["message"] for record in records]
+        next_after = format_cursor(cursor)
+        high_water = {p: version for p, (version, _) in zip(selected, states)}
+        return web.json_response(
+            {
+                "topic": topic,
+                "messages": messages,
+                "records": records,
+                "next_after": next_after,
+                "high_water": high_water,
+            },
+            headers={"ETag": etag},
+        )
     except Exception as e:
         logging.exception(f"Error in get_data route: {e}")
         return web.json_response({"status": "error", "message": str(e)}, status=500)
 
 
+async def prune_partition(request):
+    """
+    Delete this broker's copy of a partition it no longer owns
+    (``POST /partitions/prune`` with ``{"topic": ..., "partition": ...}``),
+    sent by the broker that handed the partition off to its new owners.
+    Refused while this broker still places the partition on itself.
+    """
+    if PEER_HEADER not in request.headers:
+        return web.json_response({"status": "error", "message": "Only brokers may prune partitions."}, status=403)
+    try:
+        data = await request.json()
+        topic, partition = data["topic"], int(data["partition"])
+    except (ValueError, TypeError, KeyError) as e:
+        return web.json_response({"status": "error", "message": f"Malformed request: {e}"}, status=400)
+    if placement.is_replica(topic, partition):
+        return web.json_response(
+            {"status": "error", "message": f"Broker {BROKER_ID} still owns {topic}/{partition}."}, status=409
+        )
+    deleted = data_store.delete_partition(topic, partition)
+    return web.json_response({"status": "success", "deleted": deleted})
+
+
 async def heartbeat_check(request):
     """Health check endpoint for broker."""
     return web.Response(text=f"Broker {BROKER_ID} is healthy and running.")
 
 
-async def leader_announcement(request):
+async def readiness(request):
     """
-    Endpoint for receiving leader announcements from other brokers.
-    
-    Expected JSON payload:
-    {
-        "leader_id": int
-    }
+    Readiness endpoint: 200 once the broker has registered, applied the
+    registry's member list, knows a leader holding a valid lease and has no
+    partition hand-off or replication retry outstanding; 503 otherwise.
+    Both answers list the individual checks.
     """
-    try:
-        data = await request.json()
-        leader_id = data.get("leader_id")
-
-        if leader_id:
-            leader_election.leader = leader_id
-            logging.info(f"Broker {BROKER_ID} acknowledged new leader {leader_id}")
-            return web.json_response({"status": "success", "message": "Leader announced."})
-        else:
-            logging.warning(f"Invalid leader announcement received: {data}")
-            return web.json_response({"status": "error", "message": "Invalid leader announcement."}, status=400)
-    except Exception as e:
-        logging.exception(f"Error in leader announcement route: {e}")
-        return web.json_response({"status": "error", "message": str(e)}, status=500)
+    global ready_after
+    checks = {
+        "registered": membership.registered,
+        "membership": membership.seeded,
+        "election": leader_election.leader is not None
+        and leader_election.lease_expires > time.monotonic(),
+        "catch_up": replication.handoffs_in_progress == 0
+        and replication.failed_queue.empty(),
+    }
+    ready = all(checks.values())
+    if ready and ready_after is None:
+        ready_after = time.monotonic() - STARTED_AT
+        logging.info(f"Broker {BROKER_ID} ready {ready_after:.2f}s after start.")
+    return web.json_response(
+        {"ready": ready, "checks": checks, "ready_after": ready_after},
+        status=200 if ready else 503,
+    )
 
 
 # Background task for heartbeat and leader election
@@ -194,6 +1144,9 @@ async def start_background_tasks(app):
     """Start background tasks."""
     app["membership_task"] = asyncio.create_task(membership.start_membership_service())
     app["heartbeat_task"] = asyncio.create_task(heartbeat.start_heartbeat())
+    app["load_report_task"] = asyncio.create_task(load_reporter.start_reporting())
+    app["loop_lag_task"] = asyncio.create_task(loop_lag.start())
+    app["filter_expiry_task"] = asyncio.create_task(filters.expire_idle())
     app["leader_election_task"] = asyncio.create_task(
         leader_election.start_leader_election()
     )
@@ -202,24 +1155,78 @@ async def start_background_tasks(app):
 
 async def cleanup_background_tasks(app):
     """Cancel background tasks and close database."""
+    app["membership_task"].cancel()
     app["heartbeat_task"].cancel()
     app["leader_election_task"].cancel()  # Cancel leader election task
+    app["load_report_task"].cancel()
+    app["loop_lag_task"].cancel()
+    app["filter_expiry_task"].cancel()
     await asyncio.gather(
-        app["heartbeat_task"], app["leader_election_task"], return_exceptions=True
+        app["membership_task"],
+        app["heartbeat_task"],
+        app["leader_election_task"],
+        app["load_report_task"],
+        app["loop_lag_task"],
+        app["filter_expiry_task"],
+        return_exceptions=True,
     )
+    profiler.stop()
     # Stop replication retries
     await replication.stop_background_tasks(app)
+    # Close the pooled peer connections
+    await directory.close()
+    tracer.close()
     # Close the database connection
     data_store.close()
 
 
 async def start_server():
     """Initialize the application and add routes."""
-    app = web.Application()
+    app = web.Application(
+        middlewares=[
+            directory.middleware,
+            admin_guard.middleware,
+            REGISTRY.middleware(REQUEST_SECONDS),
+            load_reporter.middleware,
+            heartbeat.middleware,
+            admission.middleware,
+        ]
+    )
     app.router.add_get("/heartbeat", heartbeat_check)
+    app.router.add_get("/ready", readiness)
+    app.router.add_get("/metrics", REGISTRY.handle_metrics)
     app.router.add_post("/publish", publish)
+    app.router.add_post("/publish_batch", publish_batch)
+    app.router.add_post("/publish_blob", publish_blob)
+    app.router.add_get("/blobs/{digest}", blob_store.handle_get)
+    app.router.add_put("/blobs/{digest}", blob_store.handle_put)
     app.router.add_get("/data/{topic}", get_data)
-    app.router.add_post("/leader_announcement", leader_announcement)  # New route for leader announcements
+    app.router.add_get("/filters", filters.handle_list)
+    app.router.add_post("/filters", filters.handle_register)
+    app.router.add_put("/filters/{filter_id}", filters.handle_put)
+    app.router.add_delete("/filters/{filter_id}", filters.handle_delete)
+    app.router.add_get("/dictionaries/{dictionary}", compressor.handle_dictionary)
+    app.router.add_post("/leader_announcement", leader_election.handle_announcement)
+    app.router.add_get("/leader", leader_election.handle_status)
+    app.router.add_post("/sequence/allocate", sequencer.handle_allocate)
+    app.router.add_post("/partitions/invalidate", partition_cache.handle_invalidate)
+    app.router.add_post("/partitions/prune", prune_partition)
+    app.router.add_post("/swim/ping", membership.handle_ping)
+    app.router.add_post("/swim/ping_req", membership.handle_ping_req)
+    # Diagnostics of a running broker
+    app.router.add_post("/admin/profile/start", profiler.handle_start)
+    app.router.add_post("/admin/profile/stop", profiler.handle_stop)
+    app.router.add_get("/admin/profile", profiler.handle_summary)
+    app.router.add_get("/admin/profile/folded", profiler.handle_download)
+    app.router.add_post("/admin/tracemalloc/start", memory_snapshots.handle_start)
+    app.router.add_post("/admin/tracemalloc/stop", memory_snapshots.handle_stop)
+    app.router.add_post("/admin/tracemalloc/snapshot", memory_snapshots.handle_snapshot)
+    app.router.add_get("/admin/tracemalloc/snapshots/{snapshot_id}", memory_snapshots.handle_report)
+    app.router.add_get("/admin/tracemalloc/diff", memory_snapshots.handle_diff)
+    app.router.add_get("/admin/tasks", handle_tasks)
+    app.router.add_get("/admin/loop_lag", loop_lag.handle_stats)
+    app.router.add_get("/admin/compression", compressor.handle_stats)
+    app.router.add_post("/admin/compression/{topic}/train", compressor.handle_train)
     app.on_startup.append(start_background_tasks)
     app.on_cleanup.append(cleanup_background_tasks)
     return app
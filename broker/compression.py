@@ -0,0 +1,364 @@
+# File: compression.py
+
+import asyncio
+import heapq
+import json
+import logging
+import struct
+import zlib
+from collections import Counter
+from aiohttp import web
+from util import logger_config
+from metrics import REGISTRY
+from blobs import REFERENCE_PREFIX
+
+logger_config.setup_logger()
+
+# Inside a broker a compressed message is {"dictionary": <id>, "compressed":
+# <bytes>} in place of the message text, and it is only inflated for clients.
+DICTIONARY = "dictionary"
+COMPRESSED = "compressed"
+
+# Stored messages travel between brokers (replication, hand-off, partition
+# reads) in one binary body per request, so compressed bytes are sent as they
+# are: a 4-byte big-endian header length, a JSON header with one entry per
+# message (its fields, dictionary ID and byte length), then the messages.
+BATCH_CONTENT_TYPE = "application/x-newspubsub-batch"
+
+# zlib only looks back 32 KiB, so a larger dictionary would not be used
+MAX_DICTIONARY_BYTES = 32 * 1024
+
+COMPRESSION_BYTES = REGISTRY.counter(
+    "broker_compression_bytes_total",
+    "Bytes of message text compressed (direction=\"in\") and stored (direction=\"out\").",
+    ("direction",),
+)
+
+
+def dictionary_id(data):
+    """Identify a dictionary by its Adler-32, as zlib itself does."""
+    return zlib.adler32(data)
+
+
+def encode_payload(value, dictionary):
+    """Message field for a stored column value: text as-is, compressed bytes wrapped."""
+    if dictionary is None:
+        return value
+    return {DICTIONARY: dictionary, COMPRESSED: bytes(value)}
+
+
+def decode_payload(message):
+    """
+    Column value for a message field.
+
+    :return: Tuple of (text or compressed bytes, dictionary ID or None).
+    """
+    if isinstance(message, dict):
+        return message[COMPRESSED], int(message[DICTIONARY])
+    return message, None
+
+
+def pack_messages(header, entries):
+    """
+    Encode messages for another broker (``BATCH_CONTENT_TYPE``).
+
+    :param header: JSON-serializable fields of the whole body, e.g. the topic.
+    :param entries: Dicts with a ``message`` field and other JSON-serializable fields.
+    :return: The request or response body.
+    """
+    index, payloads = [], []
+    for entry in entries:
+        value, dictionary = decode_payload(entry["message"])
+        data = value if dictionary is not None else str(value).encode("utf-8")
+        fields = {name: field for name, field in entry.items() if name != "message"}
+        index.append({**fields, DICTIONARY: dictionary, "length": len(data)})
+        payloads.append(data)
+    head = json.dumps({**header, "messages": index}).encode("utf-8")
+    return struct.pack(">I", len(head)) + head + b"".join(payloads)
+
+
+def unpack_messages(body):
+    """
+    Decode a body built by ``pack_messages``.
+
+    :return: The header, with its entries under ``messages`` holding their message fields again.
+    :raises ValueError: If the body is malformed.
+    """
+    try:
+        (length,) = struct.unpack_from(">I", body)
+        header = json.loads(body[4:4 + length])
+        offset = 4 + length
+        for entry in header["messages"]:
+            size = entry.pop("length")
+            data = body[offset:offset + size]
+            offset += size
+            dictionary = entry.pop(DICTIONARY)
+            entry["message"] = data.decode("utf-8") if dictionary is None else encode_payload(data, dictionary)
+    except (struct.error, KeyError, TypeError, UnicodeDecodeError) as e:
+        raise ValueError(f"Malformed message batch: {e}") from e
+    if offset != len(body):
+        raise ValueError("Malformed message batch: length mismatch")
+    return header
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_BYTES, k=8, segment=64):
+    """
+    Build a preset dictionary from sample messages.
+
+    A simplified COVER: every ``k``-byte substring is scored by the number of
+    samples it occurs in, and ``segment``-byte windows of the samples are
+    picked greedily by the summed score of the substrings they add. Windows
+    are placed in reverse order of value, so the most useful content sits at
+    the end of the dictionary, closest to the data.
+
+    :param samples: List of messages as bytes.
+    :return: The dictionary, empty if the samples have nothing in common.
+    """
+    frequency = Counter()
+    for sample in samples:
+        frequency.update({sample[i:i + k] for i in range(len(sample) - k + 1)})
+
+    def score(window):
+        return sum(frequency[gram] for gram in {window[i:i + k] for i in range(len(window) - k + 1)}
+                   if frequency[gram] > 1)
+
+    heap = []
+    for sample in samples:
+        for start in range(0, max(1, len(sample) - segment + 1), segment // 2):
+            window = sample[start:start + segment]
+            value = score(window)
+            if value:
+                heap.append((-value, window))
+    heapq.heapify(heap)
+
+    chosen, total = [], 0
+    while heap and total < size:
+        value, window = heapq.heappop(heap)
+        current = score(window)  # Lower once its substrings are covered by chosen windows
+        if not current:
+            continue
+        if heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, window))
+            continue
+        chosen.append(window)
+        total += len(window)
+        for i in range(len(window) - k + 1):
+            frequency[window[i:i + k]] = 0
+    return b"".join(reversed(chosen))[-size:]
+
+
+class TopicCompressor:
+    """
+    Per-topic compression at rest with shared preset dictionaries.
+
+    For topics listed in ``topics``, the broker owning a message deflates it
+    with the topic's dictionary before storing it; the compressed bytes are
+    stored, replicated, handed off and read between brokers unchanged, and
+    only inflated for the rows returned to a client.
+
+    A topic's dictionary is trained from its latest messages once
+    ``sample_size`` are stored, unless a dictionary already arrived from
+    another broker. Dictionaries are kept forever by ID (rows refer to the
+    one they were compressed with); a broker storing or reading a message
+    compressed with a dictionary it lacks fetches it from the sender.
+    """
+
+    def __init__(self, data_store, directory, topics=(), sample_size=500, dictionary_bytes=MAX_DICTIONARY_BYTES, level=6):
+        """
+        :param data_store: DataStore holding messages and dictionaries.
+        :param directory: PeerDirectory used to fetch dictionaries from peers.
+        :param topics: Topics to compress; ``"*"`` compresses every topic.
+        :param sample_size: Messages a topic needs before a dictionary is trained.
+        :param dictionary_bytes: Size of trained dictionaries (at most 32 KiB).
+        :param level: zlib compression level.
+        """
+        self.data_store = data_store
+        self.directory = directory
+        self.topics = {data_store.table_name(topic) for topic in topics}
+        self.sample_size = sample_size
+        self.dictionary_bytes = min(dictionary_bytes, MAX_DICTIONARY_BYTES)
+        self.level = level
+        self.dictionaries = {}  # Dictionary ID -> bytes
+        self.current = {}  # Table name -> ID of the dictionary new messages are compressed with
+        self.compressors = {}  # Dictionary ID -> compressor primed with it, copied per message
+        self.stats = {}  # Table name -> [messages, bytes in, bytes out]
+        self.training = {}  # Table name -> training task
+        self.next_training = {}  # Table name -> message count at which to try training again
+        for table_name, dictionary, data in data_store.load_dictionaries():
+            self.dictionaries[dictionary] = data
+            self.current[table_name] = dictionary
+
+    def enabled(self, topic):
+        return "*" in self.topics or self.data_store.table_name(topic) in self.topics
+
+    def compress(self, topic, message):
+        """
+        Compress a message for storage if its topic has a dictionary.
+
+        :return: The compressed message field, or ``message`` unchanged when
+                 compression is off, the topic has no dictionary yet, or it
+                 would not make the message smaller. Blob references stay
+                 readable, since replicas look for them.
+        """
+        if not isinstance(message, str) or message.startswith(REFERENCE_PREFIX) or not self.enabled(topic):
+            return message
+        table_name = self.data_store.table_name(topic)
+        dictionary = self.current.get(table_name)
+        if dictionary is None:
+            self._maybe_train(topic, table_name)
+            return message
+        raw = message.encode("utf-8")
+        compressor = self.compressors.get(dictionary)
+        if compressor is None:
+            compressor = self.compressors[dictionary] = zlib.compressobj(
+                self.level, zlib.DEFLATED, -15, zdict=self.dictionaries[dictionary]
+            )
+        compressor = compressor.copy()
+        compressed = compressor.compress(raw) + compressor.flush()
+        if len(compressed) >= len(raw):
+            compressed = None
+        stored = len(raw) if compressed is None else len(compressed)
+        stats = self.stats.setdefault(table_name, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += len(raw)
+        stats[2] += stored
+        COMPRESSION_BYTES.inc("in", amount=len(raw))
+        COMPRESSION_BYTES.inc("out", amount=stored)
+        return message if compressed is None else encode_payload(compressed, dictionary)
+
+    def inflate(self, message):
+        """Message text of a (possibly compressed) message field."""
+        if not isinstance(message, dict):
+            return message
+        value, dictionary = decode_payload(message)
+        data = self.dictionaries.get(dictionary)
+        if data is None:
+            logging.error(f"Dictionary {dictionary} missing; cannot decompress message.")
+            return None
+        decompressor = zlib.decompressobj(-15, zdict=data)
+        return (decompressor.decompress(value) + decompressor.flush()).decode("utf-8")
+
+    def inflate_records(self, records):
+        """Copies of records with their message text restored."""
+        return [{**record, "message": self.inflate(record["message"])} for record in records]
+
+    def missing(self, messages):
+        """IDs of dictionaries the given message fields use but this broker lacks."""
+        return {
+            int(message[DICTIONARY])
+            for message in messages
+            if isinstance(message, dict) and int(message[DICTIONARY]) not in self.dictionaries
+        }
+
+    async def fetch_dictionaries(self, topic, messages, peer):
+        """
+        Make sure every dictionary the given message fields use is known,
+        fetching missing ones from ``peer``.
+
+        :return: True if all are available.
+        """
+        missing = self.missing(messages)
+        if not missing:
+            return True
+        if peer is None:
+            return False
+        for dictionary in missing:
+            url = self.directory.url(peer, f"/dictionaries/{dictionary}")
+            try:
+                async with self.directory.session(peer).get(url) as response:
+                    if response.status != 200:
+                        logging.warning(f"Fetching dictionary {dictionary} from Broker {peer} failed (HTTP {response.status})")
+                        return False
+                    data = await response.read()
+            except Exception as e:
+                logging.warning(f"Fetching dictionary {dictionary} from Broker {peer} failed: {e}")
+                return False
+            if dictionary_id(data) != dictionary:
+                logging.warning(f"Broker {peer} sent a dictionary not matching ID {dictionary}")
+                return False
+            self.add_dictionary(topic, data)
+        return True
+
+    def add_dictionary(self, topic, data):
+        """Store a dictionary; the topic uses it for new messages if it had none."""
+        dictionary = dictionary_id(data)
+        table_name = self.data_store.table_name(topic)
+        if dictionary not in self.dictionaries:
+            self.data_store.store_dictionary(topic, dictionary, data)
+            self.dictionaries[dictionary] = data
+        self.current.setdefault(table_name, dictionary)
+        return dictionary
+
+    def _maybe_train(self, topic, table_name):
+        """Start training a topic's dictionary in the background once it has enough messages."""
+        if table_name in self.training:
+            return
+        count = self.data_store.message_count(topic)
+        if count < self.next_training.get(table_name, self.sample_size):
+            return
+        self.next_training[table_name] = count + self.sample_size
+        task = asyncio.ensure_future(self.train(topic))
+        self.training[table_name] = task
+        task.add_done_callback(lambda _: self.training.pop(table_name, None))
+
+    async def train(self, topic):
+        """
+        Train a dictionary from a topic's latest messages and compress new
+        messages with it.
+
+        :return: ID of the new dictionary, or None if the sample had nothing to share.
+        """
+        samples = [self.inflate(message) for message in self.data_store.sample_messages(topic, self.sample_size)]
+        samples = [sample.encode("utf-8") for sample in samples if isinstance(sample, str) and sample]
+        data = await asyncio.get_running_loop().run_in_executor(
+            None, train_dictionary, samples, self.dictionary_bytes
+        )
+        if not data:
+            logging.info(f"No dictionary trained for '{topic}': {len(samples)} sample messages share nothing.")
+            return None
+        dictionary = self.add_dictionary(topic, data)
+        self.current[self.data_store.table_name(topic)] = dictionary
+        logging.info(f"Trained a {len(data)}-byte dictionary ({dictionary}) for '{topic}' from {len(samples)} messages.")
+        return dictionary
+
+    async def handle_dictionary(self, request):
+        """Download a dictionary (``GET /dictionaries/{dictionary}``), for peers."""
+        try:
+            data = self.dictionaries.get(int(request.match_info["dictionary"]))
+        except ValueError:
+            data = None
+        if data is None:
+            return web.json_response({"status": "error", "message": "Dictionary not found."}, status=404)
+        return web.Response(body=data, content_type="application/octet-stream")
+
+    async def handle_stats(self, request):
+        """Compression status per topic (``GET /admin/compression``)."""
+        topics = {}
+        for table_name in sorted(set(self.current) | set(self.stats)):
+            messages, raw, stored = self.stats.get(table_name, (0, 0, 0))
+            dictionary = self.current.get(table_name)
+            topics[table_name] = {
+                "dictionary": dictionary,
+                "dictionary_bytes": len(self.dictionaries[dictionary]) if dictionary is not None else 0,
+                "messages": messages,
+                "bytes_in": raw,
+                "bytes_out": stored,
+                "ratio": round(raw / stored, 2) if stored else None,
+            }
+        return web.json_response({"compressed_topics": sorted(self.topics), "topics": topics})
+
+    async def handle_train(self, request):
+        """(Re)train a topic's dictionary now (``POST /admin/compression/{topic}/train``)."""
+        topic = request.match_info["topic"]
+        if not self.enabled(topic):
+            return web.json_response(
+                {"status": "error", "message": f"Compression is not enabled for '{topic}'."}, status=400
+            )
+        dictionary = await self.train(topic)
+        return web.json_response(
+            {
+                "status": "success",
+                "dictionary": dictionary,
+                "dictionary_bytes": len(self.dictionaries[dictionary]) if dictionary is not None else 0,
+            }
+        )
@@ -1,4 +1,17 @@
+import logging
 import sqlite3
+from metrics import REGISTRY
+from util import logger_config
+from compression import decode_payload, encode_payload
+
+# Compression dictionaries live next to the topic tables
+DICTIONARY_TABLE = "_dictionaries"
+
+COMMIT_SECONDS = REGISTRY.histogram(
+    "broker_sqlite_commit_seconds",
+    "Time spent in SQLite write transactions, including the commit.",
+    ("operation",),
+)
 
 
 class DataStore:
@@ -17,14 +30,33 @@ class DataStore:
             db_file, check_same_thread=False
         )  # Enable multi-threaded access
         self.conn.row_factory = sqlite3.Row
+        self.partition_counts = {}  # Table name -> {partition: stored message count}
+        self.partition_sequences = {}  # Table name -> {partition: highest stored sequence number}
+        self.ready_tables = set()  # Tables created and migrated by this connection
+        with self.conn:
+            self.conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {DICTIONARY_TABLE} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dictionary_id INTEGER UNIQUE NOT NULL,
+                    topic TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
 
     def create_topic_table(self, topic):
         """
         Create a table dynamically for the specified topic if it does not exist.
+        Each table is created and migrated once per connection, so storing a
+        message does not run schema statements.
 
         :param topic: The topic name for the new table.
         """
         table_name = self._sanitize_table_name(topic)
+        if table_name in self.ready_tables:
+            return
         with self.conn:
             self.conn.execute(
                 f"""
@@ -32,35 +64,151 @@ class DataStore:
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     message_id TEXT UNIQUE NOT NULL,
                     message TEXT NOT NULL,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    partition_id INTEGER,
+                    sequence INTEGER,
+                    dictionary INTEGER
                 )
                 """
             )
-        print(f"Table '{table_name}' created or already exists.")
+            self._add_missing_columns(table_name)
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {table_name}_sequence ON {table_name} (partition_id, sequence)"
+            )
+        self.ready_tables.add(table_name)
+        logging.debug("Table '%s' created or already exists.", table_name, extra=logger_config.RATE_LIMITED)
 
-    def store_message(self, topic, message, message_id):
+    def _add_missing_columns(self, table_name):
+        """
+        Bring tables created by older versions up to the current schema.
+
+        :param table_name: Sanitized table name to migrate.
+        """
+        columns = {
+            row["name"] for row in self.conn.execute(f"PRAGMA table_info({table_name})")
+        }
+        if "partition_id" not in columns:
+            self.conn.execute(f"ALTER TABLE {table_name} ADD COLUMN partition_id INTEGER")
+        if "sequence" not in columns:
+            self.conn.execute(f"ALTER TABLE {table_name} ADD COLUMN sequence INTEGER")
+        if "dictionary" not in columns:
+            self.conn.execute(f"ALTER TABLE {table_name} ADD COLUMN dictionary INTEGER")
+
+    def store_message(self, topic, message, message_id, partition=None, sequence=None):
         """
         Insert a message into the database under the specified topic (table).
 
         :param topic: Topic to which the message belongs (table name).
-        :param message: The content of the message.
+        :param message: The content of the message, or a compressed message
+                        field (see ``compression.encode_payload``).
         :param message_id: Unique identifier for the message.
+        :param partition: Partition of the topic the message belongs to.
+        :param sequence: Topic-wide sequence number assigned to the message.
         :return: True if the message was successfully stored, False otherwise.
         """
         table_name = self._sanitize_table_name(topic)
         self.create_topic_table(topic)  # Ensure the table exists
+        value, dictionary = decode_payload(message)
         try:
-            with self.conn:
+            with COMMIT_SECONDS.time("store_message"), self.conn:
                 self.conn.execute(
-                    f"INSERT INTO {table_name} (message_id, message) VALUES (?, ?)",
-                    (message_id, message),
+                    f"INSERT INTO {table_name} (message_id, message, partition_id, sequence, dictionary) VALUES (?, ?, ?, ?, ?)",
+                    (message_id, value, partition, sequence, dictionary),
                 )
-            print(f"Message stored successfully: {topic} -> {message}")
+            self._bump_count(table_name, partition, sequence)
+            logging.debug("Message stored: %s -> %s", topic, message_id, extra=logger_config.RATE_LIMITED)
             return True
         except sqlite3.IntegrityError:
-            print(f"Duplicate message detected: {message_id}")
+            logging.debug("Duplicate message detected: %s", message_id, extra=logger_config.RATE_LIMITED)
             return False
 
+    def store_messages(self, topic, entries):
+        """
+        Insert a batch of messages under one topic in a single transaction.
+
+        :param topic: Topic to which the messages belong (table name).
+        :param entries: List of dicts with message, message_id, partition and sequence.
+        :return: List of booleans, True where the message was stored and
+                 False where it was a duplicate.
+        """
+        table_name = self._sanitize_table_name(topic)
+        self.create_topic_table(topic)  # Ensure the table exists
+        stored = []
+        with COMMIT_SECONDS.time("store_messages"), self.conn:
+            for entry in entries:
+                value, dictionary = decode_payload(entry["message"])
+                cursor = self.conn.execute(
+                    f"INSERT OR IGNORE INTO {table_name} (message_id, message, partition_id, sequence, dictionary) VALUES (?, ?, ?, ?, ?)",
+                    (entry["message_id"], value, entry.get("partition"), entry.get("sequence"), dictionary),
+                )
+                stored.append(cursor.rowcount == 1)
+                if cursor.rowcount == 1:
+                    self._bump_count(table_name, entry.get("partition"), entry.get("sequence"))
+        logging.debug(
+            "Stored %d of %d messages for topic '%s'", sum(stored), len(entries), topic, extra=logger_config.RATE_LIMITED
+        )
+        return stored
+
+    def partition_version(self, topic, partition):
+        """
+        Return the version of a partition: the highest sequence number
+        stored in it. Numbers only grow, and replicas holding the same
+        messages report the same value, so it can be used as a validator
+        across brokers.
+
+        :param topic: Topic (table name) to inspect.
+        :param partition: Partition number.
+        :return: Highest sequence number, or None if the partition has no numbered messages.
+        """
+        return self.last_sequence(topic, partition)
+
+    def last_sequence(self, topic, partition):
+        """
+        Return the highest sequence number stored in a partition, or None if
+        it has no numbered messages. Kept in memory like the counts.
+        """
+        table_name = self._sanitize_table_name(topic)
+        self._load_counts(table_name)
+        return self.partition_sequences[table_name].get(partition)
+
+    def topic_counts(self):
+        """
+        Return the number of messages stored per topic (table name), from the
+        cached per-partition counts.
+        """
+        return {table_name: self.message_count(table_name) for table_name in self.list_topics()}
+
+    def message_count(self, topic):
+        """Return the number of messages stored for a topic, from the cached counts."""
+        return sum(self._load_counts(self._sanitize_table_name(topic)).values())
+
+    def _load_counts(self, table_name):
+        """Load per-partition message counts and highest sequence numbers for a table into the cache."""
+        counts = self.partition_counts.get(table_name)
+        if counts is None:
+            try:
+                cursor = self.conn.execute(
+                    f"SELECT partition_id, COUNT(*) AS n, MAX(sequence) AS last FROM {table_name} GROUP BY partition_id"
+                )
+                rows = cursor.fetchall()
+            except sqlite3.OperationalError:
+                rows = []
+            counts = {row["partition_id"]: row["n"] for row in rows}
+            self.partition_counts[table_name] = counts
+            self.partition_sequences[table_name] = {
+                row["partition_id"]: row["last"] for row in rows if row["last"] is not None
+            }
+        return counts
+
+    def _bump_count(self, table_name, partition, sequence=None):
+        """Account for a newly stored message in the cached counts, if loaded."""
+        counts = self.partition_counts.get(table_name)
+        if counts is not None:
+            counts[partition] = counts.get(partition, 0) + 1
+            sequences = self.partition_sequences[table_name]
+            if sequence is not None and (sequences.get(partition) is None or sequence > sequences[partition]):
+                sequences[partition] = sequence
+
     def get_messages(self, topic, batch_size=5, start_offset=0):
         """
         Retrieve messages for a specific topic (table) with pagination support.
@@ -75,20 +223,162 @@ class DataStore:
             with self.conn:
                 cursor = self.conn.execute(
                     f"""
-                    SELECT message
+                    SELECT message, dictionary
                     FROM {table_name}
                     ORDER BY timestamp ASC
                     LIMIT ? OFFSET ?
                     """,
                     (batch_size, start_offset),
                 )
-                messages = [row["message"] for row in cursor.fetchall()]
-                print(f"Fetched messages for topic '{topic}': {messages}")
+                messages = [encode_payload(row["message"], row["dictionary"]) for row in cursor.fetchall()]
+                logging.debug("Fetched %d messages for topic '%s'", len(messages), topic, extra=logger_config.RATE_LIMITED)
                 return messages
         except sqlite3.OperationalError:
-            print(f"Topic '{topic}' does not exist.")
+            logging.debug("Topic '%s' does not exist.", topic, extra=logger_config.RATE_LIMITED)
+            return []
+
+    def get_records(
+        self, topic, partition=None, batch_size=5, start_offset=0, after_sequence=None, sequences=None
+    ):
+        """
+        Retrieve full message rows for a topic in sequence order, optionally
+        limited to one partition.
+
+        :param topic: Topic (table name) to fetch messages for.
+        :param partition: Partition to read; all partitions when None.
+        :param batch_size: Number of rows to retrieve (None for all rows).
+        :param start_offset: Offset for pagination (default is 0).
+        :param after_sequence: Only return messages numbered after this cursor.
+        :param sequences: Only return messages with these sequence numbers.
+        :return: A list of dicts with message_id, message, timestamp, partition and sequence.
+                 Compressed messages are returned as stored (see ``compression.encode_payload``).
+        """
+        table_name = self._sanitize_table_name(topic)
+        conditions = []
+        params = ()
+        if partition is not None:
+            conditions.append("partition_id = ?")
+            params += (partition,)
+        if after_sequence is not None:
+            conditions.append("sequence > ?")
+            params += (after_sequence,)
+        if sequences is not None:
+            conditions.append(f"sequence IN ({', '.join('?' * len(sequences))})")
+            params += tuple(sequences)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        try:
+            with self.conn:
+                cursor = self.conn.execute(
+                    f"""
+                    SELECT message_id, message, timestamp, partition_id, sequence, dictionary
+                    FROM {table_name}
+                    {where}
+                    ORDER BY sequence ASC, timestamp ASC, id ASC
+                    LIMIT ? OFFSET ?
+                    """,
+                    params + (-1 if batch_size is None else batch_size, start_offset),
+                )
+                return [
+                    {
+                        "message_id": row["message_id"],
+                        "message": encode_payload(row["message"], row["dictionary"]),
+                        "timestamp": row["timestamp"],
+                        "partition": row["partition_id"],
+                        "sequence": row["sequence"],
+                    }
+                    for row in cursor.fetchall()
+                ]
+        except sqlite3.OperationalError:
+            logging.debug("Topic '%s' does not exist.", topic, extra=logger_config.RATE_LIMITED)
+            return []
+
+    def list_topics(self):
+        """
+        List the topics (tables) stored in this database.
+
+        :return: A list of table names.
+        """
+        cursor = self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND name != ?",
+            (DICTIONARY_TABLE,),
+        )
+        return [row["name"] for row in cursor.fetchall()]
+
+    def list_partitions(self, topic):
+        """
+        List the partitions of a topic that have messages stored locally.
+
+        :param topic: Topic (table name) to inspect.
+        :return: A list of partition numbers.
+        """
+        table_name = self._sanitize_table_name(topic)
+        try:
+            cursor = self.conn.execute(
+                f"SELECT DISTINCT partition_id FROM {table_name} WHERE partition_id IS NOT NULL"
+            )
+            return [row["partition_id"] for row in cursor.fetchall()]
+        except sqlite3.OperationalError:
+            return []
+
+    def delete_partition(self, topic, partition):
+        """
+        Delete a partition's messages, e.g. after it moved to other brokers.
+
+        :param topic: Topic (table name) the partition belongs to.
+        :param partition: Partition number.
+        :return: Number of messages deleted.
+        """
+        table_name = self._sanitize_table_name(topic)
+        try:
+            with COMMIT_SECONDS.time("delete_partition"), self.conn:
+                cursor = self.conn.execute(f"DELETE FROM {table_name} WHERE partition_id = ?", (partition,))
+        except sqlite3.OperationalError:
+            return 0
+        self.partition_counts.get(table_name, {}).pop(partition, None)
+        self.partition_sequences.get(table_name, {}).pop(partition, None)
+        logging.info("Deleted %d messages of partition %s of topic '%s'.", cursor.rowcount, partition, topic)
+        return cursor.rowcount
+
+    def sample_messages(self, topic, limit):
+        """
+        Return a topic's latest messages, as stored, for training a compression dictionary.
+
+        :param topic: Topic (table name) to sample.
+        :param limit: Number of messages to return.
+        """
+        table_name = self._sanitize_table_name(topic)
+        try:
+            cursor = self.conn.execute(
+                f"SELECT message, dictionary FROM {table_name} ORDER BY id DESC LIMIT ?", (limit,)
+            )
+            return [encode_payload(row["message"], row["dictionary"]) for row in cursor.fetchall()]
+        except sqlite3.OperationalError:
             return []
 
+    def store_dictionary(self, topic, dictionary_id, data):
+        """
+        Keep a compression dictionary for a topic.
+
+        :param dictionary_id: ID messages compressed with it refer to.
+        :param data: The dictionary.
+        """
+        with self.conn:
+            self.conn.execute(
+                f"INSERT OR IGNORE INTO {DICTIONARY_TABLE} (dictionary_id, topic, data) VALUES (?, ?, ?)",
+                (dictionary_id, self._sanitize_table_name(topic), data),
+            )
+
+    def load_dictionaries(self):
+        """
+        Return every stored compression dictionary, oldest first.
+
+        :return: A list of (table name, dictionary ID, data) tuples.
+        """
+        cursor = self.conn.execute(
+            f"SELECT topic, dictionary_id, data FROM {DICTIONARY_TABLE} ORDER BY id ASC"
+        )
+        return [(row["topic"], row["dictionary_id"], row["data"]) for row in cursor.fetchall()]
+
     def delete_topic(self, topic):
         """
         Drop the table for the specified topic.
@@ -98,7 +388,10 @@ class DataStore:
         table_name = self._sanitize_table_name(topic)
         with self.conn:
             self.conn.execute(f"DROP TABLE IF EXISTS {table_name}")
-        print(f"Table for topic '{topic}' has been deleted.")
+        self.ready_tables.discard(table_name)
+        self.partition_counts.pop(table_name, None)
+        self.partition_sequences.pop(table_name, None)
+        logging.info("Table for topic '%s' has been deleted.", topic)
 
     def close(self):
         """
@@ -113,6 +406,10 @@ class DataStore:
         """
         return topic.replace(" ", "_").replace("-", "_").lower()
 
+    def table_name(self, topic):
+        """Return the table a topic's messages are stored in."""
+        return self._sanitize_table_name(topic)
+
 
 # # Example usage:
 # if __name__ == "__main__":
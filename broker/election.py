@@ -1,113 +1,361 @@
 import asyncio
 import logging
+import time
 from util import logger_config
 from membership import Membership
+from peers import PEER_HEADER, PeerDirectory
+from sequencing import MAX_TERM
+from metrics import REGISTRY
 import aiohttp
+from aiohttp import web
 
 logger_config.setup_logger()
 
+# Furthest a leader announcement may move the term ahead while a lease is current
+MAX_TERM_STEP = 1000
+
+FAILOVER_SECONDS = REGISTRY.histogram(
+    "broker_election_duration_seconds",
+    "Time leadership was vacant, from the old leader's last renewal to a new leader.",
+    buckets=(0.5, 1.0, 2.0, 3.0, 4.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0),
+)
+
 
 class LeaderElection:
     """
-    Implements the Bully Algorithm for leader election in a distributed system.
+    Term-numbered, lease-based leader election.
+
+    The leader holds a lease that it renews every ``renew_interval`` by
+    announcing ``(leader, term)`` to all peers in parallel. Followers accept
+    an announcement only if its term is not older than theirs, so a deposed
+    leader's stale announcements are rejected, and the rejection tells it the
+    current term. Announcements must come from the announced leader itself,
+    proven by the peer secret and a current member; their term may be at
+    most ``MAX_TERM`` and, while a lease is current, at most
+    ``MAX_TERM_STEP`` ahead. A leader that cannot renew with a majority of members before
+    its lease runs out steps down.
+
+    When a follower's lease expires, the highest-ID member other than the
+    expired leader takes over with the next term (Bully-style choice). Other
+    brokers give that candidate one lease to announce itself before skipping
+    it, so failover takes roughly ``lease_duration + renew_interval`` after the
+    leader goes silent.
     """
 
-    def __init__(self, broker_id, peers, membership_service, election_timeout=10):
+    def __init__(
+        self,
+        broker_id,
+        peers,
+        membership_service,
+        liveness=None,
+        lease_duration=3.0,
+        renew_interval=1.0,
+        directory=None,
+    ):
         """
         :param broker_id: ID of the current broker.
         :param peers: List of peer broker IDs.
         :param membership_service: Instance of the Membership class to track brokers.
-        :param election_timeout: Timeout in seconds for waiting for higher ID brokers.
+        :param liveness: Optional Heartbeat tracker refreshed by acknowledged announcements.
+        :param lease_duration: Seconds a leader's lease lasts after a renewal.
+        :param renew_interval: Seconds between lease renewals (and lease checks on followers).
+        :param directory: PeerDirectory resolving peer addresses and pooling connections.
         """
         self.broker_id = int(broker_id)
         self.membership_service = membership_service  # Membership instance
         self.peers = [int(peer) for peer in peers if peer]  # Initial peer list
         self.leader = None
-        self.election_timeout = election_timeout
+        self.term = 0
+        self.lease_duration = lease_duration
+        self.renew_interval = renew_interval
+        self.lease_expires = 0.0  # Monotonic time the current lease runs out
+        self.last_renewal = None  # Monotonic time of the last accepted announcement or renewal
+        self.last_failover = None  # Seconds from the old leader's last renewal to the new leader
+        self.awaiting = None  # Candidate given one lease to announce itself
+        self.skipped = set()  # Candidates that failed to take over
+        self.liveness = liveness
+        self.directory = directory or PeerDirectory(broker_id)
+        self.timeout = aiohttp.ClientTimeout(total=renew_interval)
+        self._wake = None  # asyncio.Event, created on the running loop
 
     async def update_peers(self):
         """
-        Updates the list of peers using the Membership service.
+        Updates the list of peers from the Membership service's gossip view.
         Excludes the current broker's ID from the peer list.
         """
-        await self.membership_service.fetch_members()  # Update membership
         self.peers = [peer for peer in self.membership_service.members if peer != self.broker_id]
-        logging.info(f"Broker {self.broker_id}: Updated peer list: {self.peers}")
+        logging.debug(f"Broker {self.broker_id}: Updated peer list: {self.peers}")
 
     async def start_leader_election(self, *_):
         """
-        Starts the leader election process if no leader exists or the current leader is invalid.
+        Run the election loop until cancelled: renew the lease while leader,
+        and elect a new leader once the current lease expires.
+        """
+        self._wake = asyncio.Event()
+        await self.discover_leader()
+        while True:
+            await self.update_peers()
+            if self.leader == self.broker_id:
+                await self.renew_lease()
+            elif time.monotonic() >= self.lease_expires:
+                await self.elect_leader()
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.renew_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def discover_leader(self):
+        """
+        Learn the current leader at startup instead of waiting out a lease.
+
+        Waits (up to one lease) for the first member list, then asks every
+        known peer for its view and follows the newest term reported. If no
+        peer knows a leader, the election can start right away.
+        """
+        deadline = time.monotonic() + self.lease_duration
+        while not self.membership_service.seeded and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await self.update_peers()
+
+        views = await asyncio.gather(*(self.fetch_leader_view(peer) for peer in self.peers))
+        views = [
+            view
+            for view in views
+            if view and view.get("leader") is not None and self.valid_term(view.get("term"))
+        ]
+        if not views:
+            logging.info(f"Broker {self.broker_id}: no peer knows a leader; electing now.")
+            self.lease_expires = time.monotonic()
+            return
+        newest = max(views, key=lambda view: (view["term"], view["leader"]))
+        if newest["term"] >= self.term:
+            self.accept_leader(int(newest["leader"]), newest["term"])
+            self.lease_expires = time.monotonic() + newest.get("lease_remaining", self.lease_duration)
+
+    async def fetch_leader_view(self, peer):
+        """Ask a peer for its current leader and term; None if unreachable."""
+        url = self.directory.url(peer, "/leader")
+        try:
+            async with self.directory.session(peer).get(url, timeout=self.timeout) as response:
+                if response.status == 200:
+                    return await response.json()
+        except Exception as e:
+            logging.debug(f"Broker {self.broker_id}: Could not ask Broker {peer} for the leader: {e}")
+        return None
+
+    async def apply_membership_delta(self, joined, left):
+        """
+        Apply a membership change incrementally. If the leader left, its lease
+        is dropped so the election does not wait for it to run out; if
+        brokers joined while this broker leads, they are told right away.
         """
-        await self.update_peers()  # Ensure peers are up-to-date
-        if self.leader is None or self.leader not in self.peers:
-            logging.info("Starting leader election process...")
-            await self.elect_leader()
+        left = {int(peer) for peer in left}
+        joined = {int(peer) for peer in joined} - {self.broker_id}
+        self.peers = [peer for peer in self.peers if peer not in left]
+        self.peers += [peer for peer in joined if peer not in self.peers]
+        if self.leader in left:
+            logging.info(f"Leader {self.leader} left; starting election...")
+            self.lease_expires = 0.0
+            self._poke()
+        elif joined and self.leader == self.broker_id:
+            self._poke()
 
     async def elect_leader(self):
         """
-        Implements the Bully Election Algorithm to elect a leader.
-        The broker with the highest ID that is alive becomes the leader.
-        """
-        await self.update_peers()  # Refresh peers
-        higher_ids = [peer for peer in self.peers if peer > self.broker_id]
-        logging.debug(f"Broker {self.broker_id}: Peers with higher IDs: {higher_ids}")
-
-        if not higher_ids:
-            # No higher ID brokers; this broker becomes the leader.
-            self.leader = self.broker_id
-            logging.info(f"Broker {self.broker_id} elected as leader (no higher ID peers).")
-            await self.announce_leader()
-        else:
-            # Check if higher ID brokers are alive.
-            for peer in higher_ids:
-                if await self.is_alive(peer):
-                    logging.info(f"Broker {peer} is alive. Broker {self.broker_id} defers election.")
-                    return
-
-            # If no higher ID peers are alive, this broker becomes the leader.
-            self.leader = self.broker_id
-            logging.info(f"Broker {self.broker_id} elected as leader (no response from higher ID peers).")
-            await self.announce_leader()
-
-    async def is_alive(self, broker_id):
-        """
-        Checks if a broker is alive using the Membership service.
-        
-        :param broker_id: The ID of the broker to check.
-        :return: True if the broker is alive, False otherwise.
-        """
-        logging.debug(f"Broker {self.broker_id}: Checking if Broker {broker_id} is alive...")
-        await self.membership_service.fetch_members()  # Update the membership list
-        is_alive = broker_id in self.membership_service.members
-        logging.info(
-            f"Broker {self.broker_id}: Broker {broker_id} is {'alive' if is_alive else 'not alive'}."
-        )
-        return is_alive
+        Pick the highest-ID member that is not the expired leader and has not
+        already failed to take over. If that is this broker, it starts the
+        next term; otherwise the candidate gets one lease to announce itself.
+        """
+        if self.awaiting is not None:
+            logging.warning(f"Broker {self.awaiting} did not take over; skipping it.")
+            self.skipped.add(self.awaiting)
+            self.awaiting = None
+
+        expired = self.leader
+        candidates = [
+            broker_id
+            for broker_id in self.membership_service.members | {self.broker_id}
+            if broker_id != expired and broker_id not in self.skipped
+        ]
+        candidate = max(candidates)
+        self.leader = None
+        if candidate != self.broker_id:
+            logging.info(
+                f"Broker {self.broker_id}: lease of leader {expired} expired; waiting for Broker {candidate}."
+            )
+            self.awaiting = candidate
+            self.lease_expires = time.monotonic() + self.lease_duration
+            return
+
+        self.term += 1
+        self.leader = self.broker_id
+        self.skipped.clear()
+        self._record_failover(expired, self.broker_id)
+        logging.info(f"Broker {self.broker_id} elected as leader for term {self.term}.")
+        await self.renew_lease()
+
+    async def renew_lease(self):
+        """
+        Announce leadership to every peer in parallel. The lease is extended
+        from the moment the renewal started once a majority of members (this
+        broker included) acknowledged it; a leader whose lease runs out
+        without such a majority steps down.
+        """
+        started = time.monotonic()
+        acks = await self.announce_leader()
+        if self.leader != self.broker_id:
+            return  # Deposed by a newer term while renewing
+
+        if (acks + 1) * 2 > len(self.peers) + 1:
+            self.lease_expires = started + self.lease_duration
+            self.last_renewal = started
+        elif time.monotonic() >= self.lease_expires:
+            logging.warning(
+                f"Broker {self.broker_id}: lease for term {self.term} lost "
+                f"({acks + 1}/{len(self.peers) + 1} acks); stepping down."
+            )
+            self.leader = None
 
     async def announce_leader(self):
         """
-        Notifies all peers about the newly elected leader.
+        Notifies all peers about the current leader concurrently.
+
+        :return: Number of peers that acknowledged.
         """
-        logging.info(f"Broker {self.broker_id}: Announcing leader {self.leader} to peers.")
-        for peer in self.peers:
-            try:
-                await self.send_leader_announcement(peer)
-                logging.info(f"Broker {self.broker_id}: Successfully announced leader to Broker {peer}.")
-            except Exception as e:
-                logging.error(f"Broker {self.broker_id}: Failed to announce leader to Broker {peer}. Error: {e}")
+        results = await asyncio.gather(
+            *(self.send_leader_announcement(peer) for peer in self.peers)
+        )
+        return sum(1 for acked in results if acked)
 
     async def send_leader_announcement(self, peer):
         """
         Sends the leader announcement to a peer broker.
-        
+
         :param peer: The peer broker ID.
+        :return: True if the peer accepted this broker's leadership.
         """
-        peer_port = 3000 + int(peer) - 1  # Map broker ID to port
-        url = f"http://broker-{peer}:{peer_port}/leader_announcement"
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json={"leader_id": self.leader}) as response:
-                if response.status == 200:
-                    logging.debug(f"Broker {self.broker_id}: Announcement sent to Broker {peer}.")
-                else:
-                    raise Exception(f"Failed to send leader announcement to Broker {peer}.")
+        url = self.directory.url(peer, "/leader_announcement")
+        try:
+            async with self.directory.session(peer).post(
+                url, json={"leader_id": self.leader, "term": self.term}, timeout=self.timeout
+            ) as response:
+                body = await response.json()
+        except Exception as e:
+            logging.debug(f"Broker {self.broker_id}: Failed to announce leader to Broker {peer}: {e}")
+            return False
+
+        if self.liveness:
+            self.liveness.record_contact(peer)
+        if response.status == 200:
+            return True
+        if response.status == 409 and self.valid_term(body.get("term")) and (
+            body["term"] > self.term
+            or (body.get("term") == self.term and (body.get("leader") or 0) > self.broker_id)
+        ):
+            logging.info(
+                f"Broker {self.broker_id}: Broker {peer} knows newer term {body['term']}; stepping down."
+            )
+            self.accept_leader(body.get("leader"), body["term"])
+        return False
+
+    @staticmethod
+    def valid_term(term):
+        """Whether a term reported by a peer is a usable term number."""
+        return isinstance(term, int) and not isinstance(term, bool) and 0 <= term <= MAX_TERM
+
+    def accept_leader(self, leader_id, term):
+        """Follow a leader for a term, restarting its lease."""
+        now = time.monotonic()
+        if leader_id is not None and (leader_id != self.leader or term != self.term):
+            self._record_failover(self.leader, leader_id, now)
+            logging.info(f"Broker {self.broker_id} acknowledged leader {leader_id} for term {term}.")
+        self.term = term
+        self.leader = leader_id
+        self.awaiting = None
+        self.skipped.clear()
+        self.lease_expires = now + self.lease_duration
+        self.last_renewal = now
 
+    def _record_failover(self, previous, new, now=None):
+        """Log how long leadership was vacant since the previous leader's last renewal."""
+        if self.last_renewal is None or previous == new:
+            return
+        now = time.monotonic() if now is None else now
+        self.last_failover = now - self.last_renewal
+        FAILOVER_SECONDS.observe(self.last_failover)
+        logging.info(
+            f"Leader failover completed in {self.last_failover:.2f}s (term {self.term})."
+        )
+
+    def _poke(self):
+        """Wake the election loop before its next scheduled check."""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def handle_announcement(self, request):
+        """
+        Endpoint for receiving leader announcements and lease renewals.
+
+        Expected JSON payload:
+        {
+            "leader_id": int,
+            "term": int
+        }
+
+        Only proven peer brokers may announce, and only themselves (403).
+        Announcements from a broker that is not a current member, from an
+        older term, or from a lower-ID leader in the same term, are rejected
+        with 409 and the current term and leader. Terms above ``MAX_TERM``,
+        or more than ``MAX_TERM_STEP`` ahead while a lease is current, are
+        rejected with 400.
+        """
+        sender = request.headers.get(PEER_HEADER)
+        if sender is None:
+            return web.json_response(
+                {"status": "error", "message": "Only brokers may announce leadership."}, status=403
+            )
+        try:
+            data = await request.json()
+            leader_id = data.get("leader_id")
+            term = data.get("term", 0)
+            if not leader_id or not self.valid_term(term) or (
+                self.lease_expires > time.monotonic() and term > self.term + MAX_TERM_STEP
+            ):
+                logging.warning(f"Invalid leader announcement received from Broker {sender}: {data}")
+                return web.json_response(
+                    {"status": "error", "message": "Invalid leader announcement."}, status=400
+                )
+            if int(leader_id) != int(sender):
+                return web.json_response(
+                    {"status": "error", "message": "Brokers may only announce themselves."}, status=403
+                )
+            if int(leader_id) not in self.membership_service.members:
+                return web.json_response(
+                    {"status": "rejected", "term": self.term, "leader": self.leader},
+                    status=409,
+                )
+
+            if term < self.term or (
+                term == self.term and self.leader is not None and self.leader > leader_id
+            ):
+                return web.json_response(
+                    {"status": "rejected", "term": self.term, "leader": self.leader},
+                    status=409,
+                )
+            self.accept_leader(int(leader_id), term)
+            return web.json_response({"status": "success", "term": term})
+        except Exception as e:
+            logging.exception(f"Error in leader announcement route: {e}")
+            return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+    async def handle_status(self, request):
+        """Endpoint reporting the current leader, term and lease."""
+        return web.json_response(
+            {
+                "leader": self.leader,
+                "term": self.term,
+                "lease_remaining": round(max(0.0, self.lease_expires - time.monotonic()), 3),
+                "last_failover": self.last_failover,
+            }
+        )
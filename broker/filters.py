@@ -0,0 +1,498 @@
+# File: filters.py
+
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import math
+import re
+import time
+from collections import Counter
+from aiohttp import web
+from util import logger_config
+from datatable import DataStore
+from peers import PEER_HEADER
+
+logger_config.setup_logger()
+
+# Filter syntax, one condition per (dotted) field path, all of which must hold:
+#   {"section": "world",                      equality
+#    "region": {"in": ["eu", "us"]},          set membership
+#    "priority": {"gte": 3, "lt": 8},         range (numbers or strings)
+#    "headline": {"match": ["storm", "flood"]},  any of these words
+#    "meta.source": {"eq": "reuters"}}
+OPERATORS = ("eq", "in", "gt", "gte", "lt", "lte", "match")
+_WORD = re.compile(r"\w+")
+
+
+class FilterError(ValueError):
+    """A filter specification is malformed."""
+
+
+def _kind(value):
+    """Comparison class of a scalar: values of different kinds never compare equal."""
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if value is None:
+        return "null"
+    return None
+
+
+def _words(text):
+    return {word.lower() for word in _WORD.findall(text)}
+
+
+def _values(document, path):
+    """Scalars at a dotted path of a document; the elements if it holds a list."""
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return []
+        value = value[part]
+    if isinstance(value, list):
+        return [item for item in value if _kind(item) is not None]
+    return [value] if _kind(value) is not None else []
+
+
+def as_document(message):
+    """
+    Parse a message for matching. JSON objects are matched by their fields;
+    anything else is matched as ``{"message": <the message>}``.
+    """
+    try:
+        document = json.loads(message)
+    except (TypeError, ValueError):
+        document = message
+    return document if isinstance(document, dict) else {"message": document}
+
+
+class Filter:
+    """A compiled filter: its ID and a flat list of (path, operator, operand) predicates."""
+
+    __slots__ = ("id", "topic", "spec", "predicates")
+
+    def __init__(self, topic, spec, max_predicates=64):
+        """
+        :param topic: Topic the filter applies to.
+        :param spec: Filter specification (see the syntax at the top of this module).
+        :raises FilterError: If the specification is malformed.
+        """
+        if not isinstance(topic, str) or not topic:
+            raise FilterError("'topic' must be a non-empty string.")
+        if not isinstance(spec, dict):
+            raise FilterError("A filter must be a JSON object of field conditions.")
+        self.topic = topic
+        self.spec = spec
+        self.predicates = []
+        for path, condition in spec.items():
+            if not path or not isinstance(path, str):
+                raise FilterError("Field paths must be non-empty strings.")
+            if not isinstance(condition, dict):
+                condition = {"eq": condition}
+            if not condition:
+                raise FilterError(f"Empty condition for '{path}'.")
+            for operator, operand in condition.items():
+                self.predicates.append((path, operator, self._operand(path, operator, operand)))
+        if len(self.predicates) > max_predicates:
+            raise FilterError(f"A filter may have at most {max_predicates} conditions.")
+        canonical = json.dumps({"topic": topic, "filter": spec}, sort_keys=True, separators=(",", ":"))
+        self.id = hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def _operand(path, operator, operand):
+        """Validate an operand and bring it into the form the index uses."""
+        if operator not in OPERATORS:
+            raise FilterError(f"Unknown operator '{operator}' for '{path}' (use one of {', '.join(OPERATORS)}).")
+        if operator == "eq":
+            if _kind(operand) is None:
+                raise FilterError(f"'eq' on '{path}' needs a scalar value.")
+            return operand
+        if operator == "in":
+            if not isinstance(operand, list) or not operand or any(_kind(item) is None for item in operand):
+                raise FilterError(f"'in' on '{path}' needs a non-empty list of scalars.")
+            return operand
+        if operator == "match":
+            words = set()
+            for text in operand if isinstance(operand, list) else [operand]:
+                if not isinstance(text, str):
+                    raise FilterError(f"'match' on '{path}' needs a word or a list of words.")
+                words |= _words(text)
+            if not words:
+                raise FilterError(f"'match' on '{path}' needs at least one word.")
+            return sorted(words)
+        if _kind(operand) not in ("number", "string"):
+            raise FilterError(f"'{operator}' on '{path}' needs a number or a string.")
+        return operand
+
+    def matches(self, document):
+        """Evaluate the filter on one parsed message directly, without an index."""
+        for path, operator, operand in self.predicates:
+            if not any(self._holds(operator, operand, value) for value in _values(document, path)):
+                return False
+        return True
+
+    @staticmethod
+    def _holds(operator, operand, value):
+        if operator == "match":
+            return isinstance(value, str) and not _words(value).isdisjoint(operand)
+        if operator in ("eq", "in"):
+            candidates = operand if operator == "in" else [operand]
+            return any(_kind(value) == _kind(c) and value == c for c in candidates)
+        if _kind(value) != _kind(operand):
+            return False
+        if operator == "gt":
+            return value > operand
+        if operator == "gte":
+            return value >= operand
+        if operator == "lt":
+            return value < operand
+        return value <= operand
+
+
+class _FieldIndex:
+    """Predicates on one field path, indexed by operator."""
+
+    def __init__(self):
+        self.equal = {}  # (kind, value) -> predicate IDs (eq, and each member of an in)
+        self.keywords = {}  # Word -> predicate IDs
+        self.bounds = {}  # (operator, kind) -> sorted list of (bound, predicate ID)
+
+    def add(self, predicate, operator, operand):
+        if operator in ("eq", "in"):
+            for value in operand if operator == "in" else [operand]:
+                self.equal.setdefault((_kind(value), value), set()).add(predicate)
+        elif operator == "match":
+            for word in operand:
+                self.keywords.setdefault(word, set()).add(predicate)
+        else:
+            bisect.insort(self.bounds.setdefault((operator, _kind(operand)), []), (operand, predicate))
+
+    def remove(self, predicate, operator, operand):
+        if operator in ("eq", "in"):
+            for value in operand if operator == "in" else [operand]:
+                predicates = self.equal.get((_kind(value), value), set())
+                predicates.discard(predicate)
+                if not predicates:
+                    self.equal.pop((_kind(value), value), None)
+        elif operator == "match":
+            for word in operand:
+                predicates = self.keywords.get(word, set())
+                predicates.discard(predicate)
+                if not predicates:
+                    self.keywords.pop(word, None)
+        else:
+            self.bounds[(operator, _kind(operand))].remove((operand, predicate))
+
+    def empty(self):
+        return not (self.equal or self.keywords or any(self.bounds.values()))
+
+    def satisfied(self, value, into):
+        """Add the predicates ``value`` satisfies to the set ``into``."""
+        kind = _kind(value)
+        into.update(self.equal.get((kind, value), ()))
+        if kind == "string" and self.keywords:
+            for word in _words(value):
+                into.update(self.keywords.get(word, ()))
+        if kind not in ("number", "string"):
+            return
+        # Bounds are sorted, so the satisfied ones are a prefix or a suffix
+        below, at_or_below = (value,), (value, math.inf)
+        for operator, start, end in (
+            ("gt", None, below),  # bound < value
+            ("gte", None, at_or_below),  # bound <= value
+            ("lt", at_or_below, None),  # bound > value
+            ("lte", below, None),  # bound >= value
+        ):
+            bounds = self.bounds.get((operator, kind))
+            if not bounds:
+                continue
+            lo = 0 if start is None else bisect.bisect_left(bounds, start)
+            hi = len(bounds) if end is None else bisect.bisect_left(bounds, end)
+            into.update(predicate for _, predicate in bounds[lo:hi])
+
+
+class FilterIndex:
+    """
+    Matches a message against many filters at once (the counting algorithm).
+
+    Every predicate of every filter is indexed under its field path: equality
+    and ``in`` values in a hash table, keywords in an inverted index, range
+    bounds in sorted lists. A message looks up each indexed field it has and
+    collects the predicates it satisfies; a filter matches when all of its
+    predicates were satisfied. The cost follows the fields of the message and
+    the predicates it satisfies, not the number of filters.
+    """
+
+    def __init__(self):
+        self.fields = {}  # Field path -> _FieldIndex
+        self.owners = []  # Predicate ID -> filter ID (None once removed)
+        self.sizes = {}  # Filter ID -> number of predicates
+        self.predicates = {}  # Filter ID -> (predicate ID, path, operator, operand) as indexed
+        self.match_all = set()  # Filters without conditions
+        self.free = []  # Predicate IDs to reuse
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, compiled):
+        """Index a compiled Filter."""
+        if compiled.id in self.sizes:
+            return
+        self.sizes[compiled.id] = len(compiled.predicates)
+        self.predicates[compiled.id] = []
+        if not compiled.predicates:
+            self.match_all.add(compiled.id)
+        for path, operator, operand in compiled.predicates:
+            if self.free:
+                predicate = self.free.pop()
+                self.owners[predicate] = compiled.id
+            else:
+                predicate = len(self.owners)
+                self.owners.append(compiled.id)
+            self.predicates[compiled.id].append((predicate, path, operator, operand))
+            self.fields.setdefault(path, _FieldIndex()).add(predicate, operator, operand)
+
+    def remove(self, filter_id):
+        """Drop a filter from the index."""
+        if filter_id not in self.sizes:
+            return
+        for predicate, path, operator, operand in self.predicates.pop(filter_id):
+            field = self.fields[path]
+            field.remove(predicate, operator, operand)
+            if field.empty():
+                del self.fields[path]
+            self.owners[predicate] = None
+            self.free.append(predicate)
+        del self.sizes[filter_id]
+        self.match_all.discard(filter_id)
+
+    def match(self, document):
+        """IDs of the filters a parsed message matches."""
+        satisfied = set()
+        for path, field in self.fields.items():
+            for value in _values(document, path):
+                field.satisfied(value, satisfied)
+        counts = Counter(self.owners[predicate] for predicate in satisfied)
+        return {f for f, count in counts.items() if count == self.sizes[f]} | self.match_all
+
+
+class SubscriptionFilters:
+    """
+    Content-based subscriptions: filters registered by subscribers, matched
+    against every message stored on this broker.
+
+    A filter is registered once (``POST /filters``), compiled, indexed under
+    its topic and shared with every peer, so whichever brokers own a
+    partition match its messages as they are stored. Matches are kept per
+    filter and partition as sorted sequence numbers (the latest
+    ``max_matches``), which ``/data/{topic}?filter=<id>`` reads instead of
+    the whole partition. A filter sees messages stored after it was
+    registered, and is dropped after ``ttl`` seconds without reads.
+    """
+
+    def __init__(self, directory, peers=None, ttl=3600, max_matches=10000, max_filters=100000):
+        """
+        :param directory: PeerDirectory used to share filters with peers.
+        :param peers: Callable returning the peer IDs to share filters with.
+        :param ttl: Seconds a filter is kept without being read.
+        :param max_matches: Matches kept per filter and partition.
+        :param max_filters: Filters kept on this broker.
+        """
+        self.directory = directory
+        self.peers = peers or (lambda: [])
+        self.ttl = ttl
+        self.max_matches = max_matches
+        self.max_filters = max_filters
+        self.filters = {}  # Filter ID -> Filter
+        self.indexes = {}  # Table name -> FilterIndex
+        self.matches = {}  # Filter ID -> {partition: sorted sequence numbers}
+        self.match_counts = {}  # Filter ID -> {partition: matches recorded so far}
+        self.last_used = {}  # Filter ID -> monotonic time of the last read
+
+    @staticmethod
+    def _key(topic):
+        # Spellings of a topic that share a table share its filters
+        return DataStore._sanitize_table_name(topic)
+
+    def register(self, topic, spec):
+        """
+        Compile and index a filter, unless the same one is registered already.
+
+        :return: The Filter.
+        :raises FilterError: If the specification is malformed or too many filters are registered.
+        """
+        return self.add(Filter(topic, spec))
+
+    def add(self, compiled):
+        """
+        Index a compiled Filter, unless one with its ID is registered already.
+
+        :return: The registered Filter with that ID.
+        :raises FilterError: If too many filters are registered.
+        """
+        if compiled.id not in self.filters:
+            if len(self.filters) >= self.max_filters:
+                raise FilterError(f"Too many filters registered (at most {self.max_filters}).")
+            self.filters[compiled.id] = compiled
+            self.indexes.setdefault(self._key(compiled.topic), FilterIndex()).add(compiled)
+            self.matches[compiled.id] = {}
+            self.match_counts[compiled.id] = {}
+            logging.debug("Filter %s registered on '%s'", compiled.id, compiled.topic, extra=logger_config.RATE_LIMITED)
+        self.last_used[compiled.id] = time.monotonic()
+        return self.filters[compiled.id]
+
+    def unregister(self, filter_id):
+        """Drop a filter and its matches; False if it was not registered."""
+        compiled = self.filters.pop(filter_id, None)
+        if compiled is None:
+            return False
+        key = self._key(compiled.topic)
+        index = self.indexes[key]
+        index.remove(filter_id)
+        if not len(index):
+            del self.indexes[key]
+        for table in (self.matches, self.match_counts, self.last_used):
+            table.pop(filter_id, None)
+        return True
+
+    def active(self, topic):
+        """Whether any filter is registered on a topic."""
+        return self._key(topic) in self.indexes
+
+    def on_stored(self, topic, partition, sequence, message):
+        """Record a newly stored message against the topic's filters."""
+        index = self.indexes.get(self._key(topic))
+        if index is None or sequence is None or message is None:
+            return
+        for filter_id in index.match(as_document(message)):
+            sequences = self.matches[filter_id].setdefault(partition, [])
+            bisect.insort(sequences, sequence)
+            if len(sequences) > self.max_matches:
+                del sequences[0]
+            counts = self.match_counts[filter_id]
+            counts[partition] = counts.get(partition, 0) + 1
+
+    def get(self, filter_id, topic):
+        """The Filter with this ID registered on ``topic``, or None; counts as a read."""
+        compiled = self.filters.get(filter_id)
+        if compiled is None or self._key(compiled.topic) != self._key(topic):
+            return None
+        self.last_used[filter_id] = time.monotonic()
+        return compiled
+
+    def sequences(self, filter_id, partition, after=None, limit=None):
+        """Sequence numbers of a partition's matches, after a cursor."""
+        sequences = self.matches.get(filter_id, {}).get(partition, [])
+        start = 0 if after is None else bisect.bisect_right(sequences, after)
+        return sequences[start:] if limit is None else sequences[start:start + limit]
+
+    def version(self, filter_id, partition):
+        """Highest sequence number matched in a partition (None before the first), a validator for filtered reads."""
+        sequences = self.matches.get(filter_id, {}).get(partition)
+        return sequences[-1] if sequences else None
+
+    async def expire_idle(self):
+        """Drop filters that were not read for ``ttl`` seconds, checking periodically."""
+        while True:
+            await asyncio.sleep(max(1.0, self.ttl / 10))
+            cutoff = time.monotonic() - self.ttl
+            for filter_id in [f for f, used in self.last_used.items() if used < cutoff]:
+                self.unregister(filter_id)
+                logging.info(f"Filter {filter_id} expired after {self.ttl}s without reads.")
+
+    async def share(self, compiled, peers=None):
+        """
+        Register a filter on peers.
+
+        :param peers: Peer IDs; all peers when None.
+        :return: Number of peers that accepted it.
+        """
+        peers = self.peers() if peers is None else peers
+        return sum(await asyncio.gather(*(self._put(peer, compiled) for peer in peers)))
+
+    async def share_all(self, peer):
+        """
+        Register every filter on a peer, e.g. one that just joined.
+
+        :return: Number of filters it accepted.
+        """
+        return sum(await asyncio.gather(*(self._put(peer, compiled) for compiled in list(self.filters.values()))))
+
+    def _put(self, peer, compiled):
+        return self._send(peer, "PUT", compiled.id, {"topic": compiled.topic, "filter": compiled.spec})
+
+    async def _send(self, peer, method, filter_id, body=None):
+        try:
+            async with self.directory.session(peer).request(
+                method, self.directory.url(peer, f"/filters/{filter_id}"), json=body
+            ) as response:
+                # Deleting a filter the peer already dropped is fine
+                return response.status == 200 or (method == "DELETE" and response.status == 404)
+        except Exception as e:
+            logging.warning(f"Sharing filter {filter_id} with Broker {peer} failed: {e}")
+            return False
+
+    async def handle_register(self, request):
+        """
+        Register a filter (``POST /filters`` with ``{"topic": ..., "filter": {...}}``).
+
+        :return: The filter ID to pass to ``/data/{topic}?filter=``.
+        """
+        try:
+            data = await request.json()
+            compiled = self.register(data.get("topic"), data.get("filter"))
+        except (ValueError, AttributeError) as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+        shared = await self.share(compiled)
+        return web.json_response(
+            {"status": "success", "filter_id": compiled.id, "topic": compiled.topic, "shared_with": shared}
+        )
+
+    async def handle_put(self, request):
+        """Register a filter shared by a peer (``PUT /filters/{filter_id}``)."""
+        try:
+            data = await request.json()
+            compiled = Filter(data.get("topic"), data.get("filter"))
+        except (ValueError, AttributeError) as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+        # Compare before registering: the filter may already be live under its ID
+        if compiled.id != request.match_info["filter_id"]:
+            return web.json_response({"status": "error", "message": "Filter ID does not match the filter."}, status=400)
+        try:
+            compiled = self.add(compiled)
+        except FilterError as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+        return web.json_response({"status": "success", "filter_id": compiled.id})
+
+    async def handle_delete(self, request):
+        """Unregister a filter (``DELETE /filters/{filter_id}``), on every broker if a client asks."""
+        filter_id = request.match_info["filter_id"]
+        found = self.unregister(filter_id)
+        if PEER_HEADER not in request.headers:
+            await asyncio.gather(*(self._send(peer, "DELETE", filter_id) for peer in self.peers()))
+        if not found:
+            return web.json_response({"status": "error", "message": "Unknown filter."}, status=404)
+        return web.json_response({"status": "success", "filter_id": filter_id})
+
+    async def handle_list(self, request):
+        """List registered filters with their match counts (``GET /filters``)."""
+        now = time.monotonic()
+        return web.json_response(
+            {
+                "filters": [
+                    {
+                        "filter_id": filter_id,
+                        "topic": compiled.topic,
+                        "filter": compiled.spec,
+                        "matched": sum(self.match_counts[filter_id].values()),
+                        "idle_s": round(now - self.last_used[filter_id], 1),
+                    }
+                    for filter_id, compiled in self.filters.items()
+                ]
+            }
+        )
@@ -1,19 +1,115 @@
 # File: heartbeat.py
 
 import asyncio
+import math
+import time
+from collections import deque
 from util import logger_config
 import logging
-from aiohttp import ClientSession, ClientTimeout
+from aiohttp import ClientTimeout, web
+from peers import PEER_HEADER, PeerDirectory
+from metrics import REGISTRY
 
 logger_config.setup_logger()
 
+PROBE_SECONDS = REGISTRY.histogram(
+    "broker_heartbeat_probe_seconds",
+    "Duration of explicit heartbeat probes, by peer broker ID.",
+    ("peer",),
+)
+PEER_REQUESTS = REGISTRY.counter(
+    "broker_peer_requests_total",
+    "Requests received from other brokers, by route.",
+    ("route",),
+)
+
+
+class PhiAccrualFailureDetector:
+    """
+    Phi accrual failure detector (Hayashibara et al.).
+
+    Instead of a fixed timeout, it keeps the history of heartbeat inter-arrival
+    times and reports a suspicion level phi: the -log10 probability that a
+    heartbeat is still on its way given how long it has been silent. phi = 1
+    means roughly a 10% chance of a false positive, phi = 8 about 1e-8.
+    """
+
+    def __init__(self, first_interval, min_std_deviation=0.5, acceptable_pause=0.0, max_samples=100):
+        """
+        :param first_interval: Expected interval in seconds used to bootstrap the history.
+        :param min_std_deviation: Lower bound on the standard deviation, in seconds.
+        :param acceptable_pause: Extra seconds of silence tolerated (e.g. GC pauses).
+        :param max_samples: Number of inter-arrival times kept.
+        """
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self.intervals = deque(maxlen=max_samples)
+        # Bootstrap with a plausible distribution around the expected interval
+        self.intervals.extend([first_interval - first_interval / 4, first_interval + first_interval / 4])
+        self.last_heartbeat = time.monotonic()
+
+    def heartbeat(self, now=None):
+        """Record the arrival of a heartbeat."""
+        now = time.monotonic() if now is None else now
+        self.intervals.append(now - self.last_heartbeat)
+        self.last_heartbeat = now
+
+    def touch(self, now=None):
+        """
+        Mark the peer as seen without recording an inter-arrival sample.
+
+        Piggybacked contacts can arrive many times per second; sampling them
+        would shrink the expected interval and make the first quiet period
+        after a burst look like a failure.
+        """
+        now = time.monotonic() if now is None else now
+        self.last_heartbeat = max(self.last_heartbeat, now)
+
+    def phi(self, now=None):
+        """Return the current suspicion level."""
+        now = time.monotonic() if now is None else now
+        elapsed = now - self.last_heartbeat
+        mean = sum(self.intervals) / len(self.intervals) + self.acceptable_pause
+        variance = sum((i - mean) ** 2 for i in self.intervals) / len(self.intervals)
+        std = max(math.sqrt(variance), self.min_std_deviation)
+
+        # Logistic approximation of the normal CDF tail
+        y = (elapsed - mean) / std
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if elapsed > mean:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+
 class Heartbeat:
-    def __init__(self, broker_id, failure_timeout=2, heartbeat_interval=5, on_peer_failure=None):
+    """
+    Liveness tracker for peer brokers.
+
+    Any successful exchange with a peer (replication, election, gossip,
+    partition reads, or a request the peer sent us) refreshes its last-seen
+    time via ``record_contact``. Explicit ``GET /heartbeat`` probes only go to
+    peers that have been silent for longer than ``heartbeat_interval``, so
+    under steady traffic probing stops almost entirely.
+    """
+
+    def __init__(
+        self,
+        broker_id,
+        failure_timeout=2,
+        heartbeat_interval=5,
+        on_peer_failure=None,
+        phi_threshold=8.0,
+        min_std_deviation=0.5,
+        directory=None,
+    ):
         """
         :param broker_id: ID of the current broker
-        :param failure_timeout: Timeout in seconds to consider a peer failed
+        :param failure_timeout: Timeout in seconds for a single heartbeat probe
         :param heartbeat_interval: Interval in seconds to send heartbeats
         :param on_peer_failure: Callback function to handle peer failure (e.g., updating membership)
+        :param phi_threshold: Suspicion level at which a peer is considered failed
+        :param min_std_deviation: Lower bound in seconds on the inter-arrival deviation
+        :param directory: PeerDirectory resolving peer addresses and pooling connections
         """
         self.broker_id = int(broker_id)
         self.peers = []  # Initialize with an empty list; dynamic updates will populate it
@@ -21,6 +117,13 @@ class Heartbeat:
         self.failure_timeout = failure_timeout
         self.heartbeat_interval = heartbeat_interval
         self.on_peer_failure = on_peer_failure  # Callback for handling peer failures
+        self.phi_threshold = phi_threshold
+        self.min_std_deviation = min_std_deviation
+        self.detectors = {}  # Peer ID -> PhiAccrualFailureDetector
+        self.last_contact = {}  # Peer ID -> monotonic time of the last piggybacked contact
+        self.directory = directory or PeerDirectory(broker_id)
+        self.probes_sent = 0
+        self.probes_skipped = 0  # Probes avoided thanks to piggybacked contacts
 
     async def start_heartbeat(self, *_):
         """Start heartbeat monitoring as a background task."""
@@ -30,49 +133,134 @@ class Heartbeat:
             await self.log_peer_status()  # Log online and failed peers
             await asyncio.sleep(self.heartbeat_interval)
 
+    def record_contact(self, peer, now=None):
+        """
+        Refresh a peer's last-seen time after a successful exchange with it.
+
+        :param peer: ID of the peer broker.
+        """
+        try:
+            peer = int(peer)
+        except (TypeError, ValueError):
+            return
+        detector = self.detectors.get(peer)
+        if detector is None:
+            return
+        now = time.monotonic() if now is None else now
+        detector.touch(now)
+        self.last_contact[peer] = now
+        if peer in self.failed_peers:
+            logging.info(f"Peer {peer} is back online.")
+            self.failed_peers.discard(peer)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """aiohttp middleware counting any request from a peer as a contact (and in the metrics)."""
+        sender = request.headers.get(PEER_HEADER)
+        if sender is not None:
+            self.record_contact(sender)
+            resource = request.match_info.route.resource
+            PEER_REQUESTS.inc(resource.canonical if resource is not None else "unmatched")
+        return await handler(request)
+
+    def silent_peers(self, now=None):
+        """Return the peers without any contact in the last ``heartbeat_interval``."""
+        now = time.monotonic() if now is None else now
+        return [
+            peer
+            for peer in self.peers
+            if now - self.last_contact.get(peer, float("-inf")) >= self.heartbeat_interval
+        ]
+
     async def check_peers(self):
-        """Check if peers are alive by pinging each one."""
-        for peer in self.peers:
-            is_alive = await self.is_peer_alive(peer)
-            if not is_alive:
-                if peer not in self.failed_peers:
-                    logging.warning(f"Peer {peer} has failed.")
-                    self.failed_peers.add(peer)
-                    # Invoke the callback for peer failure
-                    if self.on_peer_failure:
-                        logging.debug(f"Invoking callback for failed peer {peer}")
-                        await self.on_peer_failure(peer)  # Handle peer failure (e.g., update registry)
-            else:
+        """Probe silent peers concurrently and evaluate their suspicion level."""
+        peers = self.silent_peers()
+        self.probes_sent += len(peers)
+        self.probes_skipped += len(self.peers) - len(peers)
+        results = await asyncio.gather(*(self.is_peer_alive(peer) for peer in peers))
+        now = time.monotonic()
+        for peer, is_alive in zip(peers, results):
+            detector = self.detectors.get(peer)
+            if detector is None:
+                continue  # Peer was removed while the probe was in flight
+            if is_alive:
+                detector.heartbeat(now)
                 if peer in self.failed_peers:
                     logging.info(f"Peer {peer} is back online.")
                     self.failed_peers.discard(peer)
+                continue
+
+            phi = detector.phi(now)
+            logging.debug("Peer %s missed a heartbeat (phi=%.2f).", peer, phi)
+            if phi >= self.phi_threshold and peer not in self.failed_peers:
+                logging.warning(f"Peer {peer} has failed (phi={phi:.2f}).")
+                self.failed_peers.add(peer)
+                # Invoke the callback for peer failure
+                if self.on_peer_failure:
+                    logging.debug(f"Invoking callback for failed peer {peer}")
+                    await self.on_peer_failure(peer)  # Handle peer failure (e.g., update registry)
+
+    def phi(self, peer):
+        """Return the current suspicion level of a peer (0 if unknown)."""
+        detector = self.detectors.get(peer)
+        return detector.phi() if detector else 0.0
 
     async def is_peer_alive(self, broker_id):
         """Check if a peer is alive by sending an HTTP request."""
-        peer_port = 3000 + int(broker_id) - 1  # Map broker ID to port
-        url = f"http://broker-{broker_id}:{peer_port}/heartbeat"  # Updated endpoint
-        timeout = ClientTimeout(total=self.failure_timeout)
+        url = self.directory.url(broker_id, "/heartbeat")
 
         try:
-            async with ClientSession(timeout=timeout) as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        logging.info(f"Peer {broker_id} is alive.")
-                        return True
-                    else:
-                        logging.warning(f"Peer {broker_id} returned HTTP {response.status}.")
-                        return False
+            with PROBE_SECONDS.time(str(broker_id)):
+                async with self.directory.session(broker_id).get(
+                    url, timeout=ClientTimeout(total=self.failure_timeout)
+                ) as response:
+                    status = response.status
+            if status == 200:
+                logging.debug("Peer %s is alive.", broker_id, extra=logger_config.RATE_LIMITED)
+                return True
+            logging.warning(f"Peer {broker_id} returned HTTP {status}.")
+            return False
         except Exception as e:
-            logging.error(f"Peer {broker_id} heartbeat check failed: {e}")
+            logging.debug("Peer %s heartbeat check failed: %s", broker_id, e)
             return False
 
     def update_peers(self, peers):
         """Update the list of peers dynamically."""
         self.peers = [int(peer) for peer in peers if peer]
+        for peer in self.peers:
+            if peer not in self.detectors:
+                self.detectors[peer] = PhiAccrualFailureDetector(
+                    self.heartbeat_interval, min_std_deviation=self.min_std_deviation
+                )
+        for peer in list(self.detectors):
+            if peer not in self.peers:
+                del self.detectors[peer]
+                self.last_contact.pop(peer, None)
+                self.failed_peers.discard(peer)
         logging.info(f"Updated peer list: {self.peers}")
 
+    def apply_membership_delta(self, joined, left):
+        """Start tracking brokers that joined and forget those that left."""
+        for peer in map(int, left):
+            if peer in self.detectors:
+                del self.detectors[peer]
+            self.last_contact.pop(peer, None)
+            self.failed_peers.discard(peer)
+        self.peers = [peer for peer in self.peers if peer in self.detectors]
+        for peer in map(int, joined):
+            if peer != self.broker_id and peer not in self.detectors:
+                self.detectors[peer] = PhiAccrualFailureDetector(
+                    self.heartbeat_interval, min_std_deviation=self.min_std_deviation
+                )
+                self.peers.append(peer)
+        logging.info(f"Heartbeat peers: {self.peers}")
+
     async def log_peer_status(self):
         """Log the current status of online and failed peers."""
         online_peers = [peer for peer in self.peers if peer not in self.failed_peers]
-        logging.info(f"Online Brokers: {online_peers}")
-        logging.info(f"Failed Brokers: {list(self.failed_peers)}")
+        logging.debug("Online Brokers: %s", online_peers)
+        if self.failed_peers:
+            logging.info("Failed Brokers: %s", sorted(self.failed_peers))
+        logging.debug(
+            "Heartbeat probes sent: %d, skipped: %d", self.probes_sent, self.probes_skipped
+        )
@@ -0,0 +1,84 @@
+# File: load_report.py
+
+import asyncio
+import logging
+import time
+from collections import deque
+import aiohttp
+from aiohttp import web
+from util import logger_config
+
+logger_config.setup_logger()
+
+
+class LoadReporter:
+    """
+    Tracks this broker's load and periodically reports it to the registry so
+    that /dcnews can route by load.
+
+    Reported fields: in-flight requests, replication retry queue depth and
+    p99 request latency over the last ``window`` requests.
+    """
+
+    def __init__(self, broker_id, registry_url, address, replication, report_interval=2, window=1000):
+        """
+        :param broker_id: ID of the current broker.
+        :param registry_url: URL of the centralized registry service.
+        :param address: Base URL other services should use to reach this broker.
+        :param replication: DataReplication instance whose queue depth is reported.
+        :param report_interval: Interval in seconds between load reports.
+        :param window: Number of recent request latencies kept for the p99.
+        """
+        self.broker_id = broker_id
+        self.registry_url = registry_url
+        self.address = address
+        self.replication = replication
+        self.report_interval = report_interval
+        self.in_flight = 0
+        self.latencies = deque(maxlen=window)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """aiohttp middleware counting in-flight requests and their latency."""
+        self.in_flight += 1
+        started = time.monotonic()
+        try:
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+            self.latencies.append(time.monotonic() - started)
+
+    def p99_ms(self):
+        """Return the 99th percentile latency of recent requests in milliseconds."""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000
+
+    def snapshot(self):
+        """Return the current load report."""
+        return {
+            "broker_id": self.broker_id,
+            "address": self.address,
+            "in_flight": self.in_flight,
+            "queue_depth": self.replication.failed_queue.qsize(),
+            "p99_ms": round(self.p99_ms(), 2),
+        }
+
+    async def start_reporting(self):
+        """Send load reports to the registry until cancelled."""
+        if not self.registry_url:
+            logging.warning("No registry URL provided; load reporting disabled.")
+            return
+        timeout = aiohttp.ClientTimeout(total=self.report_interval)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                try:
+                    async with session.post(
+                        f"{self.registry_url}/load", json=self.snapshot()
+                    ) as response:
+                        if response.status != 200:
+                            logging.warning(f"Load report rejected (HTTP {response.status}).")
+                except Exception as e:
+                    logging.debug(f"Failed to report load to registry: {e}")
+                await asyncio.sleep(self.report_interval)
@@ -2,108 +2,591 @@
 
 import asyncio
 import logging
+import math
+import random
+import time
 import aiohttp
+from aiohttp import web
+from peers import PEER_HEADER, PeerDirectory, default_address
 from util import logger_config
 
 logger_config.setup_logger()
 
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+
 
 class Membership:
-    def __init__(self, broker_id, registry_url=None, update_interval=10, on_membership_change=None):
+    """
+    SWIM-style gossip membership.
+
+    Every protocol period the broker pings one member (randomized round-robin).
+    If no ack arrives within ``ping_timeout``, it asks ``indirect_probes`` other
+    members to ping the target on its behalf. A member that answers neither
+    way is marked suspect, and dead once it stays suspect for
+    ``suspect_timeout``. Membership updates (alive/suspect/dead with an
+    incarnation number) are piggybacked on pings and acks, so changes spread
+    epidemically without any central polling.
+
+    The registry is only used as a seed: the broker registers there and
+    follows its versioned /members feed with long-polls, so joins are learnt
+    as soon as they are registered without any periodic polling.
+
+    The membership callback receives the member set together with the
+    brokers that joined and left since the previous call.
+
+    Only proven peer brokers may gossip. A broker's address is only taken
+    from the registry or from an update carrying that broker's own
+    signature of it (``address_record``), made at an incarnation no older
+    than the address it replaces. A relayed or forged update therefore
+    cannot redirect traffic meant for another broker.
+    """
+
+    def __init__(
+        self,
+        broker_id,
+        registry_url=None,
+        update_interval=10,
+        on_membership_change=None,
+        address=None,
+        protocol_period=0.5,
+        ping_timeout=0.2,
+        indirect_probes=3,
+        suspect_timeout=2.0,
+        liveness=None,
+        feed_wait=30,
+        directory=None,
+    ):
         """
         :param broker_id: ID of the current broker.
         :param registry_url: URL of the centralized registry service.
-        :param update_interval: Interval in seconds to update the membership list.
+        :param update_interval: Seconds to wait before retrying an unreachable registry.
         :param on_membership_change: Callback function for handling membership changes.
+        :param address: Base URL other brokers use to reach this broker.
+        :param protocol_period: Seconds between probes of a member.
+        :param ping_timeout: Seconds to wait for a direct ack before probing indirectly.
+        :param indirect_probes: Number of members asked to probe an unresponsive member.
+        :param suspect_timeout: Seconds a member stays suspect before it is declared dead.
+        :param liveness: Optional Heartbeat tracker refreshed by acknowledged gossip.
+        :param feed_wait: Seconds each long-poll of the registry's membership feed may wait.
+        :param directory: PeerDirectory that learns members' advertised addresses.
         """
-        self.broker_id = broker_id
+        self.broker_id = int(broker_id)
         self.registry_url = registry_url
         self.update_interval = update_interval
-        self.members = set()  # Current membership list
+        self.members = {self.broker_id}  # Current membership list (alive or suspect)
         self.on_membership_change = on_membership_change  # Callback for membership updates
+        self.address = address or default_address(self.broker_id)
+        self.protocol_period = protocol_period
+        self.ping_timeout = ping_timeout
+        self.indirect_probes = indirect_probes
+        self.suspect_timeout = suspect_timeout
+        self.liveness = liveness
+        self.feed_wait = feed_wait
+        self.registry_version = None  # Last version of the registry's membership feed seen
+        self.notified_members = {self.broker_id}  # Member set at the last callback
+
+        # A restarted broker must outrank gossip about its previous life
+        self.incarnation = int(time.time())
+        self.states = {}  # Broker ID -> {"status", "incarnation", "address", "changed_at"}
+        self.broadcasts = {}  # Broker ID -> [update, remaining transmissions]
+        self.probe_order = []
+        self.directory = directory or PeerDirectory(broker_id)
+        self._changed = None  # asyncio.Event, created on the running loop
+        self._deregistrations = set()  # Registry removals of confirmed dead members in flight
+        self.registered = False  # Registration with the registry succeeded
+        self.seeded = False  # The registry's member list has been applied
+
 
     async def register_broker(self):
-        """Register the broker with the centralized registry."""
+        """
+        Register the broker with the centralized registry.
+
+        :return: True if the registry accepted the registration.
+        """
         if not self.registry_url:
             logging.warning("No registry URL provided; running standalone.")
-            return
+            return False
 
         try:
             logging.info(f"Registering Broker {self.broker_id} with registry at {self.registry_url}.")
             async with aiohttp.ClientSession() as session:
                 async with session.post(
                     f"{self.registry_url}/register",
-                    json={"broker_id": self.broker_id},
+                    json={"broker_id": self.broker_id, "address": self.address},
                 ) as response:
                     if response.status == 200:
                         logging.info("Registration successful.")
-                    else:
-                        logging.warning(f"Failed to register with registry (HTTP {response.status}).")
+                        return True
+                    logging.warning(f"Failed to register with registry (HTTP {response.status}).")
         except Exception as e:
-            logging.exception(f"Error registering with registry: {e}")
+            logging.warning(f"Error registering with registry: {e}")
+        return False
+
+    async def register_with_retry(self, initial_delay=0.1, max_delay=5.0):
+        """
+        Register, retrying with jittered exponential backoff until it succeeds,
+        so brokers can start before (or together with) the registry.
+        """
+        if not self.registry_url:
+            logging.warning("No registry URL provided; running standalone.")
+            self.registered = self.seeded = True
+            return
+        delay = initial_delay
+        while not await self.register_broker():
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, max_delay)
+        self.registered = True
 
     async def remove_broker(self, broker_id):
         """Remove a broker from the registry (used when a broker fails)."""
-        if broker_id in self.members:
-            self.members.remove(broker_id)  # Ensure broker is removed from internal list
+        state = self.states.get(broker_id)
+        if state and state["status"] != DEAD:
+            # Ensure broker is removed from internal list, and tell the others
+            self._apply({"id": broker_id, "status": DEAD, "incarnation": state["incarnation"]})
+            await self._membership_changed()
             logging.info(f"Broker {broker_id} removed from internal membership list.")
+        await self.deregister(broker_id)
+
+    async def deregister(self, broker_id):
+        """
+        Remove a failed broker from the registry, so /dcnews stops routing to
+        it. Several brokers may report the same failure; the registry answers
+        404 to all but the first. A broker removed by mistake re-registers
+        when it sees itself leave the registry's feed.
+        """
         if not self.registry_url:
             logging.warning("No registry URL provided; running standalone.")
             return
 
         try:
             logging.info(f"Removing Broker {broker_id} from registry at {self.registry_url}.")
-            async with aiohttp.ClientSession() as session:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.update_interval)) as session:
                 async with session.delete(
                     f"{self.registry_url}/remove/{broker_id}"
                 ) as response:
                     if response.status == 200:
                         logging.info(f"Broker {broker_id} removed from registry.")
+                    elif response.status == 404:
+                        logging.debug(f"Broker {broker_id} was already removed from the registry.")
                     else:
                         logging.warning(f"Failed to remove broker {broker_id} from registry (HTTP {response.status}).")
         except Exception as e:
-            logging.exception(f"Error removing broker {broker_id} from registry: {e}")
+            logging.warning(f"Error removing broker {broker_id} from registry: {e}")
+
+    async def fetch_members(self, wait=0):
+        """
+        Seed the member list from the registry's versioned membership feed.
 
-    async def fetch_members(self):
-        """Fetch the latest membership list from the registry."""
+        Asks for the changes since the last version seen (a full list on the
+        first call). Brokers that joined but gossip has not heard of yet are
+        added as alive; brokers that left are only suspected, so the gossip
+        protocol confirms or refutes the removal.
+
+        :param wait: Seconds the registry may hold the request open waiting for a change.
+        :return: True if the registry answered.
+        """
         if not self.registry_url:
             logging.warning("No registry URL provided; using local peers.")
-            return
+            return False
 
+        params = {"since": self.registry_version or 0, "wait": wait}
         try:
             async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.registry_url}/members") as response:
+                async with session.get(f"{self.registry_url}/members", params=params) as response:
                     if response.status == 200:
                         try:
-                            members = await response.json()  # Expecting a JSON list of broker IDs
-                            new_members = set(members)
-
-                            # Update membership only if it has changed
-                            if new_members != self.members:
-                                self.members = new_members
-                                logging.info(f"Membership updated: {self.members}")
-
-                                # Trigger the callback if provided
-                                if self.on_membership_change:
-                                    await self.on_membership_change(self.members)
-                            else:
-                                logging.debug("No membership changes detected.")
+                            delta = await response.json()
                         except ValueError as e:
                             logging.error(f"Malformed JSON response from registry: {e}")
+                            return False
                     else:
                         logging.warning(f"Failed to fetch members (HTTP {response.status}).")
+                        return False
         except Exception as e:
-            logging.exception(f"Error fetching members from registry: {e}")
+            logging.warning(f"Error fetching members from registry: {e}")
+            return False
+
+        self.seeded = True
+        if isinstance(delta, list):
+            # Registry without a change log: treat the full list as a reset
+            delta = {"version": None, "reset": True, "members": delta}
+        self.registry_version = delta["version"]
+        joined = delta["members"] if delta["reset"] else delta["joined"]
+        left = [] if delta["reset"] else delta["left"]
+        addresses = {int(b): address for b, address in delta.get("addresses", {}).items()}
+
+        changed = False
+        for broker_id in map(int, joined):
+            if broker_id == self.broker_id:
+                continue
+            address = addresses.get(broker_id)
+            if broker_id not in self.states:
+                self.states[broker_id] = {
+                    "status": ALIVE,
+                    "incarnation": 0,
+                    "address": address,
+                    "changed_at": time.monotonic(),
+                }
+                changed = True
+            elif address and not self.states[broker_id]["address"]:
+                self.states[broker_id]["address"] = address
+            self.directory.set_address(broker_id, self.states[broker_id]["address"])
+        for broker_id in map(int, left):
+            if broker_id == self.broker_id:
+                # The registry dropped us (e.g. a false failure report): come back
+                logging.warning("Registry reports this broker as gone; re-registering.")
+                await self.register_broker()
+                continue
+            state = self.states.get(broker_id)
+            if state and state["status"] == ALIVE:
+                self._apply({"id": broker_id, "status": SUSPECT, "incarnation": state["incarnation"]})
+                changed = True
+        if changed:
+            await self._membership_changed()
+        return True
+
+    async def join(self):
+        """Register (retrying with backoff), then follow the registry's membership feed."""
+        await self.register_with_retry()
+        await self.watch_registry()
+
+    async def watch_registry(self):
+        """Follow the registry's membership feed with long-polls until cancelled."""
+        if not self.registry_url:
+            return
+        while True:
+            if not await self.fetch_members(wait=self.feed_wait):
+                await asyncio.sleep(self.update_interval)
+
 
     async def start_membership_service(self):
-        """Start periodic membership updates."""
-        # Register the broker with the registry
-        await self.register_broker()
+        """Join through the registry and run the gossip protocol."""
+        self._changed = asyncio.Event()
+
+        # Gossip starts right away; registration retries in the background
+        notifier = asyncio.create_task(self._notify_changes())
+        watcher = asyncio.create_task(self.join())
+        try:
+            while True:
+                await self.probe_next()
+                await self.expire_suspects()
+                await asyncio.sleep(self.protocol_period)
+        finally:
+            tasks = [notifier, watcher, *self._deregistrations]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-        # Start a periodic task to fetch the latest membership list
+    async def probe_next(self):
+        """Probe the next member in randomized round-robin order."""
+        target = self._next_target()
+        if target is None:
+            return
+        if await self.ping(target):
+            return
+
+        helpers = [b for b in self._live_peers() if b != target]
+        helpers = random.sample(helpers, min(self.indirect_probes, len(helpers)))
+        if helpers:
+            results = await asyncio.gather(
+                *(self.ping_req(helper, target) for helper in helpers)
+            )
+            if any(results):
+                return
+
+        state = self.states.get(target)
+        if state and state["status"] == ALIVE:
+            logging.warning(f"Broker {target} did not answer direct or indirect probes; suspecting it.")
+            self._apply({"id": target, "status": SUSPECT, "incarnation": state["incarnation"]})
+            await self._membership_changed()
+
+    async def expire_suspects(self):
+        """
+        Declare members dead once they have been suspect for too long, and
+        remove them from the registry in the background.
+        """
+        now = time.monotonic()
+        expired = [
+            broker_id
+            for broker_id, state in self.states.items()
+            if state["status"] == SUSPECT and now - state["changed_at"] >= self.suspect_timeout
+        ]
+        for broker_id in expired:
+            logging.warning(f"Broker {broker_id} confirmed dead.")
+            self._apply(
+                {"id": broker_id, "status": DEAD, "incarnation": self.states[broker_id]["incarnation"]}
+            )
+        if expired:
+            await self._membership_changed()
+        for broker_id in expired:
+            task = asyncio.create_task(self.deregister(broker_id))
+            self._deregistrations.add(task)
+            task.add_done_callback(self._deregistrations.discard)
+
+    async def _membership_changed(self):
+        """Recompute the member set and wake the change notifier."""
+        self._refresh_members()
+        logging.info(f"Membership updated: {self.members}")
+        if self._changed is not None:
+            self._changed.set()
+
+    async def _notify_changes(self):
+        """Invoke the membership callback, coalescing bursts of changes."""
         while True:
-            await self.fetch_members()
-            await asyncio.sleep(self.update_interval)
+            await self._changed.wait()
+            self._changed.clear()
+            members = set(self.members)
+            joined = members - self.notified_members
+            left = self.notified_members - members
+            self.notified_members = members
+            if self.on_membership_change and (joined or left):
+                try:
+                    await self.on_membership_change(members, joined, left)
+                except Exception as e:
+                    logging.exception(f"Error in membership change callback: {e}")
+
+
+    async def ping(self, target):
+        """Send a direct ping carrying piggybacked updates; True on ack."""
+        body = await self._post(
+            target,
+            "/swim/ping",
+            {"from": self.broker_id, "updates": self._outgoing_updates()},
+            timeout=self.ping_timeout,
+        )
+        return body is not None
+
+    async def ping_req(self, helper, target):
+        """Ask a helper to ping a target for us; True if the target acked."""
+        body = await self._post(
+            helper,
+            "/swim/ping_req",
+            {"from": self.broker_id, "target": target, "updates": self._outgoing_updates()},
+            timeout=self.protocol_period,
+        )
+        return bool(body and body.get("ack"))
+
+    async def _post(self, target, path, payload, timeout):
+        """POST to a member, apply the updates piggybacked on the reply and return it."""
+        url = self.directory.url(target, path)
+        try:
+            async with self.directory.session(target).post(
+                url, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                if response.status != 200:
+                    return None
+                body = await response.json()
+        except Exception as e:
+            logging.debug(f"{path} to Broker {target} failed: {e}")
+            return None
+        if self.liveness:
+            self.liveness.record_contact(target)
+        if self._apply_all(body.get("updates", [])):
+            await self._membership_changed()
+        return body
+
+    @staticmethod
+    def _gossip_sender(request, data):
+        """The proven peer a gossip request comes from, or None if it does not match ``from``."""
+        sender = request.headers.get(PEER_HEADER)
+        try:
+            if sender is not None and int(sender) == int(data.get("from")):
+                return int(sender)
+        except (TypeError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def _forbidden():
+        return web.json_response({"status": "error", "message": "Only brokers may gossip."}, status=403)
+
+    async def handle_ping(self, request):
+        """Endpoint answering a direct ping; the ack carries our updates."""
+        if PEER_HEADER not in request.headers:
+            return self._forbidden()
+        data = await request.json()
+        sender = self._gossip_sender(request, data)
+        if sender is None:
+            return self._forbidden()
+        known = sender in self.states and self.states[sender]["status"] != DEAD
+        changed = self._apply_all(data.get("updates", []))
+        if known:
+            updates = self._outgoing_updates()
+        else:
+            # Unknown sender (e.g. just joined): send it the full member list
+            updates = self._full_state()
+        if changed:
+            await self._membership_changed()
+        return web.json_response({"updates": updates})
+
+    async def handle_ping_req(self, request):
+        """Endpoint probing a target on behalf of another member."""
+        if PEER_HEADER not in request.headers:
+            return self._forbidden()
+        data = await request.json()
+        if self._gossip_sender(request, data) is None:
+            return self._forbidden()
+        if self._apply_all(data.get("updates", [])):
+            await self._membership_changed()
+        ack = await self.ping(int(data.get("target")))
+        return web.json_response({"ack": ack, "updates": self._outgoing_updates()})
+
+
+    def address_record(self, broker_id, incarnation, address):
+        """Fields a broker signs to vouch for its own address."""
+        return ("address", broker_id, incarnation, address)
+
+    def _self_update(self):
+        """Describe this broker as alive at its current incarnation, signing its address."""
+        return {
+            "id": self.broker_id,
+            "status": ALIVE,
+            "incarnation": self.incarnation,
+            "address": self.address,
+            "address_incarnation": self.incarnation,
+            "address_signature": self.directory.sign_record(
+                *self.address_record(self.broker_id, self.incarnation, self.address)
+            ),
+        }
+
+    def _full_state(self):
+        """Describe every known member, used to bootstrap a joining broker."""
+        updates = [self._self_update()]
+        for broker_id, state in self.states.items():
+            updates.append(
+                {
+                    "id": broker_id,
+                    "status": state["status"],
+                    "incarnation": state["incarnation"],
+                    "address": state["address"],
+                    "address_incarnation": state.get("address_incarnation"),
+                    "address_signature": state.get("address_signature"),
+                }
+            )
+        return updates
+
+    def _apply_all(self, updates):
+        """Apply piggybacked updates; return True if the member set changed."""
+        before = set(self.members)
+        for update in updates:
+            self._apply(update)
+        self._refresh_members()
+        return before != self.members
+
+    def _apply(self, update):
+        """
+        Apply one update using SWIM precedence rules and queue it for further
+        dissemination if it was news.
+        """
+        broker_id = int(update["id"])
+        status = update["status"]
+        incarnation = update["incarnation"]
+
+        if broker_id == self.broker_id:
+            if status != ALIVE and incarnation >= self.incarnation:
+                # Refute the rumour with a higher incarnation
+                self.incarnation = incarnation + 1
+                logging.info(f"Refuting {status} rumour with incarnation {self.incarnation}.")
+                self._enqueue(self._self_update())
+            return
+
+        current = self.states.get(broker_id)
+        if current is not None:
+            if status == ALIVE and incarnation <= current["incarnation"]:
+                return
+            if status == SUSPECT and (
+                current["status"] == DEAD
+                or incarnation < current["incarnation"]
+                or (incarnation == current["incarnation"] and current["status"] == SUSPECT)
+            ):
+                return
+            if status == DEAD and (
+                current["status"] == DEAD or incarnation < current["incarnation"]
+            ):
+                return
+
+        # The address is kept with the incarnation its owner signed it at
+        address, signed_at, signature = (
+            (current["address"], current.get("address_incarnation"), current.get("address_signature"))
+            if current
+            else (None, None, None)
+        )
+        claimed = update.get("address")
+        if claimed and claimed != address:
+            claimed_at = update.get("address_incarnation")
+            if (
+                isinstance(claimed_at, int)
+                and (signed_at is None or claimed_at >= signed_at)
+                and self.directory.verify_record(
+                    update.get("address_signature"), *self.address_record(broker_id, claimed_at, claimed)
+                )
+            ):
+                address, signed_at, signature = claimed, claimed_at, update.get("address_signature")
+            else:
+                logging.warning(f"Ignoring address {claimed} for Broker {broker_id} not signed by it.")
+
+        self.states[broker_id] = {
+            "status": status,
+            "incarnation": incarnation,
+            "address": address,
+            "address_incarnation": signed_at,
+            "address_signature": signature,
+            "changed_at": time.monotonic(),
+        }
+        self.directory.set_address(broker_id, address)
+        self._enqueue(
+            {
+                "id": broker_id,
+                "status": status,
+                "incarnation": incarnation,
+                "address": address,
+                "address_incarnation": signed_at,
+                "address_signature": signature,
+            }
+        )
+
+    def _enqueue(self, update):
+        """Queue an update to be piggybacked about log(n) times."""
+        transmissions = 3 * math.ceil(math.log2(len(self.states) + 2))
+        self.broadcasts[update["id"]] = [update, transmissions]
+
+    def _outgoing_updates(self):
+        """Updates to piggyback on a message: our own liveness plus pending gossip."""
+        return [self._self_update()] + self._take_broadcasts()
+
+    def _take_broadcasts(self, limit=16):
+        """Pick the least-transmitted updates to piggyback on an outgoing message."""
+        pending = sorted(self.broadcasts.values(), key=lambda item: -item[1])[:limit]
+        updates = []
+        for item in pending:
+            updates.append(item[0])
+            item[1] -= 1
+            if item[1] <= 0:
+                self.broadcasts.pop(item[0]["id"], None)
+        return updates
+
+    def _refresh_members(self):
+        """Members are every broker not known to be dead, including this one."""
+        self.members = {self.broker_id} | {
+            broker_id for broker_id, state in self.states.items() if state["status"] != DEAD
+        }
+
+    def _live_peers(self):
+        """Peers currently believed alive (candidates for indirect probes)."""
+        return [b for b, state in self.states.items() if state["status"] == ALIVE]
+
+    def _next_target(self):
+        """Randomized round-robin over members that are not known dead."""
+        if not self.probe_order:
+            self.probe_order = [b for b, s in self.states.items() if s["status"] != DEAD]
+            random.shuffle(self.probe_order)
+        while self.probe_order:
+            target = self.probe_order.pop()
+            if target in self.states and self.states[target]["status"] != DEAD:
+                return target
+        return None
 
     async def on_peer_failure(self, failed_peer):
         """Callback to handle failed broker."""
@@ -0,0 +1,218 @@
+# File: metrics.py
+
+import time
+from bisect import bisect_left
+from aiohttp import web
+
+# Upper bounds in seconds for latency histograms, from 0.5 ms to 10 s
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    """Escape a label value for the text exposition format."""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    """Render a label set such as ``{peer="2",le="0.5"}``."""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    """Format a sample value the way Prometheus expects."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, optionally split by labels.
+
+    Recording finds the bucket with a bisect and bumps two counters; the
+    cumulative bucket counts Prometheus expects are only built when scraped.
+    All recording happens on the event loop thread, so no lock is needed.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+        :param name: Metric name.
+        :param documentation: HELP text.
+        :param labelnames: Names of the labels passed to ``observe``.
+        :param buckets: Ascending bucket upper bounds; +Inf is implied.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}  # Label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *labels):
+        """Record one value for the given label values."""
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels):
+        """Context manager recording the duration of its block."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        """Yield ``(name, labels, value)`` samples for the exposition."""
+        bounds = self.buckets + (float("inf"),)
+        for labels, series in self.series.items():
+            total = 0
+            for bound, count in zip(bounds, series):
+                total += count
+                yield f"{self.name}_bucket", _labels(self.labelnames, labels, ("le", _number(bound))), total
+            yield f"{self.name}_sum", _labels(self.labelnames, labels), series[-1]
+            yield f"{self.name}_count", _labels(self.labelnames, labels), total
+
+
+class _Timer:
+    """Records the wall time of a ``with`` block into a histogram."""
+
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Counter:
+    """Monotonically increasing count, optionally split by labels."""
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: Metric name, conventionally ending in ``_total``.
+        :param documentation: HELP text.
+        :param labelnames: Names of the labels passed to ``inc``.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # Label values -> count
+
+    def inc(self, *labels, amount=1):
+        """Add ``amount`` for the given label values."""
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """Yield ``(name, labels, value)`` samples for the exposition."""
+        for labels, value in self.values.items():
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class Gauge:
+    """
+    Value read when the metrics are scraped.
+
+    ``collect`` is called at scrape time and returns either a number, or a
+    dict mapping label-value tuples to numbers, so keeping the gauge current
+    costs nothing on the request path.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, collect, labelnames=()):
+        """
+        :param name: Metric name.
+        :param documentation: HELP text.
+        :param collect: Callable returning the current value(s).
+        :param labelnames: Names of the labels used as keys of ``collect``'s dict.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        """Yield ``(name, labels, value)`` samples for the exposition."""
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+class MetricsRegistry:
+    """Set of metrics rendered together by one /metrics endpoint."""
+
+    def __init__(self):
+        self.metrics = {}  # Name -> metric
+
+    def register(self, metric):
+        """Add a metric (replacing one of the same name) and return it."""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """Create and register a histogram."""
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def counter(self, name, documentation, labelnames=()):
+        """Create and register a counter."""
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, collect, labelnames=()):
+        """Create and register a gauge."""
+        return self.register(Gauge(name, documentation, collect, labelnames))
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    async def handle_metrics(self, request):
+        """Endpoint serving the metrics (``GET /metrics``)."""
+        return web.Response(body=self.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    def middleware(self, histogram):
+        """
+        aiohttp middleware timing every request into ``histogram``, labelled
+        by route pattern (e.g. ``/data/{topic}``) so label values stay bounded.
+        """
+
+        @web.middleware
+        async def timing(request, handler):
+            started = time.perf_counter()
+            try:
+                return await handler(request)
+            finally:
+                route = request.match_info.route.resource
+                histogram.observe(
+                    time.perf_counter() - started,
+                    route.canonical if route is not None else "unmatched",
+                )
+
+        return timing
+
+
+# Default registry of this process
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,173 @@
+# File: partition_cache.py
+
+import asyncio
+import logging
+import time
+from aiohttp import web
+from util import logger_config
+from datatable import DataStore
+from metrics import REGISTRY
+from peers import PEER_HEADER
+
+logger_config.setup_logger()
+
+INVALIDATIONS = REGISTRY.counter(
+    "broker_partition_invalidations_total",
+    "Cached remote partitions dropped, by cause (\"callback\" from the owner or \"local\" store).",
+    ("cause",),
+)
+
+
+class CachedPartition:
+    """What a broker last read of a remote partition."""
+
+    __slots__ = ("etag", "version", "records", "expires")
+
+    def __init__(self, etag, version, records, expires):
+        self.etag = etag
+        self.version = version  # Highest sequence number in the partition (or filter matches)
+        self.records = records  # First page, if the read had no cursor
+        self.expires = expires
+
+
+class PartitionCache:
+    """
+    Remote partitions cached by readers and invalidated by their owners.
+
+    A broker reading a partition from another broker keeps its version (the
+    highest sequence number) and, for reads without a cursor, its first page.
+    The owner remembers who read it for ``lease`` seconds, and when one of its
+    partitions changes it tells those readers once (``POST
+    /partitions/invalidate``, batched per reader), after which they have to
+    read again to hear about the next change. Until then a reader answers
+    from the cache, so an idle poll costs no round trip: a cursor at or past
+    the cached version has nothing new, whatever the partition's owner.
+
+    A broker also drops its cached copy of a partition when it stores a
+    message of that partition itself (a replica receiving replication), and
+    an entry lapses after ``lease`` seconds in case an invalidation was lost.
+    """
+
+    def __init__(self, directory, lease=10.0, flush_delay=0.005):
+        """
+        :param directory: PeerDirectory used to notify readers.
+        :param lease: Seconds a read stays cached, and an owner keeps notifying its reader.
+        :param flush_delay: Seconds invalidations are collected before they are sent.
+        """
+        self.directory = directory
+        self.lease = lease
+        self.flush_delay = flush_delay
+        self.entries = {}  # (Table name, partition) -> {filter ID or None: CachedPartition}
+        self.generations = {}  # (Table name, partition) -> invalidations so far
+        self.watchers = {}  # (Table name, partition) -> {peer: monotonic expiry}
+        self.pending = {}  # Peer -> set of (table name, partition) to invalidate
+        self.flush_task = None
+
+    @staticmethod
+    def _key(topic, partition):
+        return DataStore._sanitize_table_name(topic), int(partition)
+
+    # Reader side
+
+    def get(self, topic, partition, filter_id=None):
+        """
+        The cached read of a partition, or None.
+
+        :return: Tuple of (entry, fresh); a stale entry can still validate a
+                 conditional read.
+        """
+        entry = self.entries.get(self._key(topic, partition), {}).get(filter_id)
+        if entry is None:
+            return None, False
+        return entry, entry.expires > time.monotonic()
+
+    def generation(self, topic, partition):
+        """Token to take before reading a partition and pass to ``put``."""
+        return self.generations.get(self._key(topic, partition), 0)
+
+    def put(self, topic, partition, filter_id, generation, etag, version, records, started):
+        """
+        Cache a read, unless the partition was invalidated since ``generation``
+        was taken (the callback overtook the response).
+
+        :param started: Monotonic time the read was sent; the lease counts from it.
+        """
+        key = self._key(topic, partition)
+        if self.generations.get(key, 0) != generation:
+            return
+        self.entries.setdefault(key, {})[filter_id] = CachedPartition(
+            etag, version, records, started + self.lease
+        )
+
+    def invalidate(self, topic, partition, cause="local"):
+        """Drop the cached reads of a partition."""
+        key = self._key(topic, partition)
+        self.generations[key] = self.generations.get(key, 0) + 1
+        if self.entries.pop(key, None) is not None:
+            INVALIDATIONS.inc(cause)
+
+    def clear(self):
+        """Drop everything, e.g. because partitions moved to other owners."""
+        for key in list(self.entries):
+            self.generations[key] = self.generations.get(key, 0) + 1
+        self.entries.clear()
+        self.watchers.clear()
+
+    async def handle_invalidate(self, request):
+        """
+        Drop cached partitions an owner reports as changed
+        (``POST /partitions/invalidate`` with ``{"partitions": [[table, partition], ...]}``).
+        """
+        if PEER_HEADER not in request.headers:
+            return web.json_response(
+                {"status": "error", "message": "Only brokers may invalidate cached partitions."}, status=403
+            )
+        try:
+            data = await request.json()
+            for table_name, partition in data.get("partitions", []):
+                self.invalidate(table_name, partition, cause="callback")
+        except (ValueError, TypeError, AttributeError) as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+        return web.json_response({"status": "success"})
+
+    # Owner side
+
+    def watch(self, peer, topic, partition):
+        """Remember that a peer read a partition, to tell it when the partition changes."""
+        self.watchers.setdefault(self._key(topic, partition), {})[int(peer)] = time.monotonic() + self.lease
+
+    def changed(self, topic, partition):
+        """
+        A message of a partition was stored here: drop this broker's cached
+        read of it and schedule callbacks to the peers that read it.
+        """
+        key = self._key(topic, partition)
+        self.invalidate(topic, partition)
+        watchers = self.watchers.pop(key, None)
+        if not watchers:
+            return
+        now = time.monotonic()
+        for peer, expires in watchers.items():
+            if expires > now:
+                self.pending.setdefault(peer, set()).add(key)
+        if self.pending and self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        """Send the collected invalidations, one request per reader."""
+        try:
+            await asyncio.sleep(self.flush_delay)
+        finally:
+            self.flush_task = None
+        pending, self.pending = self.pending, {}
+        await asyncio.gather(*(self._send(peer, sorted(keys)) for peer, keys in pending.items()))
+
+    async def _send(self, peer, keys):
+        url = self.directory.url(peer, "/partitions/invalidate")
+        try:
+            async with self.directory.session(peer).post(url, json={"partitions": keys}) as response:
+                if response.status != 200:
+                    logging.debug(f"Broker {peer} refused invalidations (HTTP {response.status}).")
+        except Exception as e:
+            # The reader's lease runs out instead
+            logging.debug(f"Sending invalidations to Broker {peer} failed: {e}")
@@ -0,0 +1,137 @@
+# File: partitioning.py
+
+import bisect
+import hashlib
+import logging
+from util import logger_config
+from datatable import DataStore
+
+logger_config.setup_logger()
+
+
+def _hash(key):
+    """Map a string key onto the 64-bit hash ring."""
+    return int.from_bytes(hashlib.md5(str(key).encode("utf-8")).digest()[:8], "big")
+
+
+class ConsistentHashRing:
+    """
+    A consistent-hash ring of broker IDs with virtual nodes.
+
+    Adding or removing a broker only moves the keys that fall on that broker's
+    virtual nodes, so partitions move minimally on membership changes.
+    """
+
+    def __init__(self, nodes=(), virtual_nodes=64):
+        """
+        :param nodes: Initial broker IDs on the ring.
+        :param virtual_nodes: Number of points each broker occupies on the ring.
+        """
+        self.virtual_nodes = virtual_nodes
+        self.nodes = set()
+        self._points = []  # Sorted hash points
+        self._owners = {}  # Hash point -> broker ID
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        """Place a broker on the ring."""
+        node = int(node)
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.virtual_nodes):
+            point = _hash(f"broker-{node}#{replica}")
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove_node(self, node):
+        """Take a broker off the ring."""
+        node = int(node)
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self._points = [point for point in self._points if self._owners[point] != node]
+        self._owners = {point: self._owners[point] for point in self._points}
+
+    def set_nodes(self, nodes):
+        """Apply a new member set, touching only the brokers that joined or left."""
+        nodes = {int(node) for node in nodes}
+        for node in self.nodes - nodes:
+            self.remove_node(node)
+        for node in nodes - self.nodes:
+            self.add_node(node)
+
+    def get_nodes(self, key, count):
+        """
+        Walk the ring clockwise from the key and collect distinct brokers.
+
+        :param key: Key to place on the ring.
+        :param count: Number of distinct brokers to return.
+        :return: List of broker IDs, the first one being the primary owner.
+        """
+        if not self._points:
+            return []
+        count = min(count, len(self.nodes))
+        owners = []
+        start = bisect.bisect(self._points, _hash(key))
+        for offset in range(len(self._points)):
+            node = self._owners[self._points[(start + offset) % len(self._points)]]
+            if node not in owners:
+                owners.append(node)
+                if len(owners) == count:
+                    break
+        return owners
+
+
+class PartitionPlacement:
+    """
+    Splits topics into partitions and places each partition on a fixed number
+    of replicas chosen from the consistent-hash ring of live brokers.
+
+    Topics are placed by the name of the table they are stored in, so topic
+    names stored in the same table (``"Top News"`` and ``"top_news"``) share
+    their placement, and a broker can place what it finds in its database.
+    """
+
+    def __init__(self, broker_id, num_partitions=8, replication_factor=3, virtual_nodes=64):
+        """
+        :param broker_id: ID of the current broker.
+        :param num_partitions: Number of partitions per topic.
+        :param replication_factor: Number of brokers holding a copy of each partition.
+        :param virtual_nodes: Number of ring points per broker.
+        """
+        self.broker_id = int(broker_id)
+        self.num_partitions = num_partitions
+        self.replication_factor = replication_factor
+        self.ring = ConsistentHashRing([self.broker_id], virtual_nodes=virtual_nodes)
+
+    def update_members(self, members):
+        """
+        Rebuild placement from the membership list.
+
+        :param members: Set of live broker IDs (including this broker).
+        :return: Set of ring members before the update.
+        """
+        previous = set(self.ring.nodes)
+        self.ring.set_nodes(set(members) | {self.broker_id})
+        if previous != self.ring.nodes:
+            logging.info(f"Partition ring updated: {sorted(self.ring.nodes)}")
+        return previous
+
+    def partition_for(self, topic, key):
+        """Return the partition a message key belongs to within a topic."""
+        return _hash(f"{DataStore._sanitize_table_name(topic)}/{key}") % self.num_partitions
+
+    def replicas_for(self, topic, partition, ring=None):
+        """
+        Return the brokers owning a partition, primary first.
+
+        :param ring: Optional ring to place against (defaults to the current one).
+        """
+        ring = ring or self.ring
+        return ring.get_nodes(f"{DataStore._sanitize_table_name(topic)}:{partition}", self.replication_factor)
+
+    def is_replica(self, topic, partition):
+        """Check whether this broker holds a copy of the partition."""
+        return self.broker_id in self.replicas_for(topic, partition)
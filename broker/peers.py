@@ -0,0 +1,253 @@
+# File: peers.py
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import secrets
+import time
+from collections import OrderedDict
+import aiohttp
+from aiohttp import payload, web
+from util import logger_config
+from metrics import REGISTRY
+
+logger_config.setup_logger()
+
+# Header identifying the sending broker on inter-broker requests
+PEER_HEADER = "X-Broker-Id"
+# Header proving the sender knows the cluster's peer secret (see ``request_signature``)
+AUTH_HEADER = "X-Broker-Auth"
+# Signed alongside: when the request was sent, a one-time nonce and the body's SHA-256
+TIMESTAMP_HEADER = "X-Broker-Timestamp"
+NONCE_HEADER = "X-Broker-Nonce"
+BODY_HEADER = "X-Broker-Content-SHA256"
+SIGNATURE_HEADERS = (AUTH_HEADER, TIMESTAMP_HEADER, NONCE_HEADER, BODY_HEADER)
+# Body digest of streamed bodies, only allowed on routes that check the content themselves
+UNSIGNED_BODY = "UNSIGNED-PAYLOAD"
+UNSIGNED_BODY_ROUTES = ("/blobs/",)
+
+PEER_AUTH_FAILURES = REGISTRY.counter(
+    "broker_peer_auth_failures_total",
+    "Requests naming a sending broker without proving it, handled as client requests.",
+)
+
+
+def request_signature(secret, broker_id, method, path, timestamp, nonce, body_digest):
+    """
+    Proof that a broker knows the peer secret and sent this very request: an
+    HMAC over its ID, the method, the path with query, when it was sent, a
+    nonce and the body's digest.
+    """
+    message = "\n".join((str(int(broker_id)), method.upper(), path, timestamp, nonce, body_digest))
+    return hmac.new(secret.encode("utf-8"), message.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def signed_request_class(secret, broker_id):
+    """aiohttp request class signing each request just before it is sent, once its body is final."""
+
+    class SignedRequest(aiohttp.ClientRequest):
+        async def send(self, conn):
+            if isinstance(self.body, payload.BytesPayload):
+                digest = hashlib.sha256(self.body._value).hexdigest()
+            elif isinstance(self.body, (bytes, bytearray)):
+                digest = hashlib.sha256(self.body).hexdigest()
+            else:
+                digest = UNSIGNED_BODY  # Streamed, e.g. a file
+            timestamp = f"{time.time():.3f}"
+            nonce = secrets.token_hex(16)
+            self.headers[TIMESTAMP_HEADER] = timestamp
+            self.headers[NONCE_HEADER] = nonce
+            self.headers[BODY_HEADER] = digest
+            self.headers[AUTH_HEADER] = request_signature(
+                secret, broker_id, self.method, self.url.raw_path_qs, timestamp, nonce, digest
+            )
+            return await super().send(conn)
+
+    return SignedRequest
+
+
+def default_address(broker_id):
+    """Address a broker is assumed to have when it has not advertised one."""
+    return f"http://broker-{broker_id}:{3000 + int(broker_id) - 1}"
+
+
+class PeerDirectory:
+    """
+    Shared directory of peer brokers: broker ID -> advertised base URL, plus
+    one pooled keep-alive client per peer.
+
+    Addresses are learnt from the registry and from gossip, so brokers can
+    run on any host and port. Each peer's client keeps its connections open
+    and caches DNS results, so a request to a peer neither rebuilds its URL
+    from a naming convention nor resolves its host again.
+    """
+
+    def __init__(
+        self,
+        broker_id,
+        connections_per_peer=20,
+        request_timeout=10,
+        dns_cache_ttl=300,
+        secret=None,
+        max_clock_skew=30,
+    ):
+        """
+        :param broker_id: ID of the current broker, sent on every request.
+        :param connections_per_peer: Maximum pooled connections to each peer.
+        :param request_timeout: Default deadline in seconds for a request to a peer.
+        :param dns_cache_ttl: Seconds a resolved peer address is cached.
+        :param secret: Secret shared by the cluster's brokers; without one,
+                       any request naming a sender is believed to come from it.
+        :param max_clock_skew: Seconds a signed request stays valid, either way
+                               of this broker's clock; its nonce is remembered as long.
+        """
+        self.broker_id = int(broker_id)
+        self.secret = secret
+        self.max_clock_skew = max_clock_skew
+        self.nonces = OrderedDict()  # Nonce -> wall time it may be forgotten, oldest first
+        self.connections_per_peer = connections_per_peer
+        self.request_timeout = request_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.addresses = {}  # Broker ID -> advertised base URL
+        self.sessions = {}  # Broker ID -> aiohttp.ClientSession
+
+    def set_address(self, broker_id, address):
+        """
+        Record a peer's advertised address. If it moved, its pooled client is
+        dropped so the next request connects to the new address.
+        """
+        broker_id = int(broker_id)
+        if not address or self.addresses.get(broker_id) == address:
+            return
+        logging.info(f"Broker {broker_id} advertised at {address}")
+        self.addresses[broker_id] = address.rstrip("/")
+        session = self.sessions.pop(broker_id, None)
+        if session is not None:
+            asyncio.ensure_future(session.close())
+
+    def address_of(self, broker_id):
+        """Base URL of a peer, as advertised or by the default port mapping."""
+        broker_id = int(broker_id)
+        return self.addresses.get(broker_id) or default_address(broker_id)
+
+    def url(self, broker_id, path):
+        """Full URL of ``path`` on a peer."""
+        return f"{self.address_of(broker_id)}{path}"
+
+    def session(self, broker_id):
+        """Pooled client for a peer, created on first use."""
+        broker_id = int(broker_id)
+        session = self.sessions.get(broker_id)
+        if session is None or session.closed:
+            request_class = signed_request_class(self.secret, self.broker_id) if self.secret else aiohttp.ClientRequest
+            session = self.sessions[broker_id] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.connections_per_peer, ttl_dns_cache=self.dns_cache_ttl
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+                headers=self.headers(),
+                request_class=request_class,
+            )
+        return session
+
+    def headers(self):
+        """Headers identifying this broker on requests to peers; each request is signed as it is sent."""
+        return {PEER_HEADER: str(self.broker_id)}
+
+    def authenticated(self, request):
+        """
+        Whether a request naming its sending broker proves it with the peer
+        secret: a signature of this request, sent within ``max_clock_skew``
+        and with a nonce not seen before. The body digest is checked
+        separately (``body_matches``), since that means reading the body.
+        """
+        if not self.secret:
+            return True
+        headers = request.headers
+        try:
+            timestamp, nonce, digest = (headers[name] for name in (TIMESTAMP_HEADER, NONCE_HEADER, BODY_HEADER))
+            expected = request_signature(
+                self.secret, headers[PEER_HEADER], request.method, request.raw_path, timestamp, nonce, digest
+            )
+            sent = float(timestamp)
+        except (KeyError, ValueError):
+            return False
+        if not hmac.compare_digest(headers.get(AUTH_HEADER, ""), expected):
+            return False
+        now = time.time()
+        if abs(now - sent) > self.max_clock_skew:
+            return False
+        if digest == UNSIGNED_BODY and not request.path.startswith(UNSIGNED_BODY_ROUTES):
+            return False
+        return self._first_use(nonce, now)
+
+    def _first_use(self, nonce, now):
+        """Remember a nonce for as long as its request is valid; False if it was used already."""
+        while self.nonces and next(iter(self.nonces.values())) < now:
+            self.nonces.popitem(last=False)
+        if nonce in self.nonces:
+            return False
+        self.nonces[nonce] = now + 2 * self.max_clock_skew
+        return True
+
+    async def body_matches(self, request):
+        """Whether an authenticated request's body has the digest it was signed with."""
+        digest = request.headers.get(BODY_HEADER)
+        if not self.secret or digest == UNSIGNED_BODY:
+            return True
+        return hmac.compare_digest(digest, hashlib.sha256(await request.read()).hexdigest())
+
+    def sign_record(self, *fields):
+        """
+        Signature of a record that peers pass on unchanged, such as a
+        broker's advertised address in gossip; None without a secret.
+        """
+        if not self.secret:
+            return None
+        message = "\n".join(map(str, fields))
+        return hmac.new(self.secret.encode("utf-8"), message.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def verify_record(self, signature, *fields):
+        """Whether a relayed record carries its author's signature (always, without a secret)."""
+        if not self.secret:
+            return True
+        return isinstance(signature, str) and hmac.compare_digest(signature, self.sign_record(*fields))
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """
+        aiohttp middleware stripping the sender from requests that cannot
+        prove it, so every handler treats them as client requests: peer-only
+        routes refuse them, and admission control applies. A correctly signed
+        request whose body does not match the signature is refused with 401.
+        """
+        if PEER_HEADER in request.headers:
+            if not self.authenticated(request):
+                PEER_AUTH_FAILURES.inc()
+                logging.debug(
+                    "Unauthenticated request claiming Broker %s from %s",
+                    request.headers[PEER_HEADER],
+                    request.remote,
+                    extra=logger_config.RATE_LIMITED,
+                )
+                headers = request.headers.copy()
+                for name in (PEER_HEADER,) + SIGNATURE_HEADERS:
+                    headers.popall(name, None)
+                request = request.clone(headers=headers)
+            elif not await self.body_matches(request):
+                PEER_AUTH_FAILURES.inc()
+                logging.warning(f"Request from Broker {request.headers[PEER_HEADER]} does not match its signature")
+                raise web.HTTPUnauthorized(text="Body does not match the peer signature.")
+        return await handler(request)
+
+    def forget(self, broker_id):
+        """Close the pooled client of a peer that left."""
+        session = self.sessions.pop(int(broker_id), None)
+        if session is not None:
+            asyncio.ensure_future(session.close())
+
+    async def close(self):
+        """Close every pooled client."""
+        sessions, self.sessions = list(self.sessions.values()), {}
+        await asyncio.gather(*(session.close() for session in sessions))
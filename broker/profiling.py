@@ -0,0 +1,472 @@
+# File: profiling.py
+
+import asyncio
+import hmac
+import io
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from aiohttp import web
+from util import logger_config
+from metrics import REGISTRY
+from peers import PEER_HEADER
+
+logger_config.setup_logger()
+
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "broker_event_loop_lag_seconds",
+    "How late the event loop ran a timer scheduled by the lag monitor.",
+)
+
+
+# Routes only administrators (and peer brokers) may call
+ADMIN_PREFIX = "/admin/"
+LOOPBACK = ("127.0.0.1", "::1")
+
+
+class AdminGuard:
+    """
+    Refuses ``/admin`` requests with 403 unless they come from:
+
+    - an administrator, sending ``Authorization: Bearer <admin token>``;
+    - a peer broker proven by the peer secret (the peer directory's
+      middleware, which must run first, strips senders it cannot prove);
+    - the broker's own host (loopback).
+    """
+
+    def __init__(self, token=None, peer_secret=None):
+        """
+        :param token: Admin token; without one, only peers and loopback are allowed.
+        :param peer_secret: Cluster peer secret; without one, no sender is proven, so peers are not allowed.
+        """
+        self.token = token
+        self.trust_peers = bool(peer_secret)
+
+    def allowed(self, request):
+        """Whether a request may use the admin routes."""
+        if request.remote in LOOPBACK:
+            return True
+        if self.trust_peers and PEER_HEADER in request.headers:
+            return True
+        if not self.token:
+            return False
+        return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {self.token}")
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        """aiohttp middleware guarding the admin routes."""
+        if request.path.startswith(ADMIN_PREFIX) and not self.allowed(request):
+            logging.debug(
+                "Refused %s %s from %s", request.method, request.path, request.remote, extra=logger_config.RATE_LIMITED
+            )
+            raise web.HTTPForbidden(text="Admin routes need an admin token.")
+        return await handler(request)
+
+
+def _query_float(request, name, default):
+    """Read a numeric query parameter, raising HTTP 400 if malformed."""
+    try:
+        return float(request.query.get(name, default))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Invalid {name}: {request.query[name]}")
+
+
+def _download(text, filename):
+    """Plain-text response the browser saves as ``filename``."""
+    return web.Response(
+        text=text, headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler for the event loop thread.
+
+    A background thread reads the loop thread's current stack every
+    ``interval`` seconds and counts identical stacks, so nothing is added to
+    the code being profiled. Results are kept in the collapsed-stack format
+    (``frame;frame;frame count``) used by flame graph tools. Time the loop
+    spends idle shows up under the selector's ``select``.
+
+    Overhead is bounded three ways: a profile runs for at most
+    ``max_duration`` seconds, the interval is widened whenever taking samples
+    costs more than ``overhead_budget`` of the wall time, and at most
+    ``max_stacks`` distinct stacks are kept (the rest are counted as
+    ``[other]``).
+    """
+
+    def __init__(self, interval=0.01, max_duration=300, overhead_budget=0.02, max_stacks=20000):
+        """
+        :param interval: Default seconds between samples.
+        :param max_duration: Longest profile allowed, in seconds.
+        :param overhead_budget: Fraction of wall time sampling may take.
+        :param max_stacks: Distinct stacks kept per profile.
+        """
+        self.interval = interval
+        self.max_duration = max_duration
+        self.overhead_budget = overhead_budget
+        self.max_stacks = max_stacks
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()  # Guards stacks between the sampling thread and readers
+        self._reset(interval)
+
+    def _reset(self, interval):
+        self.stacks = {}  # Collapsed stack -> sample count
+        self.samples = 0
+        self.sampling_time = 0.0
+        self.current_interval = interval
+        self.started = None
+        self.finished = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration, interval=None):
+        """
+        Start profiling the calling (event loop) thread in the background.
+
+        :param duration: Seconds to profile for, capped at ``max_duration``.
+        :param interval: Seconds between samples; defaults to ``interval``.
+        """
+        if self.running:
+            raise RuntimeError("Profiler is already running.")
+        self._reset(max(0.001, interval or self.interval))
+        self.stop_event.clear()
+        self.started = time.monotonic()
+        self.thread = threading.Thread(
+            target=self._run,
+            args=(threading.get_ident(), self.started + min(duration, self.max_duration)),
+            name="sampling-profiler",
+            daemon=True,
+        )
+        self.thread.start()
+        logging.info(
+            f"Profiler started for {min(duration, self.max_duration):.0f}s "
+            f"at {self.current_interval * 1000:.1f}ms intervals."
+        )
+
+    def stop(self):
+        """Stop profiling and wait for the sampling thread to exit."""
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self, thread_id, deadline):
+        """Sampling thread: record the target thread's stack until stopped or past ``deadline``."""
+        requested = self.current_interval
+        average_cost = 0.0
+        while not self.stop_event.wait(self.current_interval) and time.monotonic() < deadline:
+            # CPU time of this thread only; waiting for the GIL is not overhead
+            started = time.thread_time()
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = self._collapse(frame)
+            del frame
+            with self.lock:
+                if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                    stack = "[other]"
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+            cost = time.thread_time() - started
+            self.sampling_time += cost
+            # Sample less often while sampling takes more than its share of the time
+            average_cost = cost if self.samples == 1 else 0.9 * average_cost + 0.1 * cost
+            self.current_interval = max(requested, average_cost / self.overhead_budget)
+        self.finished = time.monotonic()
+        logging.info(f"Profiler stopped after {self.samples} samples.")
+
+    @staticmethod
+    def _collapse(frame):
+        """Render a stack root-first as ``function (file:line);...``."""
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(frames))
+
+    def snapshot(self):
+        """Copy of the sample counts per stack, consistent while sampling goes on."""
+        with self.lock:
+            return dict(self.stacks)
+
+    def collapsed(self):
+        """Samples in collapsed-stack format, most frequent stack first."""
+        stacks = self.snapshot()
+        return "".join(
+            f"{stack} {count}\n"
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1])
+        )
+
+    def summary(self, top=20):
+        """Status and the functions with the most samples."""
+        own, total = {}, {}
+        for stack, count in self.snapshot().items():
+            frames = stack.split(";")
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for function in set(frames):
+                total[function] = total.get(function, 0) + count
+        elapsed = 0.0
+        if self.started is not None:
+            elapsed = (self.finished or time.monotonic()) - self.started
+        return {
+            "running": self.running,
+            "samples": self.samples,
+            "elapsed": round(elapsed, 3),
+            "interval": round(self.current_interval, 6),
+            "overhead": round(self.sampling_time / elapsed, 5) if elapsed else 0.0,
+            "top_self": [
+                {"function": function, "samples": count}
+                for function, count in sorted(own.items(), key=lambda item: -item[1])[:top]
+            ],
+            "top_total": [
+                {"function": function, "samples": count}
+                for function, count in sorted(total.items(), key=lambda item: -item[1])[:top]
+            ],
+        }
+
+    async def handle_start(self, request):
+        """Start a profile (``POST /admin/profile/start?duration=30&interval=0.01``)."""
+        duration = _query_float(request, "duration", 30)
+        interval = _query_float(request, "interval", self.interval)
+        try:
+            self.start(duration, interval)
+        except RuntimeError as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=409)
+        return web.json_response(self.summary(), status=202)
+
+    async def handle_stop(self, request):
+        """Stop the running profile early and return its summary."""
+        await asyncio.get_running_loop().run_in_executor(None, self.stop)
+        return web.json_response(self.summary())
+
+    async def handle_summary(self, request):
+        """Status of the current or last profile, with its top functions."""
+        return web.json_response(self.summary(int(_query_float(request, "top", 20))))
+
+    async def handle_download(self, request):
+        """Download the current or last profile as collapsed stacks."""
+        if not self.samples:
+            return web.json_response({"status": "error", "message": "No samples recorded."}, status=404)
+        return _download(self.collapsed(), "profile.folded")
+
+
+class MemorySnapshots:
+    """
+    tracemalloc snapshots of the broker's heap, kept in memory by ID so
+    that any two can be compared. Tracing slows allocation down noticeably,
+    so it only runs between ``start`` and ``stop``; only the last ``keep``
+    snapshots are retained.
+    """
+
+    def __init__(self, keep=5):
+        """
+        :param keep: Snapshots retained; older ones are discarded.
+        """
+        self.keep = keep
+        self.snapshots = {}  # Snapshot ID -> tracemalloc.Snapshot
+        self.next_id = 1
+
+    @staticmethod
+    def _filtered(snapshot):
+        """Drop allocations made by tracemalloc and the import machinery."""
+        return snapshot.filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+                tracemalloc.Filter(False, "<unknown>"),
+            )
+        )
+
+    def take(self):
+        """Take a snapshot (blocking) and return its ID."""
+        snapshot = self._filtered(tracemalloc.take_snapshot())
+        snapshot_id = self.next_id
+        self.next_id += 1
+        self.snapshots[snapshot_id] = snapshot
+        for old in sorted(self.snapshots)[: -self.keep]:
+            del self.snapshots[old]
+        return snapshot_id
+
+    def report(self, snapshot_id, key_type="lineno", limit=50):
+        """Largest allocation sites of one snapshot, as text."""
+        stats = self.snapshots[snapshot_id].statistics(key_type)
+        lines = [f"Snapshot {snapshot_id}: {sum(stat.size for stat in stats)} bytes in {len(stats)} sites"]
+        lines.extend(self._format(stat, key_type) for stat in stats[:limit])
+        return "\n".join(lines) + "\n"
+
+    def diff(self, from_id, to_id, key_type="lineno", limit=50):
+        """Allocation sites that grew (or shrank) the most between two snapshots, as text."""
+        stats = self.snapshots[to_id].compare_to(self.snapshots[from_id], key_type)
+        lines = [
+            f"Snapshot {from_id} -> {to_id}: "
+            f"{sum(stat.size_diff for stat in stats):+d} bytes, {sum(stat.count_diff for stat in stats):+d} blocks"
+        ]
+        lines.extend(self._format(stat, key_type) for stat in stats[:limit])
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _format(stat, key_type):
+        if key_type == "traceback":
+            return "\n".join([str(stat)] + [f"    {line}" for line in stat.traceback.format()])
+        return str(stat)
+
+    async def handle_start(self, request):
+        """Start tracing allocations (``POST /admin/tracemalloc/start?frames=10``)."""
+        frames = int(_query_float(request, "frames", 10))
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(max(1, frames))
+            logging.info(f"tracemalloc started ({frames} frames).")
+        return web.json_response({"tracing": True, "frames": tracemalloc.get_traceback_limit()})
+
+    async def handle_stop(self, request):
+        """Stop tracing allocations; taken snapshots are kept."""
+        tracemalloc.stop()
+        logging.info("tracemalloc stopped.")
+        return web.json_response({"tracing": False, "snapshots": sorted(self.snapshots)})
+
+    async def handle_snapshot(self, request):
+        """Take a snapshot and return its ID with the top allocation sites."""
+        if not tracemalloc.is_tracing():
+            return web.json_response(
+                {"status": "error", "message": "tracemalloc is not running."}, status=409
+            )
+        current, peak = tracemalloc.get_traced_memory()
+        loop = asyncio.get_running_loop()
+        snapshot_id = await loop.run_in_executor(None, self.take)
+        stats = self.snapshots[snapshot_id].statistics("lineno")[:10]
+        return web.json_response(
+            {
+                "id": snapshot_id,
+                "traced_bytes": current,
+                "peak_bytes": peak,
+                "snapshots": sorted(self.snapshots),
+                "top": [str(stat) for stat in stats],
+            }
+        )
+
+    def _lookup(self, name, value):
+        try:
+            snapshot_id = int(value)
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text=f"Invalid {name}: {value}")
+        if snapshot_id not in self.snapshots:
+            raise web.HTTPNotFound(text=f"No snapshot {snapshot_id}; have {sorted(self.snapshots)}")
+        return snapshot_id
+
+    def _key_type(self, request):
+        key_type = request.query.get("group_by", "lineno")
+        if key_type not in ("lineno", "filename", "traceback"):
+            raise web.HTTPBadRequest(text=f"Invalid group_by: {key_type}")
+        return key_type
+
+    async def handle_report(self, request):
+        """Download one snapshot's allocation sites (``GET /admin/tracemalloc/snapshots/{id}``)."""
+        snapshot_id = self._lookup("id", request.match_info["snapshot_id"])
+        text = await asyncio.get_running_loop().run_in_executor(
+            None,
+            self.report,
+            snapshot_id,
+            self._key_type(request),
+            int(_query_float(request, "limit", 50)),
+        )
+        return _download(text, f"tracemalloc-{snapshot_id}.txt")
+
+    async def handle_diff(self, request):
+        """Download the difference between two snapshots (``GET /admin/tracemalloc/diff?from=1&to=2``)."""
+        if not self.snapshots:
+            raise web.HTTPNotFound(text="No snapshots taken.")
+        from_id = self._lookup("from", request.query.get("from", min(self.snapshots)))
+        to_id = self._lookup("to", request.query.get("to", max(self.snapshots)))
+        text = await asyncio.get_running_loop().run_in_executor(
+            None,
+            self.diff,
+            from_id,
+            to_id,
+            self._key_type(request),
+            int(_query_float(request, "limit", 50)),
+        )
+        return _download(text, f"tracemalloc-{from_id}-{to_id}.txt")
+
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag: how much later than scheduled a timer fires.
+    Lag means some callback held the loop, so every request waited that long.
+    Each measurement goes to the ``broker_event_loop_lag_seconds`` histogram
+    and to a window of recent samples for ``/admin/loop_lag``.
+    """
+
+    def __init__(self, interval=0.1, window=3000):
+        """
+        :param interval: Seconds between measurements.
+        :param window: Recent measurements kept (300 s at the default interval).
+        """
+        self.interval = interval
+        self.recent = deque(maxlen=window)  # (wall time, lag in seconds)
+
+    async def start(self):
+        """Measure lag until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG_SECONDS.observe(lag)
+            self.recent.append((time.time(), lag))
+            if lag > 1.0:
+                logging.warning(
+                    "Event loop blocked for %.3fs.", lag, extra=logger_config.RATE_LIMITED
+                )
+
+    def stats(self, worst=5):
+        """Lag statistics over the recent window, in milliseconds."""
+        lags = sorted(lag for _, lag in self.recent)
+        if not lags:
+            return {"samples": 0}
+
+        def at(pct):
+            return round(lags[min(len(lags) - 1, int(len(lags) * pct / 100))] * 1000, 3)
+
+        return {
+            "samples": len(lags),
+            "window_seconds": round(self.recent[-1][0] - self.recent[0][0], 1),
+            "mean_ms": round(sum(lags) / len(lags) * 1000, 3),
+            "p50_ms": at(50),
+            "p99_ms": at(99),
+            "max_ms": round(lags[-1] * 1000, 3),
+            "worst": [
+                {"time": round(when, 3), "lag_ms": round(lag * 1000, 3)}
+                for when, lag in sorted(self.recent, key=lambda sample: -sample[1])[:worst]
+            ],
+        }
+
+    async def handle_stats(self, request):
+        """Endpoint reporting recent event loop lag."""
+        return web.json_response(self.stats())
+
+
+def task_stacks(limit=20):
+    """Dump the stack of every asyncio task of the running loop, as text."""
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+    out = io.StringIO()
+    out.write(f"{len(tasks)} tasks\n\n")
+    for task in tasks:
+        out.write(f"{task!r}\n")
+        task.print_stack(limit=limit, file=out)
+        out.write("\n")
+    return out.getvalue()
+
+
+async def handle_tasks(request):
+    """Download the stacks of all asyncio tasks (``GET /admin/tasks``)."""
+    return _download(task_stacks(int(_query_float(request, "limit", 20))), "tasks.txt")
@@ -1,111 +1,449 @@
 # File: registry.py
 
-from flask import Flask, request, jsonify
+import argparse
+import asyncio
 import logging
-import requests
+import time
+from collections import deque
+from urllib.parse import quote
+import aiohttp
+from aiohttp import web
+from routing import POLICIES, BrokerLoad
+from metrics import REGISTRY
 from util import logger_config
 
 logger_config.setup_logger()
 
-app = Flask(__name__)
-
 # In-memory membership list
 members = set()
 
+# Base URL each broker advertised when it registered
+addresses = {}
+
+# Versioned change log of the membership list, for delta feeds
+members_version = 0
+member_changes = deque(maxlen=1024)  # {"version", "broker_id", "change"} entries
+
+# Longest a /members long-poll may wait, in seconds
+MAX_MEMBERS_WAIT = 60
+
+# Latest load report per broker ID
+loads = {}
+
+# Requests currently proxied to each broker ID
+proxied = {}
+
+# Metrics served on /metrics; gauges are read at scrape time
+REQUEST_SECONDS = REGISTRY.histogram(
+    "registry_request_seconds",
+    "Handler latency by route; /dcnews includes the proxied broker request.",
+    ("route",),
+)
+REGISTRY.gauge("registry_members", "Registered brokers.", lambda: len(members))
+REGISTRY.gauge(
+    "registry_proxied_requests",
+    "Requests currently proxied to each broker.",
+    lambda: {(str(broker_id),): count for broker_id, count in proxied.items()},
+    ("broker",),
+)
+
+# Headers that describe a single hop and must not be copied through the proxy
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "content-length",
+    "host",
+    "upgrade",
+}
+
+# Headers only brokers may send each other (peers.PEER_HEADER and
+# SIGNATURE_HEADERS); never passed on from clients
+PEER_ONLY_HEADERS = {
+    "x-broker-id",
+    "x-broker-auth",
+    "x-broker-timestamp",
+    "x-broker-nonce",
+    "x-broker-content-sha256",
+}
 
-@app.route("/register", methods=["POST"])
-def register():
-    """Register a new broker."""
+
+async def register(request):
+    """
+    Register a new broker.
+
+    Expected JSON payload:
+    {
+        "broker_id": int,
+        "address": str  # Optional base URL peers and the proxy use to reach it
+    }
+    """
     try:
-        data = request.json
+        data = await request.json()
         broker_id = data.get("broker_id")
         if broker_id:
+            address = data.get("address")
+            moved = address is not None and addresses.get(broker_id) != address
+            if address:
+                addresses[broker_id] = address
             if broker_id not in members:
                 members.add(broker_id)
-                logging.info(f"Broker {broker_id} registered successfully.")
-                return "Registered", 200
+                record_member_change(request.app, broker_id, "join")
+                logging.info(f"Broker {broker_id} registered successfully at {broker_address(broker_id)}.")
+                return web.Response(text="Registered")
             else:
+                if moved:
+                    # Re-announce so followers of the feed learn the new address
+                    record_member_change(request.app, broker_id, "join")
                 logging.info(f"Broker {broker_id} is already registered.")
-                return "Already Registered", 200
+                return web.Response(text="Already Registered")
         else:
             logging.warning("Invalid registration request: 'broker_id' missing.")
-            return "Bad Request: 'broker_id' is required", 400
-    except Exception as e:
+            return web.Response(text="Bad Request: 'broker_id' is required", status=400)
+    except Exception:
         logging.exception("Error during registration:")
-        return "Internal Server Error", 500
+        return web.Response(text="Internal Server Error", status=500)
 
 
-@app.route("/remove/<int:broker_id>", methods=["DELETE"])
-def remove_broker(broker_id):
+async def remove_broker(request):
     """Remove a broker from the registry."""
     try:
+        broker_id = int(request.match_info["broker_id"])
         if broker_id in members:
             members.remove(broker_id)
+            addresses.pop(broker_id, None)
+            record_member_change(request.app, broker_id, "leave")
             logging.info(f"Broker {broker_id} removed from registry.")
-            return f"Broker {broker_id} removed", 200
+            return web.Response(text=f"Broker {broker_id} removed")
         else:
             logging.warning(f"Remove failed: Broker {broker_id} not found.")
-            return "Broker not found", 404
-    except Exception as e:
+            return web.Response(text="Broker not found", status=404)
+    except Exception:
         logging.exception("Error during broker removal:")
-        return "Internal Server Error", 500
+        return web.Response(text="Internal Server Error", status=500)
+
+
+async def report_load(request):
+    """
+    Record a broker's load report.
+
+    Expected JSON payload:
+    {
+        "broker_id": int,
+        "address": str,
+        "in_flight": int,
+        "queue_depth": int,
+        "p99_ms": float
+    }
+    """
+    try:
+        data = await request.json()
+        broker_id = data.get("broker_id")
+        if not broker_id:
+            return web.Response(text="Bad Request: 'broker_id' is required", status=400)
+        loads[int(broker_id)] = BrokerLoad(
+            broker_id,
+            address=data.get("address"),
+            in_flight=data.get("in_flight", 0),
+            queue_depth=data.get("queue_depth", 0),
+            p99_ms=data.get("p99_ms", 0.0),
+        )
+        return web.Response(text="Recorded")
+    except Exception:
+        logging.exception("Error recording load report:")
+        return web.Response(text="Internal Server Error", status=500)
+
+
+def fresh_loads(max_age):
+    """Return the load reports of current members that are newer than ``max_age`` seconds."""
+    now = time.monotonic()
+    fresh = {
+        broker_id: load
+        for broker_id, load in loads.items()
+        if broker_id in members and now - load.reported_at <= max_age
+    }
+    for broker_id, load in fresh.items():
+        load.pending = proxied.get(broker_id, 0)
+    return fresh
+
+
+def broker_address(broker_id):
+    """Return the advertised address of a broker, or the default port mapping."""
+    if broker_id in addresses:
+        return addresses[broker_id]
+    load = loads.get(broker_id)
+    if load and load.address:
+        return load.address
+    return f"http://localhost:{3000 + broker_id - 1}"  # Assuming brokers run on ports 3000, 3001, etc.
+
+
+def record_member_change(app, broker_id, change):
+    """
+    Append a join or leave to the change log and wake waiting long-polls.
+
+    :param change: Either "join" or "leave".
+    """
+    global members_version
+    members_version += 1
+    member_changes.append(
+        {"version": members_version, "broker_id": broker_id, "change": change}
+    )
+    # Wake every waiter at once, then start a fresh event for the next change
+    app["members_changed"].set()
+    app["members_changed"] = asyncio.Event()
+
+
+def members_delta(since):
+    """
+    Summarize membership changes after version ``since``.
 
+    Falls back to the full list (``reset``) when the change log no longer
+    reaches back that far, or when ``since`` is from before a registry restart.
+    Advertised addresses of the listed brokers are included.
+    """
+    oldest = member_changes[0]["version"] if member_changes else members_version + 1
+    if since > members_version or since < oldest - 1:
+        return {
+            "version": members_version,
+            "reset": True,
+            "members": list(members),
+            "addresses": {b: addresses[b] for b in members if b in addresses},
+        }
+
+    latest = {}  # Broker ID -> last change after ``since``
+    for entry in member_changes:
+        if entry["version"] > since:
+            latest[entry["broker_id"]] = entry["change"]
+    joined = [b for b, change in latest.items() if change == "join"]
+    return {
+        "version": members_version,
+        "reset": False,
+        "joined": joined,
+        "left": [b for b, change in latest.items() if change == "leave"],
+        "addresses": {b: addresses[b] for b in joined if b in addresses},
+    }
+
+
+async def get_members(request):
+    """
+    Retrieve the current list of registered brokers.
 
-@app.route("/members", methods=["GET"])
-def get_members():
-    """Retrieve the current list of registered brokers."""
+    Without parameters the full list is returned. With ``since=<version>``
+    only the joins and leaves after that version are returned, together with
+    the current version. ``wait=<seconds>`` turns the request into a
+    long-poll that answers as soon as the membership moves past ``since``.
+    """
     try:
-        logging.info("Membership list fetched successfully.")
-        return jsonify(list(members)), 200
-    except Exception as e:
+        if "since" not in request.query:
+            logging.debug("Membership list fetched successfully.")
+            return web.json_response(list(members))
+
+        try:
+            since = int(request.query["since"])
+            wait = min(float(request.query.get("wait", 0)), MAX_MEMBERS_WAIT)
+        except ValueError:
+            return web.Response(text="Bad Request: 'since' and 'wait' must be numbers", status=400)
+
+        if since == members_version and wait > 0:
+            changed = request.app["members_changed"]
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response(members_delta(since))
+    except Exception:
         logging.exception("Error fetching membership list:")
-        return "Internal Server Error", 500
+        return web.Response(text="Internal Server Error", status=500)
+
+
+async def proxy(request, target_url, params=None):
+    """
+    Forward a request to a broker over the pooled client and stream the
+    response back without parsing it.
+
+    :param request: Incoming request; its body is streamed upstream as-is.
+    :param target_url: Broker URL to forward to.
+    :param params: Query parameters for the upstream request.
+    """
+    session = request.app["client_session"]
+    headers = {
+        name: value
+        for name, value in request.headers.items()
+        if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() not in PEER_ONLY_HEADERS
+    }
+    # Brokers rate limit publishers by client address
+    forwarded = request.headers.get("X-Forwarded-For")
+    headers["X-Forwarded-For"] = f"{forwarded}, {request.remote}" if forwarded else request.remote
+    body = request.content if request.can_read_body else None
+    async with session.request(
+        request.method, target_url, params=params, headers=headers, data=body
+    ) as upstream:
+        response = web.StreamResponse(
+            status=upstream.status,
+            headers={
+                name: value
+                for name, value in upstream.headers.items()
+                if name.lower() not in HOP_BY_HOP_HEADERS
+            },
+        )
+        if upstream.content_length is not None:
+            response.content_length = upstream.content_length
+        await response.prepare(request)
+        async for chunk in upstream.content.iter_any():
+            await response.write(chunk)
+        await response.write_eof()
+        return response
 
 
-@app.route("/dcnews", methods=["POST", "GET"])
-def dcnews():
+async def dcnews(request):
     """
     Entry API for redirecting to publish and subscribe endpoints.
 
-    - POST request: Redirect to the publish endpoint of the broker with the max ID.
-    - GET request: Redirect to the subscribe endpoint of the broker with the max ID.
+    - POST request: Proxy to the publish endpoint of the chosen broker.
+    - GET request: Proxy to the subscribe endpoint of the chosen broker.
+
+    The broker is picked by the configured routing policy from the brokers'
+    load reports. For topic affinity on publishes, pass the topic as a
+    ``topic`` query parameter or ``X-Topic`` header; the body is not parsed.
+    A broker that refuses the connection is skipped for the next candidate.
     """
     if not members:
         logging.error("No active brokers available for redirection.")
-        return jsonify({"error": "No active brokers available"}), 503
-
-    # Get the broker with the maximum ID
-    max_broker_id = max(members)
-    broker_host = f"localhost:300{max_broker_id-1}"  # Assuming brokers run on ports 5001, 5002, etc.
-    logging.info(f"Redirecting request to Broker {max_broker_id} at {broker_host}")
+        return web.json_response({"error": "No active brokers available"}, status=503)
 
+    topic = request.query.get("topic") or request.headers.get("X-Topic")
     if request.method == "POST":
         # Redirect to the publish endpoint
-        target_url = f"http://{broker_host}/publish"
-        try:
-            response = requests.post(target_url, json=request.json)
-            response.raise_for_status()
-            return jsonify(response.json()), response.status_code
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Failed to redirect publish request to {target_url}: {e}")
-            return jsonify({"error": "Failed to process publish request"}), 500
-
-    elif request.method == "GET":
+        path = "/publish"
+        params = None
+        action = "publish"
+    else:
         # Redirect to the subscribe endpoint
-        topic = request.args.get("topic")
         if not topic:
             logging.error("Missing 'topic' parameter in subscription request.")
-            return jsonify({"error": "Missing 'topic' parameter"}), 400
-        target_url = f"http://{broker_host}/data/{topic}"
+            return web.json_response({"error": "Missing 'topic' parameter"}, status=400)
+        if topic in (".", ".."):
+            return web.json_response({"error": "Invalid 'topic' parameter"}, status=400)
+        # Escaped into one path segment, so a topic cannot reach other broker routes
+        path = f"/data/{quote(topic, safe='')}"
+        params = {k: v for k, v in request.query.items() if k != "topic"}
+        action = "subscribe"
+
+    candidates = sorted(members)
+    while True:
+        broker_id = request.app["routing_policy"].choose(
+            candidates, fresh_loads(request.app["load_max_age"]), topic
+        )
+        target_url = f"{broker_address(broker_id)}{path}"
+        logging.debug(f"Redirecting request to Broker {broker_id} at {target_url}")
+
+        proxied[broker_id] = proxied.get(broker_id, 0) + 1
         try:
-            response = requests.get(target_url)
-            response.raise_for_status()
-            return jsonify(response.json()), response.status_code
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Failed to redirect subscribe request to {target_url}: {e}")
-            return jsonify({"error": "Failed to process subscribe request"}), 500
+            return await proxy(request, target_url, params)
+        except aiohttp.ClientConnectorError as e:
+            # Nothing reached the broker, so the body is unread and the
+            # request can go to the next candidate
+            candidates.remove(broker_id)
+            if not candidates:
+                logging.error(f"Failed to redirect {action} request to {target_url}: {e}")
+                return web.json_response(
+                    {"error": f"No reachable brokers for {action} request"}, status=503
+                )
+            logging.warning(f"Broker {broker_id} unreachable for {action} request, retrying: {e}")
+        except asyncio.TimeoutError:
+            logging.error(f"Timed out redirecting {action} request to {target_url}")
+            return web.json_response(
+                {"error": f"Timed out processing {action} request"}, status=504
+            )
+        except aiohttp.ClientError as e:
+            logging.error(f"Failed to redirect {action} request to {target_url}: {e}")
+            return web.json_response(
+                {"error": f"Failed to process {action} request"}, status=500
+            )
+        finally:
+            proxied[broker_id] -= 1
+
+
+async def start_member_feed(app):
+    """Create the event /members long-polls wait on, on the running loop."""
+    app["members_changed"] = asyncio.Event()
+
+
+async def start_client_session(app):
+    """Create the pooled keep-alive client used for proxying."""
+    app["client_session"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=app["pool_size"]),
+        timeout=aiohttp.ClientTimeout(total=app["proxy_timeout"]),
+        auto_decompress=False,  # Pass compressed bodies through untouched
+    )
+
+
+async def close_client_session(app):
+    """Close the proxy client on shutdown."""
+    await app["client_session"].close()
+
+
+def create_app(proxy_timeout=5, pool_size=200, routing_policy="least_loaded", load_max_age=10):
+    """
+    Initialize the registry application and add routes.
+
+    :param proxy_timeout: Deadline in seconds for each proxied request.
+    :param pool_size: Maximum pooled connections to brokers.
+    :param routing_policy: Name of the /dcnews routing policy (see routing.POLICIES).
+    :param load_max_age: Seconds after which a broker's load report is ignored.
+    """
+    app = web.Application(middlewares=[REGISTRY.middleware(REQUEST_SECONDS)])
+    app["proxy_timeout"] = proxy_timeout
+    app["pool_size"] = pool_size
+    app["routing_policy"] = POLICIES[routing_policy]()
+    app["load_max_age"] = load_max_age
+    app.router.add_post("/register", register)
+    app.router.add_delete("/remove/{broker_id:\\d+}", remove_broker)
+    app.router.add_get("/members", get_members)
+    app.router.add_post("/load", report_load)
+    app.router.add_get("/metrics", REGISTRY.handle_metrics)
+    app.router.add_route("GET", "/dcnews", dcnews)
+    app.router.add_route("POST", "/dcnews", dcnews)
+    app.on_startup.append(start_member_feed)
+    app.on_startup.append(start_client_session)
+    app.on_cleanup.append(close_client_session)
+    return app
 
 
 if __name__ == "__main__":
-    logging.info("Starting Registry Service on port 4000...")
-    app.run(host="0.0.0.0", port=4000)
+    parser = argparse.ArgumentParser(description="Start the registry service.")
+    parser.add_argument("--port", type=int, default=4000, help="Port to run the registry on")
+    parser.add_argument(
+        "--proxy_timeout",
+        type=float,
+        default=5,
+        help="Deadline in seconds for each request proxied through /dcnews",
+    )
+    parser.add_argument(
+        "--routing_policy",
+        choices=sorted(POLICIES),
+        default="least_loaded",
+        help="How /dcnews picks a broker",
+    )
+    parser.add_argument(
+        "--log_level",
+        type=str,
+        default=None,
+        help="Default log level (default: LOG_LEVEL env, else INFO)",
+    )
+    parser.add_argument(
+        "--log_levels",
+        type=str,
+        default=None,
+        help="Per-module log levels, e.g. registry=DEBUG (adds to LOG_LEVELS env)",
+    )
+    args = parser.parse_args()
+    logger_config.configure_levels(args.log_level, args.log_levels)
+
+    logging.info(f"Starting Registry Service on port {args.port}...")
+    web.run_app(
+        create_app(proxy_timeout=args.proxy_timeout, routing_policy=args.routing_policy),
+        host="0.0.0.0",
+        port=args.port,
+        access_log=None,
+    )
@@ -3,16 +3,41 @@
 import asyncio
 from util import logger_config
 import logging
-import aiohttp
 import json
+import time
+from partitioning import ConsistentHashRing
+from peers import PeerDirectory
+from metrics import REGISTRY
+from tracing import TRACEPARENT, Tracer
+from compression import BATCH_CONTENT_TYPE, pack_messages
+
+REPLICATION_RTT = REGISTRY.histogram(
+    "broker_replication_rtt_seconds",
+    "Round trip of replication requests to a peer, by peer broker ID.",
+    ("peer",),
+)
 
 class DataReplication:
-    def __init__(self, data_store, broker_id, port, config_file=None):
+    def __init__(
+        self,
+        data_store,
+        broker_id,
+        port,
+        config_file=None,
+        retry_interval=1,
+        liveness=None,
+        directory=None,
+        tracer=None,
+    ):
         """
         :param data_store: Local data store for the broker
         :param broker_id: ID of the current broker
         :param port: Local port for this broker
         :param config_file: Optional configuration file for the spanning tree
+        :param retry_interval: Delay in seconds before re-queueing a failed retry
+        :param liveness: Optional Heartbeat tracker refreshed by successful replications
+        :param directory: PeerDirectory used to reach peers
+        :param tracer: Tracer recording send and retry-queue spans
         """
         self.data_store = data_store
         self.broker_id = broker_id
@@ -21,6 +46,11 @@ class DataReplication:
         self.spanning_tree = {}  # Store the spanning tree
         self.config_file = config_file or "spanning_tree.json"  # Config file for static spanning tree
         self.failed_queue = asyncio.Queue()  # Queue for failed replication attempts
+        self.retry_interval = retry_interval
+        self.liveness = liveness
+        self.handoffs_in_progress = 0
+        self.directory = directory or PeerDirectory(broker_id)
+        self.tracer = tracer or Tracer(f"broker-{broker_id}")
 
     async def build_spanning_tree(self):
         """Build a spanning tree from the peers and config file (if provided)."""
@@ -62,51 +92,220 @@ class DataReplication:
         else:
             logging.warning("No peers available to construct spanning tree.")
 
-    async def replicate_message(self, topic, message, message_id):
-        """Replicate the message to all peers using the spanning tree."""
+    async def replicate_message(
+        self, topic, message, message_id, partition=None, replicas=None, sequence=None, trace=None
+    ):
+        """
+        Replicate the message to the brokers holding its partition.
+
+        :param partition: Partition of the topic the message belongs to.
+        :param replicas: Broker IDs owning the partition; all peers when None.
+        :param sequence: Topic-wide sequence number assigned to the message.
+        :param trace: Span (or traceparent) of the message on this broker.
+        """
         logging.debug(
-            f"Attempting to replicate message '{message}' for topic '{topic}' with ID {message_id}"
+            "Replicating message %s of topic '%s'", message_id, topic, extra=logger_config.RATE_LIMITED
         )
 
-        # Start the multicast/broadcast process using the spanning tree
-        for peer in self.peers:
-            try:
-                await self.send_to_peer(peer, topic, message, message_id)
-            except Exception as e:
+        targets = self.peers if replicas is None else [
+            peer for peer in replicas if peer != self.broker_id
+        ]
+        for peer in targets:
+            if not await self._send_traced(peer, topic, message, message_id, partition, sequence, trace):
                 logging.warning(f"Replication to {peer} failed. Adding to retry queue.")
-                await self.failed_queue.put((peer, topic, message, message_id))
+                await self._enqueue_retry(peer, topic, message, message_id, partition, sequence, trace)
+
+    async def _send_traced(self, peer, topic, message, message_id, partition, sequence, trace, retry=False):
+        """Send a replica inside a ``send`` span; True if the peer stored it."""
+        span = self.tracer.start_span("send", trace, kind="CLIENT", peer=peer, retry=retry)
+        try:
+            await self.send_to_peer(
+                peer, topic, message, message_id, partition, sequence, span.traceparent
+            )
+        except Exception as e:
+            span.finish(error=str(e) or type(e).__name__)
+            return False
+        span.finish()
+        return True
+
+    async def _enqueue_retry(self, peer, topic, message, message_id, partition, sequence, trace):
+        """Queue a replica for retry; its ``enqueue`` span lasts until it is picked up."""
+        waiting = self.tracer.start_span("enqueue", trace, peer=peer, depth=self.failed_queue.qsize())
+        await self.failed_queue.put((peer, topic, message, message_id, partition, sequence, waiting))
 
     async def retry_failed_replications(self):
         """Retry replication for failed messages."""
         while True:
-            peer, topic, message, message_id = await self.failed_queue.get()
-            try:
-                await self.send_to_peer(peer, topic, message, message_id)
-            except Exception:
+            peer, topic, message, message_id, partition, sequence, waiting = await self.failed_queue.get()
+            waiting.finish()
+            if peer not in self.peers:
+                logging.info(f"Dropping retry for departed peer {peer}.")
+                continue
+            if not await self._send_traced(
+                peer, topic, message, message_id, partition, sequence, waiting, retry=True
+            ):
                 # If it fails again, re-add to the queue
                 logging.warning(f"Retry failed for {peer}. Re-adding to queue.")
-                await self.failed_queue.put((peer, topic, message, message_id))
+                await asyncio.sleep(self.retry_interval)
+                await self._enqueue_retry(peer, topic, message, message_id, partition, sequence, waiting)
+
+    async def send_to_peer(
+        self, peer, topic, message, message_id, partition=None, sequence=None, traceparent=None
+    ):
+        """
+        Send a replica of a message to a peer broker.
+
+        Raises on failure so the caller can queue the message for retry.
+        """
+        await self.send_batch_to_peer(
+            peer,
+            topic,
+            [
+                {
+                    "message": message,
+                    "message_id": message_id,
+                    "partition": partition,
+                    "sequence": sequence,
+                    TRACEPARENT: traceparent,
+                }
+            ],
+        )
+
+    async def replicate_batch(self, topic, entries, replicas):
+        """
+        Replicate a batch of messages of one topic to the brokers owning them.
+        The batch goes out as one request per peer; if that fails, every
+        message in it is queued for individual retry.
+
+        :param entries: List of dicts with message, message_id, partition,
+                        sequence and the traceparent of the message on this broker.
+        :param replicas: Broker IDs owning the partitions of every entry.
+        :return: List of the peers that acknowledged the batch.
+        """
+        delivered = []
+        for peer in [peer for peer in replicas if peer != self.broker_id]:
+            # One send span per message, so each message's trace shows the batch
+            spans = [
+                self.tracer.start_span("send", entry.get(TRACEPARENT), kind="CLIENT", peer=peer, batch=len(entries))
+                for entry in entries
+            ]
+            try:
+                await self.send_batch_to_peer(
+                    peer,
+                    topic,
+                    [{**entry, TRACEPARENT: span.traceparent} for entry, span in zip(entries, spans)],
+                )
+            except Exception as e:
+                for span in spans:
+                    span.finish(error=str(e) or type(e).__name__)
+                logging.warning(
+                    f"Batch replication to {peer} failed ({e}). Adding {len(entries)} messages to retry queue."
+                )
+                for entry in entries:
+                    await self._enqueue_retry(
+                        peer,
+                        topic,
+                        entry["message"],
+                        entry["message_id"],
+                        entry["partition"],
+                        entry.get("sequence"),
+                        entry.get(TRACEPARENT),
+                    )
+                continue
+            for span in spans:
+                span.finish()
+            delivered.append(peer)
+        return delivered
 
-    async def send_to_peer(self, peer, topic, message, message_id):
-        """Send a message to a peer broker."""
+    async def send_batch_to_peer(self, peer, topic, entries):
+        """
+        Send a batch of replicas to a peer broker, raising on failure.
+        Compressed messages go out as raw bytes (see ``compression.pack_messages``).
+        """
+        started = time.perf_counter()
+        async with self.directory.session(peer).post(
+            self.directory.url(peer, "/publish_batch"),
+            data=pack_messages({"topic": topic, "replicated": True}, entries),
+            headers={"Content-Type": BATCH_CONTENT_TYPE},
+        ) as response:
+            REPLICATION_RTT.observe(time.perf_counter() - started, str(peer))
+            if response.status != 200:
+                raise Exception(
+                    f"Failed to replicate batch to {peer} (HTTP {response.status})"
+                )
+            logging.debug(
+                "Successfully replicated %d messages to %s",
+                len(entries),
+                peer,
+                extra=logger_config.RATE_LIMITED,
+            )
+            if self.liveness:
+                self.liveness.record_contact(peer)
+
+    async def hand_off_partitions(self, placement, previous_members):
+        """
+        Copy locally held partitions to brokers that became replicas after a
+        membership change. Only the first surviving previous replica pushes,
+        so each moved partition is transferred once. Once every new replica
+        has acknowledged its copy, the previous replicas that no longer own
+        the partition delete theirs.
+
+        :param placement: PartitionPlacement reflecting the new membership.
+        :param previous_members: Ring members before the change.
+        """
+        self.handoffs_in_progress += 1
         try:
-            peer_port = 3000 + int(peer) - 1  # Assuming ports start from 3000
-            url = f"http://broker-{peer}:{peer_port}/publish"
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    json={"topic": topic, "message": message, "message_id": message_id},
-                ) as response:
-                    if response.status != 200:
-                        logging.error(
-                            f"Failed to replicate to {peer} (HTTP {response.status})"
-                        )
+            await self._hand_off(placement, previous_members)
+        finally:
+            self.handoffs_in_progress -= 1
+
+    async def _hand_off(self, placement, previous_members):
+        """Push every local partition whose replica set gained brokers, and prune the ones it lost."""
+        previous_ring = ConsistentHashRing(
+            previous_members, virtual_nodes=placement.ring.virtual_nodes
+        )
+        # Topics are listed by table name, which is also what placement hashes
+        for topic in self.data_store.list_topics():
+            for partition in self.data_store.list_partitions(topic):
+                old_replicas = placement.replicas_for(topic, partition, ring=previous_ring)
+                new_replicas = placement.replicas_for(topic, partition)
+                survivors = [b for b in old_replicas if b in placement.ring.nodes]
+                if not survivors or survivors[0] != self.broker_id:
+                    continue
+                targets = [b for b in new_replicas if b not in old_replicas]
+                losers = [b for b in survivors if b not in new_replicas]
+                if targets:
+                    records = self.data_store.get_records(topic, partition, batch_size=None)
+                    logging.info(
+                        f"Handing off {len(records)} messages of {topic}/{partition} to {targets}"
+                    )
+                    # The whole transfer is one trace rather than one per message
+                    with self.tracer.start_span(
+                        "handoff", topic=topic, partition=partition, messages=len(records)
+                    ) as span:
+                        for record in records:
+                            record[TRACEPARENT] = span.traceparent
+                        delivered = await self.replicate_batch(topic, records, targets)
+                    if len(delivered) < len(targets):
+                        # Retries will complete the copy; keep the old ones until then
+                        continue
+                for peer in losers:
+                    if peer == self.broker_id:
+                        self.data_store.delete_partition(topic, partition)
                     else:
-                        logging.info(
-                            f"Successfully replicated to {peer} (HTTP {response.status})"
-                        )
+                        await self.request_prune(peer, topic, partition)
+
+    async def request_prune(self, peer, topic, partition):
+        """Ask a previous replica to delete its copy of a partition that moved away from it."""
+        try:
+            async with self.directory.session(peer).post(
+                self.directory.url(peer, "/partitions/prune"),
+                json={"topic": topic, "partition": partition},
+            ) as response:
+                if response.status != 200:
+                    logging.info(f"Broker {peer} kept {topic}/{partition} (HTTP {response.status})")
         except Exception as e:
-            logging.error(f"Unexpected error replicating to Broker {peer}: {e}")
+            logging.warning(f"Asking Broker {peer} to prune {topic}/{partition} failed: {e}")
 
     async def start_background_tasks(self, app):
         """Start background tasks for retrying failed replications."""
@@ -122,3 +321,14 @@ class DataReplication:
         self.peers = [int(peer) for peer in peers if peer]
         logging.info(f"Updated peer list: {self.peers}")
         self.build_dynamic_spanning_tree()
+
+    def apply_membership_delta(self, joined, left):
+        """Add and remove individual peers without rebuilding the peer list."""
+        left = {int(peer) for peer in left}
+        self.peers = [peer for peer in self.peers if peer not in left]
+        for peer in joined:
+            peer = int(peer)
+            if peer != int(self.broker_id) and peer not in self.peers:
+                self.peers.append(peer)
+        logging.info(f"Peers joined: {sorted(joined)}, left: {sorted(left)}")
+        self.build_dynamic_spanning_tree()
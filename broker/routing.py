@@ -0,0 +1,106 @@
+# File: routing.py
+
+import hashlib
+import random
+import time
+
+
+class BrokerLoad:
+    """Latest load report from one broker."""
+
+    def __init__(self, broker_id, address=None, in_flight=0, queue_depth=0, p99_ms=0.0):
+        """
+        :param broker_id: ID of the reporting broker.
+        :param address: Advertised base URL of the broker.
+        :param in_flight: Requests currently being handled.
+        :param queue_depth: Messages waiting in the replication retry queue.
+        :param p99_ms: 99th percentile handler latency over the last window.
+        """
+        self.broker_id = int(broker_id)
+        self.address = address
+        self.in_flight = in_flight
+        self.queue_depth = queue_depth
+        self.p99_ms = p99_ms
+        self.reported_at = time.monotonic()
+        self.pending = 0  # Requests the registry has in flight to this broker
+
+    def score(self):
+        """Lower is better: a blend of queued work and tail latency."""
+        return self.in_flight + self.pending + self.queue_depth / 10 + self.p99_ms / 10
+
+
+def reporting(candidates, loads):
+    """
+    Narrow candidates to brokers with a fresh load report. A broker whose
+    report is missing or stale may be dead, so it is only picked when no
+    candidate has reported, as right after the registry starts.
+    """
+    return [b for b in candidates if b in loads] or list(candidates)
+
+
+class LeastLoadedPolicy:
+    """Send each request to the broker with the lowest load score."""
+
+    def choose(self, candidates, loads, topic=None):
+        """
+        :param candidates: Broker IDs eligible for the request.
+        :param loads: Broker ID -> fresh BrokerLoad (missing when unknown).
+        :param topic: Topic of the request, if known.
+        :return: Chosen broker ID.
+        """
+        return min(
+            reporting(candidates, loads),
+            key=lambda b: (loads[b].score() if b in loads else 0.0, random.random()),
+        )
+
+
+class TopicAffinityPolicy:
+    """
+    Pin each topic to one broker with rendezvous hashing, so a topic keeps
+    hitting the same broker while membership is stable. Brokers that stop
+    reporting lose their topics until they report again. Requests without a
+    topic fall back to least-loaded.
+    """
+
+    def __init__(self):
+        self.fallback = LeastLoadedPolicy()
+
+    def choose(self, candidates, loads, topic=None):
+        if topic is None:
+            return self.fallback.choose(candidates, loads)
+        return max(
+            reporting(candidates, loads),
+            key=lambda b: hashlib.md5(f"{topic}/{b}".encode("utf-8")).digest(),
+        )
+
+
+class WeightedRoundRobinPolicy:
+    """
+    Smooth weighted round-robin where each broker's weight shrinks as its
+    reported load grows.
+    """
+
+    def __init__(self):
+        self.current = {}  # Broker ID -> current weight
+
+    def choose(self, candidates, loads, topic=None):
+        candidates = reporting(candidates, loads)
+        weights = {
+            b: 1.0 / (1.0 + (loads[b].score() if b in loads else 0.0)) for b in candidates
+        }
+        total = sum(weights.values())
+        for b in list(self.current):
+            if b not in weights:
+                del self.current[b]
+        for b, weight in weights.items():
+            self.current[b] = self.current.get(b, 0.0) + weight
+        chosen = max(candidates, key=lambda b: self.current[b])
+        self.current[chosen] -= total
+        return chosen
+
+
+POLICIES = {
+    "least_loaded": LeastLoadedPolicy,
+    "topic_affinity": TopicAffinityPolicy,
+    "weighted_round_robin": WeightedRoundRobinPolicy,
+}
@@ -0,0 +1,235 @@
+# File: sequencing.py
+
+import asyncio
+import logging
+import time
+import aiohttp
+from aiohttp import web
+from peers import PEER_HEADER, PeerDirectory
+from datatable import DataStore
+from util import logger_config
+
+logger_config.setup_logger()
+
+# Sequence numbers carry the leader's term in their high bits, so numbers
+# handed out in a later term always sort after those of earlier terms.
+TERM_SHIFT = 32
+# Highest term whose numbers fit SQLite's signed 64-bit INTEGER
+MAX_TERM = (1 << (63 - TERM_SHIFT)) - 1
+
+
+class SequenceRangeError(ValueError):
+    """Raised when a term's numbers would overflow its range or SQLite's INTEGER."""
+
+
+class SequenceAllocator:
+    """
+    Per-topic global sequence numbers handed out by the elected leader.
+
+    The leader keeps one counter per topic and gives out ranges of
+    ``block_size`` numbers (``POST /sequence/allocate``). Only a partition's
+    primary numbers its messages, from a block of its own for that
+    partition, and only goes back to the leader when the block runs out.
+    Numbers are unique within a topic and ascend within a partition in the
+    order the primary stores its messages, so a reader can follow each
+    partition with its own cursor. Replicas store the number they are given
+    and reads are ordered by it, so every replica exposes the same order.
+
+    A block is dropped, and a fresh one (above anything handed out before)
+    fetched, when the leader's term changes, when partition placement
+    changes (``drop_blocks``), or when the partition already holds a number
+    at or above the block's next one, e.g. from a broker that was primary
+    in the meantime.
+
+    A new leader starts its counters at ``term << TERM_SHIFT`` instead of
+    taking over its predecessor's counters. Each term therefore owns the
+    numbers below ``(term + 1) << TERM_SHIFT``; terms above ``MAX_TERM``
+    and blocks past the end of their term's range are refused, so numbers
+    stay unique and below 2^63.
+    """
+
+    def __init__(
+        self,
+        broker_id,
+        election,
+        block_size=1000,
+        allocate_timeout=5.0,
+        retry_interval=0.2,
+        directory=None,
+        last_sequence=None,
+    ):
+        """
+        :param broker_id: ID of the current broker.
+        :param election: LeaderElection instance identifying the leader and term.
+        :param block_size: Numbers requested from the leader at a time.
+        :param allocate_timeout: Seconds to keep trying to get a block while there is no leader.
+        :param retry_interval: Seconds between attempts while there is no leader.
+        :param directory: PeerDirectory used to reach the leader.
+        :param last_sequence: Callable ``(topic, partition)`` returning the highest
+                              number stored locally for a partition, or None.
+        """
+        self.broker_id = int(broker_id)
+        self.election = election
+        self.block_size = block_size
+        self.allocate_timeout = allocate_timeout
+        self.retry_interval = retry_interval
+        self.counters = {}  # Topic -> next number to hand out (leader only)
+        self.counters_term = None  # Term the counters belong to
+        self.blocks = {}  # (Topic, partition) -> [next, end, term] of this broker's current block
+        self.locks = {}  # (Topic, partition) -> asyncio.Lock serializing block refills
+        self.directory = directory or PeerDirectory(broker_id)
+        self.last_sequence = last_sequence or (lambda topic, partition: None)
+
+    def allocate(self, topic, count):
+        """
+        Hand out a range of numbers for a topic. Only the leader allocates.
+
+        :return: Tuple of (start, end, term) for the range [start, end), or
+                 None if this broker is not the leader.
+        :raises SequenceRangeError: If the term or the block is out of range.
+        """
+        if self.election.leader != self.broker_id:
+            return None
+        term = self.election.term
+        if not 0 <= term <= MAX_TERM:
+            raise SequenceRangeError(f"Term {term} is above the highest numbered term {MAX_TERM}")
+        if self.counters_term != term:
+            self.counters.clear()
+            self.counters_term = term
+        # Topics sharing a table must share a counter
+        topic = DataStore._sanitize_table_name(topic)
+        start = self.counters.get(topic, term << TERM_SHIFT)
+        if start + count > (term + 1) << TERM_SHIFT:
+            raise SequenceRangeError(f"Term {term} has run out of sequence numbers for '{topic}'")
+        self.counters[topic] = start + count
+        return start, start + count, term
+
+    def drop_blocks(self):
+        """Forget every block, e.g. because partition primaries may have moved."""
+        self.blocks.clear()
+
+    def _usable(self, topic, partition, count):
+        """Whether this broker's block for a partition can number ``count`` more messages."""
+        block = self.blocks.get((topic, partition))
+        if block is None or block[1] - block[0] < count or block[2] < self.election.term:
+            return False
+        last = self.last_sequence(topic, partition)
+        return last is None or block[0] > last
+
+    async def assign(self, topic, counts):
+        """
+        Number messages of several partitions of a topic, refilling blocks from
+        the leader as needed.
+
+        Once every block suffices, all numbers are taken at once without
+        yielding to the event loop, so a caller that stores the messages
+        before its next ``await`` stores each partition in sequence order.
+
+        :param counts: Dict of partition -> number of messages to number.
+        :return: Dict of partition -> ascending list of sequence numbers.
+        :raises ConnectionError: If no leader granted a usable block in time.
+        """
+        while True:
+            short = [partition for partition, count in counts.items() if not self._usable(topic, partition, count)]
+            if not short:
+                break
+            await asyncio.gather(*(self._refill(topic, partition, counts[partition]) for partition in short))
+        numbers = {}
+        for partition, count in counts.items():
+            block = self.blocks[(topic, partition)]
+            numbers[partition] = list(range(block[0], block[0] + count))
+            block[0] += count
+        return numbers
+
+    async def _refill(self, topic, partition, count):
+        """Replace a partition's block with a fresh one of at least ``count`` numbers."""
+        lock = self.locks.setdefault((topic, partition), asyncio.Lock())
+        async with lock:
+            if self._usable(topic, partition, count):
+                return  # Refilled by a concurrent caller
+            start, end, term = await self._fetch_block(topic, max(self.block_size, count))
+            last = self.last_sequence(topic, partition)
+            if last is not None and start <= last:
+                # The leader is behind a later term this broker has seen numbers from
+                raise ConnectionError(f"Leader granted {topic}/{partition} numbers below stored number {last}")
+            self.blocks[(topic, partition)] = [start, end, term]
+
+    async def _fetch_block(self, topic, count):
+        """Get a block from the leader, waiting out elections up to ``allocate_timeout``."""
+        deadline = time.monotonic() + self.allocate_timeout
+        while True:
+            leader = self.election.leader
+            if leader == self.broker_id:
+                try:
+                    block = self.allocate(topic, count)
+                except SequenceRangeError as e:
+                    raise ConnectionError(str(e))
+                if block:
+                    return block
+            elif leader is not None:
+                block = await self._request_block(leader, topic, count)
+                if block:
+                    return block
+            if time.monotonic() >= deadline:
+                raise ConnectionError(f"No leader granted sequence numbers for '{topic}'")
+            await asyncio.sleep(self.retry_interval)
+
+    async def _request_block(self, leader, topic, count):
+        """Ask the leader for a block; None if it refused or was unreachable."""
+        url = self.directory.url(leader, "/sequence/allocate")
+        try:
+            async with self.directory.session(leader).post(
+                url,
+                json={"topic": topic, "count": count},
+                timeout=aiohttp.ClientTimeout(total=self.election.renew_interval),
+            ) as response:
+                if response.status != 200:
+                    logging.debug(f"Broker {leader} refused to allocate (HTTP {response.status}).")
+                    return None
+                body = await response.json()
+                return body["start"], body["end"], body["term"]
+        except Exception as e:
+            logging.debug(f"Sequence allocation from Broker {leader} failed: {e}")
+            return None
+
+    async def handle_allocate(self, request):
+        """
+        Endpoint handing out a block of sequence numbers (leader only).
+
+        Expected JSON payload:
+        {
+            "topic": str,
+            "count": int
+        }
+
+        Answers 409 with the current leader when this broker is not the leader,
+        and 403 to callers that are not proven peer brokers.
+        """
+        if PEER_HEADER not in request.headers:
+            return web.json_response(
+                {"status": "error", "message": "Only brokers may allocate sequence numbers."}, status=403
+            )
+        try:
+            data = await request.json()
+            topic = data.get("topic")
+            count = int(data.get("count", self.block_size))
+            if not topic or count <= 0:
+                return web.json_response(
+                    {"status": "error", "message": "'topic' and a positive 'count' are required."},
+                    status=400,
+                )
+            try:
+                block = self.allocate(topic, count)
+            except SequenceRangeError as e:
+                logging.error(f"Refused to allocate sequence numbers: {e}")
+                return web.json_response({"status": "error", "message": str(e)}, status=503)
+            if block is None:
+                return web.json_response(
+                    {"status": "not_leader", "leader": self.election.leader, "term": self.election.term},
+                    status=409,
+                )
+            start, end, term = block
+            return web.json_response({"start": start, "end": end, "term": term})
+        except Exception as e:
+            logging.exception(f"Error in sequence allocation route: {e}")
+            return web.json_response({"status": "error", "message": str(e)}, status=500)
@@ -1,13 +1,15 @@
 import subprocess
 import time
+import urllib.request
 
 # Number of brokers to start
 NUM_BROKERS = 10
 BASE_PORT = 3000  # Starting port number
+REGISTRY_URL = "http://localhost:4000"
 
 
 # Function to start a broker process
-def start_broker(broker_id, port, peers):
+def start_broker(broker_id, port):
     cmd = [
         "python3",
         "broker.py",
@@ -15,25 +17,43 @@ def start_broker(broker_id, port, peers):
         str(broker_id),
         "--port",
         str(port),
-        "--peers",
-        ",".join(map(str, peers)),
+        "--registry",
+        REGISTRY_URL,
+        # Peers reach each other here; the default broker-<id> names only resolve inside compose
+        "--advertise",
+        f"http://localhost:{port}",
+        # Each broker needs its own database
+        "--data_dir",
+        f"data/broker-{broker_id}",
     ]
-    print(f"Starting Broker {broker_id} on port {port} with peers {peers}...")
+    print(f"Starting Broker {broker_id} on port {port}...")
     return subprocess.Popen(cmd)
 
 
-# Start brokers
-brokers = []
-for i in range(1, NUM_BROKERS + 1):
-    port = BASE_PORT + i - 1
-    peers = [
-        j for j in range(1, NUM_BROKERS + 1) if j != i
-    ]  # All other brokers as peers
-    broker = start_broker(i, port, peers)
-    brokers.append(broker)
-    time.sleep(1)  # Small delay to avoid race conditions
+def is_ready(port):
+    """Check a broker's readiness endpoint."""
+    try:
+        with urllib.request.urlopen(f"http://localhost:{port}/ready", timeout=1):
+            return True
+    except Exception:
+        return False
 
-print(f"{NUM_BROKERS} brokers started successfully!")
+
+# Start all brokers at once; they retry registration until the registry answers
+started = time.monotonic()
+brokers = [
+    start_broker(i, BASE_PORT + i - 1) for i in range(1, NUM_BROKERS + 1)
+]
+
+# Wait until every broker reports ready
+pending = {BASE_PORT + i for i in range(NUM_BROKERS)}
+while pending and all(broker.poll() is None for broker in brokers):
+    pending = {port for port in pending if not is_ready(port)}
+    time.sleep(0.1)
+if pending:
+    print(f"Brokers on ports {sorted(pending)} exited before becoming ready.")
+else:
+    print(f"{NUM_BROKERS} brokers ready in {time.monotonic() - started:.1f}s!")
 
 # Keep the script running to manage processes
 try:
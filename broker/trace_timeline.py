@@ -0,0 +1,132 @@
+# File: trace_timeline.py
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+# Rebuild a message's propagation timeline from the span files written by
+# brokers (--trace_file, Zipkin v2 JSON lines). Give it the span files, or
+# directories containing them (rotated files included), and a message ID or
+# trace ID:
+#
+#   python trace_timeline.py --message_id 1b9e... /data/b1 /data/b2 /data/b3
+#
+# Spans are printed as a tree in start order, with offsets from the start of
+# the trace, followed by when each broker stored the message. Offsets across
+# brokers are only as accurate as the brokers' clocks are in sync.
+
+
+def span_files(paths):
+    """Expand directories to the span files (and rotated backups) inside them."""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, "traces.jsonl*")))
+        else:
+            yield path
+
+
+def load_spans(paths):
+    """Read every span from the given files, skipping malformed lines."""
+    spans = []
+    for path in span_files(paths):
+        with open(path) as span_file:
+            for line in span_file:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue
+    return spans
+
+
+def select_trace(spans, message_id=None, trace_id=None):
+    """Return the spans of the trace a message (or trace ID) belongs to."""
+    if trace_id is None:
+        trace_ids = {
+            span["traceId"] for span in spans if span.get("tags", {}).get("message_id") == message_id
+        }
+        if not trace_ids:
+            return []
+        if len(trace_ids) > 1:
+            # A message published more than once gets several traces; take the first
+            trace_id = min(
+                trace_ids,
+                key=lambda t: min(s["timestamp"] for s in spans if s["traceId"] == t),
+            )
+        else:
+            trace_id = trace_ids.pop()
+    return [span for span in spans if span["traceId"] == trace_id]
+
+
+def timeline(trace):
+    """Order a trace's spans depth-first by start time, as (depth, span) pairs."""
+    by_id = {span["id"]: span for span in trace}
+    children = {}
+    for span in trace:
+        parent = span.get("parentId") if span.get("parentId") in by_id else None
+        children.setdefault(parent, []).append(span)
+    for siblings in children.values():
+        siblings.sort(key=lambda span: span["timestamp"])
+
+    ordered = []
+
+    def visit(span, depth):
+        ordered.append((depth, span))
+        for child in children.get(span["id"], []):
+            visit(child, depth + 1)
+
+    for root in children.get(None, []):
+        visit(root, 0)
+    return ordered
+
+
+def stored_at(trace):
+    """When each broker finished storing the message, keyed by service name."""
+    stored = {}
+    for span in trace:
+        if span["name"] == "store" and span.get("tags", {}).get("error") is None:
+            service = span["localEndpoint"]["serviceName"]
+            end = span["timestamp"] + span["duration"]
+            stored[service] = min(stored.get(service, end), end)
+    return stored
+
+
+def render(trace):
+    """Render a trace as text lines."""
+    start = min(span["timestamp"] for span in trace)
+    lines = [f"Trace {trace[0]['traceId']} ({len(trace)} spans)"]
+    for depth, span in timeline(trace):
+        tags = " ".join(f"{key}={value}" for key, value in sorted(span.get("tags", {}).items()))
+        lines.append(
+            f"{(span['timestamp'] - start) / 1000:>10.3f}ms {span['duration'] / 1000:>9.3f}ms  "
+            f"{span['localEndpoint']['serviceName']:<10} {'  ' * depth}{span['name']}"
+            f"{' [' + span['kind'] + ']' if span.get('kind') else ''}  {tags}"
+        )
+    lines.append("Stored:")
+    for service, end in sorted(stored_at(trace).items(), key=lambda item: item[1]):
+        lines.append(f"  {service:<10} +{(end - start) / 1000:.3f}ms")
+    return lines
+
+
+def main(args):
+    spans = load_spans(args.paths)
+    trace = select_trace(spans, args.message_id, args.trace_id)
+    if not trace:
+        print(f"No spans found for {args.message_id or args.trace_id}.", file=sys.stderr)
+        return 1
+    if args.json:
+        print(json.dumps([span for _, span in timeline(trace)]))
+    else:
+        print("\n".join(render(trace)))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show a message's propagation across brokers.")
+    parser.add_argument("paths", nargs="+", help="Span files or directories containing traces.jsonl*")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--message_id", help="Message ID to look up")
+    group.add_argument("--trace_id", help="Trace ID to show")
+    parser.add_argument("--json", action="store_true", help="Print the ordered spans as JSON")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,156 @@
+# File: tracing.py
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+from util import logger_config
+
+logger_config.setup_logger()
+
+# W3C Trace Context field, used as HTTP header and as a message field
+TRACEPARENT = "traceparent"
+
+
+def parse_traceparent(value):
+    """
+    Parse a W3C ``traceparent`` value (``00-<trace id>-<span id>-<flags>``).
+
+    :return: Tuple of (trace_id, span_id, sampled), or None if malformed.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    parts = value.split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2], parts[3] == "01"
+
+
+class Span:
+    """One timed operation of a message on this broker."""
+
+    __slots__ = ("tracer", "name", "kind", "trace_id", "span_id", "parent_id", "sampled", "tags", "timestamp", "started")
+
+    def __init__(self, tracer, name, trace_id, parent_id, sampled, kind=None, tags=None):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.tags = tags or {}
+        self.timestamp = time.time()
+        self.started = time.perf_counter()
+
+    @property
+    def traceparent(self):
+        """Context to hand to child operations, on this or another broker."""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def finish(self, **tags):
+        """End the span, adding ``tags``, and export it if sampled."""
+        self.tags.update(tags)
+        if self.sampled:
+            self.tracer.export(self, time.perf_counter() - self.started)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc is not None:
+            self.finish(error=str(exc) or exc_type.__name__)
+        else:
+            self.finish()
+
+
+class Tracer:
+    """
+    Records spans of each message's path through this broker and writes
+    them, one Zipkin v2 JSON span per line, to a rotating file.
+
+    Context travels as a W3C ``traceparent`` value: in the ``traceparent``
+    HTTP header or message field on publish, and in every replication
+    request, so the spans of all brokers form one trace per message. Spans
+    are serialized and written by a background thread. Whether a trace is
+    recorded is decided once, when it starts (``sample_rate``), and carried
+    along in the context.
+    """
+
+    def __init__(self, service, path=None, sample_rate=1.0, max_bytes=10 * 1024 * 1024, backup_count=3):
+        """
+        :param service: Name of this service in the spans (e.g. ``broker-1``).
+        :param path: Span file; None records nothing but still propagates context.
+        :param sample_rate: Fraction of new traces that are recorded.
+        :param max_bytes: Size at which the span file is rotated.
+        :param backup_count: Rotated span files kept.
+        """
+        self.service = service
+        self.path = path
+        self.sample_rate = sample_rate if path else 0.0
+        self.endpoint = {"serviceName": service}
+        self.handler = None
+        self.listener = None
+        if path:
+            # Same queue-and-thread pipeline as the application log, but separate from it
+            file_handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count, delay=True
+            )
+            file_handler.setFormatter(_SpanFormatter())
+            self.handler = logger_config.DroppingQueueHandler(queue.Queue(10000))
+            self.listener = logging.handlers.QueueListener(self.handler.queue, file_handler)
+            self.listener.start()
+
+    def start_span(self, name, parent=None, kind=None, **tags):
+        """
+        Start a span.
+
+        :param parent: Parent Span, ``traceparent`` string, or None to start a new trace.
+        :param kind: Zipkin span kind (``SERVER``, ``CLIENT``, ...), if any.
+        """
+        if isinstance(parent, Span):
+            trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+        else:
+            context = parse_traceparent(parent)
+            if context:
+                trace_id, parent_id, sampled = context
+                sampled = sampled and self.path is not None
+            else:
+                trace_id, parent_id = os.urandom(16).hex(), None
+                sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        return Span(self, name, trace_id, parent_id, sampled, kind, tags)
+
+    def export(self, span, duration):
+        """Queue a finished span for the writer thread."""
+        record = {
+            "traceId": span.trace_id,
+            "id": span.span_id,
+            "name": span.name,
+            "timestamp": int(span.timestamp * 1_000_000),
+            "duration": max(1, int(duration * 1_000_000)),
+            "localEndpoint": self.endpoint,
+            "tags": span.tags,
+        }
+        if span.parent_id:
+            record["parentId"] = span.parent_id
+        if span.kind:
+            record["kind"] = span.kind
+        self.handler.enqueue(logging.makeLogRecord({"msg": record}))
+
+    def close(self):
+        """Flush queued spans and stop the writer thread."""
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+
+
+class _SpanFormatter(logging.Formatter):
+    """Serialize a span (the record's ``msg`` dict) as one JSON line."""
+
+    def format(self, record):
+        span = record.msg
+        span["tags"] = {key: str(value) for key, value in span["tags"].items()}
+        return json.dumps(span, separators=(",", ":"))
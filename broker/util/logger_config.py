@@ -1,10 +1,27 @@
+import atexit
+import copy
 import logging
-from colorama import Fore, Style, init
+import logging.handlers
 import os
+import queue
+import time
+from colorama import Fore, Style, init
 
 # Initialize colorama for colored output
 init(autoreset=True)
 
+LOG_FORMAT = "%(asctime)s | PID:%(process)d | %(levelname)-7s | %(filename)s:%(lineno)d | %(message)s"
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Pass as ``extra=RATE_LIMITED`` on per-message log calls: each call site
+# then logs at most once per second, with a count of what it suppressed.
+RATE_LIMITED = {"rate_limit": 1.0}
+
+# Started by setup_logger; owns the handlers that actually write
+_listener = None
+_level_filter = None
+
+
 # Define a custom formatter with colors for console output
 class ColorFormatter(logging.Formatter):
     # Define colors for different log levels
@@ -15,42 +32,167 @@ class ColorFormatter(logging.Formatter):
         'ERROR': Fore.RED + Style.BRIGHT,
         'CRITICAL': Fore.RED + Style.BRIGHT
     }
-    
+
     def format(self, record):
-        # Apply color based on the log level
+        # Colorize a copy: the same record also goes to the file handler
+        record = copy.copy(record)
         log_color = self.LEVEL_COLORS.get(record.levelname, Fore.WHITE)
         record.levelname = f"{log_color}{record.levelname}{Style.RESET_ALL}"  # Colorize level name
-        
+
         # Return the formatted message
         return super().format(record)
 
+
+class ModuleLevelFilter(logging.Filter):
+    """
+    Per-module log levels. Modules log through the root logger, so the level
+    is looked up by the record's module (file name without ``.py``).
+    """
+
+    def __init__(self, level=logging.INFO, module_levels=None):
+        super().__init__()
+        self.level = level
+        self.module_levels = dict(module_levels or {})
+
+    def lowest(self):
+        """Most verbose level any module needs; the root logger is set to it."""
+        return min([self.level] + list(self.module_levels.values()))
+
+    def filter(self, record):
+        return record.levelno >= self.module_levels.get(record.module, self.level)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drop records logged with a ``rate_limit`` (seconds) attribute if the same
+    call site logged less than that long ago. The next record that gets
+    through says how many were suppressed in between.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sites = {}  # (pathname, lineno) -> [last emitted, suppressed count]
+
+    def filter(self, record):
+        interval = getattr(record, "rate_limit", None)
+        if interval is None:
+            return True
+        site = self.sites.setdefault((record.pathname, record.lineno), [float("-inf"), 0])
+        now = time.monotonic()
+        if now - site[0] < interval:
+            site[1] += 1
+            return False
+        if site[1]:
+            record.msg = f"{record.msg} [{site[1]} similar suppressed]"
+            site[1] = 0
+        site[0] = now
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the listener thread without formatting them, and drops
+    them (counting) instead of blocking when the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread; records never leave the process
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(
+                    logging.makeLogRecord(
+                        {
+                            "name": "logger_config",
+                            "levelno": logging.WARNING,
+                            "levelname": "WARNING",
+                            "module": "logger_config",
+                            "filename": "logger_config.py",
+                            "msg": f"Dropped {self.dropped} log records (queue full).",
+                        }
+                    )
+                )
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_module_levels(spec):
+    """
+    Parse ``"replication=WARNING,heartbeat=DEBUG"`` into
+    ``{"replication": logging.WARNING, "heartbeat": logging.DEBUG}``.
+    """
+    levels = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            module, level = item.split("=", 1)
+            levels[module.strip()] = logging.getLevelName(level.strip().upper())
+    return {module: level for module, level in levels.items() if isinstance(level, int)}
+
+
+def configure_levels(log_level=None, module_levels=None):
+    """
+    Change the default and per-module levels after setup, e.g. from CLI flags.
+
+    :param log_level: Default level name or number; None keeps the current one.
+    :param module_levels: Dict or ``module=LEVEL,...`` string merged into the current levels.
+    """
+    if _level_filter is None:
+        setup_logger()
+    if log_level is not None:
+        _level_filter.level = logging.getLevelName(log_level.upper()) if isinstance(log_level, str) else log_level
+    if isinstance(module_levels, str):
+        module_levels = parse_module_levels(module_levels)
+    _level_filter.module_levels.update(module_levels or {})
+    logging.getLogger().setLevel(_level_filter.lowest())
+
+
 # Function to configure the root logger
-def setup_logger(log_file='app.log', log_level=logging.DEBUG):
+def setup_logger(log_file='app.log', log_level=None, queue_size=10000):
+    """
+    Route the root logger through a queue to a background listener thread
+    that writes to the console and ``log_file``, so logging never blocks the
+    event loop on formatting or I/O.
+
+    Levels come from ``log_level`` (default: ``LOG_LEVEL`` env, else INFO),
+    with per-module overrides from the ``LOG_LEVELS`` env
+    (``module=LEVEL,...``); see ``configure_levels`` to change them later.
+    """
+    global _listener, _level_filter
     # Create a custom root logger
     logger = logging.getLogger()
-    logger.setLevel(log_level)
 
     # If the logger already has handlers, avoid adding new ones
     if not logger.hasHandlers():
         # Console handler with color output
         console_handler = logging.StreamHandler()
-        color_formatter = ColorFormatter(
-            "%(asctime)s | PID:%(process)d | %(levelname)-7s | %(filename)s:%(lineno)d | %(message)s",
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        console_handler.setFormatter(color_formatter)
+        console_handler.setFormatter(ColorFormatter(LOG_FORMAT, datefmt=DATE_FORMAT))
 
         # File handler to save logs to a file
         file_handler = logging.FileHandler(log_file)
-        file_formatter = logging.Formatter(
-            "%(asctime)s | PID:%(process)d | %(levelname)-7s | %(filename)s:%(lineno)d | %(message)s",
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        file_handler.setFormatter(file_formatter)
-
-        # Add both handlers to the root logger
-        logger.addHandler(console_handler)
-        logger.addHandler(file_handler)
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT))
+
+        level = log_level or os.environ.get("LOG_LEVEL", "INFO")
+        if isinstance(level, str):
+            level = logging.getLevelName(level.upper())
+        _level_filter = ModuleLevelFilter(level, parse_module_levels(os.environ.get("LOG_LEVELS")))
+
+        queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+        queue_handler.addFilter(_level_filter)
+        queue_handler.addFilter(RateLimitFilter())
+        logger.addHandler(queue_handler)
+        logger.setLevel(_level_filter.lowest())
+
+        _listener = logging.handlers.QueueListener(queue_handler.queue, console_handler, file_handler)
+        _listener.start()
+        atexit.register(_listener.stop)  # Flush what is still queued on exit
 
     return logger
 
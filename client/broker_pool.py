@@ -0,0 +1,286 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+import aiohttp
+
+
+class BrokerStats:
+    """Per-broker health and load statistics."""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0  # Requests currently in flight
+        self.latency = None  # Exponentially weighted moving average, in seconds
+        self.errors = 0  # Consecutive failures
+        self.down_until = 0.0  # Monotonic time until which the broker is skipped
+
+    def is_healthy(self, now):
+        """Check whether the broker is outside its failure cooldown."""
+        return now >= self.down_until
+
+    def score(self):
+        """Lower is better: expected wait for a new request on this broker."""
+        latency = self.latency if self.latency is not None else 0.0
+        return (self.outstanding + 1) * latency + self.outstanding
+
+
+class BrokerPool:
+    """
+    Keeps a pooled keep-alive session per broker, tracks latency and errors,
+    and routes each request to a healthy broker.
+
+    Routing policies:
+    - "p2c": sample two healthy brokers and pick the one with the lower score.
+    - "least_outstanding": pick the broker with the fewest in-flight requests.
+    """
+
+    def __init__(
+        self,
+        addresses,
+        registry_url=None,
+        policy="p2c",
+        max_attempts=3,
+        request_timeout=5,
+        failure_cooldown=5,
+        refresh_interval=10,
+        connections_per_broker=20,
+        max_retry_after=10,
+    ):
+        """
+        :param addresses: Initial list of broker base URLs.
+        :param registry_url: Registry URL used to refresh the broker list, and
+                             the brokers' advertised addresses, from /members.
+        :param policy: Routing policy, "p2c" or "least_outstanding".
+        :param max_attempts: Number of brokers to try before giving up on a request.
+        :param request_timeout: Per-attempt timeout in seconds.
+        :param failure_cooldown: Seconds a failing broker is skipped for.
+        :param refresh_interval: Seconds between registry refreshes.
+        :param connections_per_broker: Connection pool size per broker.
+        :param max_retry_after: Longest Retry-After, in seconds, waited out before
+                                retrying a request the broker refused (429/503).
+        """
+        if policy not in ("p2c", "least_outstanding"):
+            raise ValueError(f"Unknown routing policy: {policy}")
+        self.registry_url = registry_url
+        self.policy = policy
+        self.max_attempts = max_attempts
+        self.timeout = aiohttp.ClientTimeout(total=request_timeout)
+        self.failure_cooldown = failure_cooldown
+        self.refresh_interval = refresh_interval
+        self.connections_per_broker = connections_per_broker
+        self.max_retry_after = max_retry_after
+        self.brokers = {url: BrokerStats(url) for url in addresses}
+        self.sessions = {}
+        self.recent_latencies = deque(maxlen=512)  # Successful request latencies, all brokers
+        self._refresh_task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def start(self):
+        """Load the broker list from the registry and keep it fresh."""
+        if self.registry_url:
+            await self.refresh_members()
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        """Stop refreshing and close every pooled session."""
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+        await asyncio.gather(
+            *(session.close() for session in self.sessions.values()),
+            return_exceptions=True,
+        )
+        self.sessions.clear()
+
+    def session_for(self, url):
+        """Return the keep-alive session for a broker, creating it on first use."""
+        session = self.sessions.get(url)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connections_per_broker)
+            session = aiohttp.ClientSession(
+                base_url=url, connector=connector, timeout=self.timeout
+            )
+            self.sessions[url] = session
+        return session
+
+    @staticmethod
+    def broker_url(broker_id, addresses):
+        """
+        Base URL of a broker listed by the registry: the address it advertised
+        (``--advertise``), else the default local port mapping.
+        """
+        address = addresses.get(str(broker_id))
+        if address:
+            return address.rstrip("/")
+        return f"http://127.0.0.1:{3000 + int(broker_id) - 1}"
+
+    async def refresh_members(self):
+        """Replace the broker list with the registry's current /members."""
+        try:
+            async with aiohttp.ClientSession(timeout=self.timeout) as session:
+                # A feed from version 0 lists every member with its advertised address
+                async with session.get(
+                    f"{self.registry_url}/members", params={"since": 0}
+                ) as response:
+                    if response.status != 200:
+                        print(f"Failed to refresh brokers (HTTP {response.status})")
+                        return
+                    feed = await response.json()
+        except Exception as e:
+            print(f"Error refreshing brokers from registry: {e}")
+            return
+
+        members = feed["members"] if feed.get("reset") else feed.get("joined", [])
+        addresses = {str(broker_id): address for broker_id, address in feed.get("addresses", {}).items()}
+        urls = {self.broker_url(broker_id, addresses) for broker_id in members}
+        if not urls:
+            return
+        for url in urls - self.brokers.keys():
+            self.brokers[url] = BrokerStats(url)
+        for url in self.brokers.keys() - urls:
+            del self.brokers[url]
+            session = self.sessions.pop(url, None)
+            if session:
+                await session.close()
+
+    async def _refresh_loop(self):
+        """Periodically refresh the broker list from the registry."""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh_members()
+
+    def pick(self, exclude=()):
+        """Choose a broker according to the routing policy."""
+        now = time.monotonic()
+        candidates = [
+            stats
+            for url, stats in self.brokers.items()
+            if url not in exclude and stats.is_healthy(now)
+        ]
+        if not candidates:
+            # Every broker is cooling down; fall back to any untried one
+            candidates = [
+                stats for url, stats in self.brokers.items() if url not in exclude
+            ]
+        if not candidates:
+            return None
+        if self.policy == "least_outstanding":
+            return min(candidates, key=lambda stats: (stats.outstanding, random.random()))
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if first.score() <= second.score() else second
+
+    async def request(self, method, path, with_headers=False, **kwargs):
+        """
+        Send a request to a chosen broker, retrying on other brokers on failure.
+
+        A broker that refuses the request with a ``Retry-After`` (429, or 503
+        while overloaded) is not counted as failing: the request waits as
+        long as asked and is tried again, on any broker. Waits longer than
+        ``max_retry_after``, or a refusal on the last attempt, are returned
+        to the caller.
+
+        :param with_headers: Also return the response headers.
+        :return: Tuple of (broker URL, HTTP status, decoded JSON body or text),
+                 followed by the response headers when ``with_headers`` is set.
+        """
+        tried = set()
+        last_error = None
+        for attempt in range(self.max_attempts):
+            stats = self.pick(exclude=tried)
+            if stats is None:
+                break
+            tried.add(stats.url)
+            stats.outstanding += 1
+            started = time.monotonic()
+            wait = None
+            try:
+                async with self.session_for(stats.url).request(
+                    method, path, **kwargs
+                ) as response:
+                    if response.content_type == "application/json":
+                        body = await response.json()
+                    else:
+                        body = await response.text()
+                    wait = self.retry_after(response, body)
+                    if wait is not None and (
+                        wait > self.max_retry_after or attempt + 1 == self.max_attempts
+                    ):
+                        wait = None  # Hand the refusal to the caller
+                    if wait is None and response.status >= 500:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info,
+                            response.history,
+                            status=response.status,
+                        )
+                if wait is None:
+                    self.record_success(stats, time.monotonic() - started)
+                    if with_headers:
+                        return stats.url, response.status, body, response.headers
+                    return stats.url, response.status, body
+                # Back pressure, not a failure: any broker may be tried again
+                tried.discard(stats.url)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.record_failure(stats)
+                last_error = e
+                print(f"Request to {stats.url}{path} failed ({e}); trying another broker.")
+            finally:
+                stats.outstanding -= 1
+            if wait is not None:
+                await asyncio.sleep(wait)
+        raise ConnectionError(f"All brokers failed for {method} {path}: {last_error}")
+
+    @staticmethod
+    def retry_after(response, body):
+        """
+        Seconds a refusing broker asked to wait: the exact ``retry_after`` of a
+        JSON body if present, else the ``Retry-After`` header.
+
+        :return: Seconds, or None if the response is not a refusal to retry later.
+        """
+        if response.status not in (429, 503) or "Retry-After" not in response.headers:
+            return None
+        if isinstance(body, dict) and isinstance(body.get("retry_after"), (int, float)):
+            return max(0.0, body["retry_after"])
+        try:
+            return max(0.0, float(response.headers["Retry-After"]))
+        except ValueError:
+            return None
+
+    def latency_percentile(self, percentile):
+        """
+        Return the given percentile of recent request latencies, in seconds.
+
+        :param percentile: Percentile between 0 and 100.
+        :return: Latency, or None before any request has completed.
+        """
+        if not self.recent_latencies:
+            return None
+        ordered = sorted(self.recent_latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+    def record_success(self, stats, elapsed):
+        """Reset the error count and fold the latency into the moving average."""
+        self.recent_latencies.append(elapsed)
+        stats.errors = 0
+        stats.down_until = 0.0
+        if stats.latency is None:
+            stats.latency = elapsed
+        else:
+            stats.latency = 0.8 * stats.latency + 0.2 * elapsed
+
+    def record_failure(self, stats):
+        """Put a failing broker into cooldown."""
+        stats.errors += 1
+        # Back off longer for brokers that keep failing
+        stats.down_until = time.monotonic() + self.failure_cooldown * min(stats.errors, 6)
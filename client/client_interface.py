@@ -1,6 +1,11 @@
-import aiohttp
 import asyncio
 import argparse
+import json
+import sys
+from broker_pool import BrokerPool
+from load_generator import run_bench
+from producer import BatchingProducer
+from scatter_gather import scatter_gather_fetch
 
 BROKER_ADDRESSES = [
     "http://127.0.0.1:3000",
@@ -16,138 +21,305 @@ BROKER_ADDRESSES = [
 ]
 
 
-async def publish_message(topic, message):
-    """Publish a message to a topic by sending it to one of the brokers."""
-    async with aiohttp.ClientSession() as session:
-        # Choose a random broker to publish to
-        broker_url = BROKER_ADDRESSES[0]  # Or implement a load-balancing strategy
-        url = f"{broker_url}/publish"
-        data = {"topic": topic, "message": message}
+async def publish_message(pool, topic, message):
+    """Publish a message to a topic through the broker pool."""
+    data = {"topic": topic, "message": message}
+    broker_url, status, body = await pool.request("POST", "/publish", json=data)
+    print(f"Response from broker {broker_url}: {body}")
 
-        async with session.post(url, json=data) as response:
-            print(f"Response from broker: {await response.text()}")
+
+async def produce_from_stdin(pool, topic, batch_size, linger_ms, compression):
+    """Publish every line read from stdin as a message, in batches."""
+    async with BatchingProducer(
+        pool, batch_size=batch_size, linger_ms=linger_ms, compression=compression
+    ) as producer:
+        futures = []
+        for line in sys.stdin:
+            line = line.rstrip("\n")
+            if line:
+                futures.append(await producer.send(topic, line))
+        await producer.flush()
+
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    failed = [r for r in results if isinstance(r, Exception) or r.get("status") == "error"]
+    print(f"Published {len(results) - len(failed)} of {len(results)} messages to '{topic}'.")
+
+
+async def register_filter(pool, topic, filter_spec):
+    """Register a subscription filter with the brokers and return its ID."""
+    broker_url, status, body = await pool.request(
+        "POST", "/filters", json={"topic": topic, "filter": filter_spec}
+    )
+    if status != 200:
+        raise ValueError(f"Filter rejected by {broker_url}: {body}")
+    return body["filter_id"]
 
 
 async def subscribe_topic_adaptive(
-    topic, min_interval=1, max_interval=10, default_interval=5
+    pool, topic, min_interval=1, max_interval=10, default_interval=5, filter_spec=None
 ):
     """
     Subscribe to a topic using an adaptive polling mechanism.
     The polling interval adjusts dynamically based on message frequency.
+    Each poll is routed through the broker pool, so a failed broker is skipped.
+    Polls are conditional (If-None-Match), so an unchanged topic costs a 304.
+    Each poll resumes after the last sequence number received, and since every
+    broker orders a topic identically the cursor holds across brokers.
+
+    With ``filter_spec`` the brokers only return messages matching it (see
+    ``broker/filters.py``); the filter is registered again if a broker has
+    dropped it.
     """
-    async with aiohttp.ClientSession() as session:
-        broker_url = BROKER_ADDRESSES[0]  # Choose a broker (can be randomized)
-        url = f"{broker_url}/data/{topic}"
-
-        current_interval = default_interval
-        print(f"Subscribed to topic '{topic}'. Starting adaptive polling...\n")
-
-        last_message = None  # Track the last message to detect new messages
-
-        while True:
-            try:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        try:
-                            raw_response = (
-                                await response.text()
-                            )  # Debugging: Log the raw response
-                            messages = await response.json()
-                            if (
-                                isinstance(messages, dict)
-                                and "messages" in messages
-                                and isinstance(messages["messages"], list)
-                            ):
-                                latest_message = messages["messages"][
-                                    -1
-                                ]  # Get the latest message
-                                if latest_message != last_message:
-                                    print(
-                                        f"New messages for topic '{topic}': {messages['messages']}"
-                                    )
-                                    last_message = latest_message
-                                    current_interval = max(
-                                        min_interval, current_interval // 2
-                                    )
-                                else:
-                                    print(f"No new messages for topic '{topic}'")
-                                    current_interval = min(
-                                        max_interval, current_interval + 1
-                                    )
-                            else:
-                                print(f"Unexpected response structure: {messages}")
-                                current_interval = min(
-                                    max_interval, current_interval + 1
-                                )
-                        except aiohttp.ContentTypeError:
-                            raw_response = await response.text()
-                            print(
-                                f"Error: Response is not valid JSON. Raw response: {raw_response}"
-                            )
-                            current_interval = min(max_interval, current_interval + 1)
-                    elif response.status == 204:
-                        print(f"No new messages for topic '{topic}' (204 No Content)")
-                        current_interval = min(max_interval, current_interval + 1)
-                    else:
+    url = f"/data/{topic}"
+    etag = None  # Validator of the last response that carried messages
+    cursor = None  # next_after of the last page received: the last sequence number read per partition
+    filter_id = await register_filter(pool, topic, filter_spec) if filter_spec is not None else None
+
+    current_interval = default_interval
+    print(f"Subscribed to topic '{topic}'. Starting adaptive polling...\n")
+
+    while True:
+        try:
+            headers = {"If-None-Match": etag} if etag else {}
+            params = {"after": cursor} if cursor is not None else {}
+            if filter_id is not None:
+                params["filter"] = filter_id
+            broker_url, status, messages, response_headers = await pool.request(
+                "GET", url, with_headers=True, headers=headers, params=params
+            )
+            if status == 200:
+                etag = response_headers.get("ETag")
+                if (
+                    isinstance(messages, dict)
+                    and "messages" in messages
+                    and isinstance(messages["messages"], list)
+                ):
+                    if messages["messages"]:
                         print(
-                            f"Error: Received unexpected status code {response.status}"
+                            f"New messages for topic '{topic}': {messages['messages']}"
                         )
-
-            except aiohttp.ClientError as e:
-                print(f"Connection error while polling for topic '{topic}': {e}")
+                        cursor = messages.get("next_after", cursor)
+                        current_interval = max(min_interval, current_interval // 2)
+                    else:
+                        print(f"No new messages for topic '{topic}'")
+                        current_interval = min(max_interval, current_interval + 1)
+                else:
+                    print(f"Unexpected response structure: {messages}")
+                    current_interval = min(max_interval, current_interval + 1)
+            elif status == 304:
+                print(f"No new messages for topic '{topic}' (304 Not Modified)")
                 current_interval = min(max_interval, current_interval + 1)
-            except Exception as e:
-                print(f"An unexpected error occurred: {e}")
+            elif status == 204:
+                print(f"No new messages for topic '{topic}' (204 No Content)")
                 current_interval = min(max_interval, current_interval + 1)
+            elif status == 404 and filter_id is not None:
+                print(f"Filter unknown to {broker_url}; registering it again")
+                filter_id = await register_filter(pool, topic, filter_spec)
+            else:
+                print(f"Error: Received unexpected status code {status} from {broker_url}")
 
-            print(f"Polling again in {current_interval} seconds...\n")
-            await asyncio.sleep(current_interval)
+        except ConnectionError as e:
+            print(f"Connection error while polling for topic '{topic}': {e}")
+            current_interval = min(max_interval, current_interval + 1)
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
+            current_interval = min(max_interval, current_interval + 1)
 
+        print(f"Polling again in {current_interval} seconds...\n")
+        await asyncio.sleep(current_interval)
 
-async def fetch_messages(topic):
-    """Fetch messages for a topic from all brokers."""
-    async with aiohttp.ClientSession() as session:
-        for broker_url in BROKER_ADDRESSES:
-            url = f"{broker_url}/data/{topic}"
-            try:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        messages = await response.json()
-                        print(f"Messages from {broker_url}: {messages}")
-                    else:
-                        print(f"Failed to fetch from {broker_url}: {response.status}")
-            except Exception as e:
-                print(f"Error fetching messages from {broker_url}: {e}")
+
+async def fetch_messages(pool, topic, after=None, deadline=2.0, hedge_percentile=None):
+    """Fetch messages for a topic from all brokers concurrently, each reading different partitions, and merge them."""
+    result = await scatter_gather_fetch(
+        pool, topic, after=after, deadline=deadline, hedge_percentile=hedge_percentile
+    )
+    for broker_url, status in result["brokers"].items():
+        print(f"{broker_url}: {status}")
+    print(f"Merged {len(result['messages'])} messages for topic '{topic}' in {result['elapsed']:.3f}s:")
+    for record in result["messages"]:
+        print(f"  [{record['timestamp']}] {record['message']} (ID: {record['message_id']})")
+    print(f"Next cursor: {result['next_after']}")
+
+
+async def bench(pool, args):
+    """
+    Run the open-loop load generator, one rate step after another until the
+    brokers saturate, printing one JSON line per step and a summary line.
+    """
+    rates = [args.rate + i * args.rate_step for i in range(args.steps)]
+    output = open(args.output, "a") if args.output else None
+
+    def report(result):
+        text = json.dumps(result)
+        print(text)
+        if output:
+            output.write(text + "\n")
+
+    try:
+        summary = await run_bench(
+            pool,
+            args.topic,
+            rates,
+            args.duration,
+            topics=args.topics,
+            zipf_exponent=args.zipf,
+            subscribe_topics=args.subscribe_topics,
+            max_in_flight=args.max_in_flight,
+            message_size=args.message_size,
+            slo_ms=args.slo_ms,
+            drain=args.drain,
+            seed=args.seed,
+            report=report,
+        )
+        report(summary)
+    finally:
+        if output:
+            output.close()
+
+
+async def main(args):
+    """Run the selected client mode against a shared broker pool."""
+    async with BrokerPool(
+        BROKER_ADDRESSES,
+        registry_url=args.registry,
+        policy=args.policy,
+        connections_per_broker=args.connections,
+    ) as pool:
+        if args.mode == "publish":
+            await publish_message(pool, args.topic, args.message)
+        elif args.mode == "produce":
+            await produce_from_stdin(
+                pool, args.topic, args.batch_size, args.linger_ms, args.compression
+            )
+        elif args.mode == "subscribe":
+            await subscribe_topic_adaptive(
+                pool,
+                args.topic,
+                min_interval=1,
+                max_interval=10,
+                default_interval=5,
+                filter_spec=json.loads(args.filter) if args.filter else None,
+            )
+        elif args.mode == "fetch":
+            await fetch_messages(
+                pool,
+                args.topic,
+                after=args.after,
+                deadline=args.deadline,
+                hedge_percentile=args.hedge_percentile,
+            )
+        elif args.mode == "bench":
+            await bench(pool, args)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Client Interface for Pub-Sub System")
     parser.add_argument(
         "--mode",
-        choices=["publish", "subscribe", "fetch"],
+        choices=["publish", "produce", "subscribe", "fetch", "bench"],
         required=True,
-        help="Mode: publish, subscribe, or fetch",
+        help="Mode: publish, produce (batch-publish stdin lines), subscribe, fetch, or bench (load test)",
+    )
+    parser.add_argument(
+        "--topic", type=str, required=True, help="Topic name (topic name prefix in bench mode)"
     )
-    parser.add_argument("--topic", type=str, required=True, help="Topic name")
     parser.add_argument(
         "--message",
         type=str,
         required=False,
         help="Message to publish (if in publish mode)",
     )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        default=None,
+        help='Only receive messages matching this JSON filter, e.g. \'{"section": "world"}\' (subscribe mode)',
+    )
+    parser.add_argument(
+        "--registry",
+        type=str,
+        required=False,
+        help="Registry URL used to refresh the broker list (e.g. http://127.0.0.1:4000)",
+    )
+    parser.add_argument(
+        "--policy",
+        choices=["p2c", "least_outstanding"],
+        default="p2c",
+        help="Broker selection policy",
+    )
+    parser.add_argument(
+        "--connections", type=int, default=20, help="Connection pool size per broker"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=500, help="Messages per batch (produce mode)"
+    )
+    parser.add_argument(
+        "--linger_ms", type=int, default=5, help="Batch linger in milliseconds (produce mode)"
+    )
+    parser.add_argument(
+        "--compression",
+        choices=["gzip"],
+        default=None,
+        help="Batch compression (produce mode)",
+    )
+    parser.add_argument(
+        "--after", type=str, default=None, help="Cursor of a previous fetch to read after (fetch mode)"
+    )
+    parser.add_argument(
+        "--deadline", type=float, default=2.0, help="Fetch deadline in seconds (fetch mode)"
+    )
+    parser.add_argument(
+        "--hedge_percentile",
+        type=float,
+        default=None,
+        help="Hedge slow brokers after this latency percentile, e.g. 95 (fetch mode)",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=100, help="Target publish rate in messages/s (bench mode)"
+    )
+    parser.add_argument(
+        "--rate_step", type=float, default=100, help="Rate increase per step (bench mode)"
+    )
+    parser.add_argument(
+        "--steps", type=int, default=1, help="Number of rate steps; stops at saturation (bench mode)"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="Seconds per rate step (bench mode)"
+    )
+    parser.add_argument(
+        "--topics", type=int, default=100, help="Number of topics to spread load over (bench mode)"
+    )
+    parser.add_argument(
+        "--zipf", type=float, default=1.0, help="Zipf exponent of topic popularity (bench mode)"
+    )
+    parser.add_argument(
+        "--subscribe_topics",
+        type=int,
+        default=8,
+        help="Hottest topics to subscribe to for delivery latency (bench mode)",
+    )
+    parser.add_argument(
+        "--max_in_flight", type=int, default=1000, help="Concurrent publish cap (bench mode)"
+    )
+    parser.add_argument(
+        "--message_size", type=int, default=100, help="Message padding in bytes (bench mode)"
+    )
+    parser.add_argument(
+        "--slo_ms",
+        type=float,
+        default=100.0,
+        help="p99 publish latency above which a step counts as saturated (bench mode)",
+    )
+    parser.add_argument(
+        "--drain", type=float, default=5.0, help="Seconds to wait for deliveries after a step (bench mode)"
+    )
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for topic choice (bench mode)")
+    parser.add_argument("--output", help="Append the JSON results to this file (bench mode)")
 
     args = parser.parse_args()
 
-    if args.mode == "publish":
-        if not args.message:
-            print("Error: You must provide a message to publish in 'publish' mode.")
-        else:
-            asyncio.run(publish_message(args.topic, args.message))
-    elif args.mode == "subscribe":
-        asyncio.run(
-            subscribe_topic_adaptive(
-                args.topic, min_interval=1, max_interval=10, default_interval=5
-            )
-        )
-    elif args.mode == "fetch":
-        asyncio.run(fetch_messages(args.topic))
+    if args.mode == "publish" and not args.message:
+        print("Error: You must provide a message to publish in 'publish' mode.")
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,359 @@
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+import uuid
+
+
+class HdrHistogram:
+    """
+    Log-linear latency histogram in the style of HdrHistogram.
+
+    Values are counted in microseconds. Below ``2 ** significant_bits`` every
+    value has its own bucket; above, each power of two is split into
+    ``2 ** (significant_bits - 1)`` equal buckets, so the relative error stays
+    under ``2 ** -(significant_bits - 1)`` (under 1% by default) from
+    microseconds to minutes. Recording is a few integer operations and only
+    buckets that were hit take memory.
+    """
+
+    def __init__(self, significant_bits=8):
+        """
+        :param significant_bits: Bits of precision kept per value.
+        """
+        self.bits = significant_bits
+        self.sub_buckets = 1 << significant_bits
+        self.half = self.sub_buckets >> 1
+        self.counts = {}  # Bucket index -> count
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def _index(self, value):
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.bits
+        return self.sub_buckets + (shift - 1) * self.half + (value >> shift) - self.half
+
+    def _highest_equivalent(self, index):
+        """Largest value that falls into a bucket."""
+        if index < self.sub_buckets:
+            return index
+        shift, offset = divmod(index - self.sub_buckets, self.half)
+        return ((self.half + offset + 1) << (shift + 1)) - 1
+
+    def record(self, seconds):
+        """Record one latency, in seconds."""
+        value = max(0, int(seconds * 1_000_000))
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def value_at(self, percentile):
+        """
+        Return the latency at the given percentile, in seconds.
+
+        :param percentile: Percentile between 0 and 100.
+        :return: Latency, or 0.0 if nothing was recorded.
+        """
+        if not self.total:
+            return 0.0
+        target = max(1, math.ceil(self.total * percentile / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self._highest_equivalent(index), self.max) / 1_000_000
+        return self.max / 1_000_000
+
+    def summary(self):
+        """Count and latency percentiles in milliseconds."""
+        return {
+            "count": self.total,
+            "mean_ms": round(self.sum / self.total / 1000, 3) if self.total else 0.0,
+            "p50_ms": round(self.value_at(50) * 1000, 3),
+            "p90_ms": round(self.value_at(90) * 1000, 3),
+            "p99_ms": round(self.value_at(99) * 1000, 3),
+            "p999_ms": round(self.value_at(99.9) * 1000, 3),
+            "max_ms": round(self.max / 1000, 3),
+        }
+
+
+class ZipfTopics:
+    """Topic chooser where the topic of rank k is picked with weight 1 / k**exponent."""
+
+    def __init__(self, prefix, count, exponent=1.0):
+        """
+        :param prefix: Topic name prefix; topics are ``<prefix>0`` to ``<prefix><count-1>``.
+        :param count: Number of topics.
+        :param exponent: Zipf exponent; 0 spreads load evenly, larger values skew it.
+        """
+        self.topics = [f"{prefix}{rank}" for rank in range(count)]
+        self.cum_weights = list(
+            itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1))
+        )
+
+    def choose(self, rng):
+        """Pick a topic."""
+        return rng.choices(self.topics, cum_weights=self.cum_weights)[0]
+
+    def hottest(self, count):
+        """The ``count`` most frequently picked topics."""
+        return self.topics[:count]
+
+
+class _Step:
+    """Measurements of one rate step."""
+
+    def __init__(self, index, rate, watched):
+        self.index = index
+        self.rate = rate
+        self.publish = HdrHistogram()  # From the intended send time
+        self.service = HdrHistogram()  # From the actual send time
+        self.delivery = HdrHistogram()
+        self.per_second = {}  # Second of the step -> HdrHistogram of publish latency
+        self.errors = {}  # HTTP status or "connection" -> count
+        self.watched = dict.fromkeys(watched, 0)  # Subscribed topic -> messages published to it
+        self.delivered = 0
+        self.max_send_lag = 0.0
+        self.started = 0.0  # Loop time the step started
+        self.elapsed = 0.0
+
+    def expected_deliveries(self):
+        return sum(self.watched.values())
+
+
+class LoadGenerator:
+    """
+    Open-loop load generator.
+
+    Publishes are scheduled at fixed intended times (``i / rate`` after the
+    start of a step) and sent without waiting for earlier ones to finish.
+    Latency is measured from the intended time, not from when the request
+    actually went out, so a stall in the broker (or in this client) is
+    charged to every message that should have been sent during it. This is
+    the coordinated omission correction: a closed-loop client would simply
+    send fewer messages while the broker is slow and hide the stall. The
+    uncorrected service time is reported alongside for comparison.
+
+    Topics are chosen with a Zipf distribution. Subscribers follow the
+    sequence cursor of the hottest topics and record delivery latency from
+    the intended send time carried in each message.
+    """
+
+    def __init__(
+        self,
+        pool,
+        topics,
+        subscribe_topics=8,
+        max_in_flight=1000,
+        message_size=100,
+        poll_interval=0.05,
+        seed=None,
+    ):
+        """
+        :param pool: BrokerPool to send requests through.
+        :param topics: ZipfTopics to publish to.
+        :param subscribe_topics: Number of hottest topics to subscribe to (0 to disable).
+        :param max_in_flight: Cap on concurrent publishes; sends beyond it wait (and show as latency).
+        :param message_size: Padding added to each message, in bytes.
+        :param poll_interval: Subscriber idle poll interval in seconds.
+        :param seed: Random seed, to replay the same topic sequence.
+        """
+        self.pool = pool
+        self.topics = topics
+        self.watched = topics.hottest(subscribe_topics)
+        self.max_in_flight = max_in_flight
+        self.padding = "x" * message_size
+        self.poll_interval = poll_interval
+        self.rng = random.Random(seed)
+        self.steps = []
+        self.seen = set()
+
+    async def _send(self, step, topic, intended, sent_at):
+        """Publish one message and record its latency."""
+        loop = asyncio.get_running_loop()
+        message = json.dumps(
+            {"id": uuid.uuid4().hex, "sent": sent_at, "step": step.index, "pad": self.padding}
+        )
+        started = loop.time()
+        try:
+            _, status, _ = await self.pool.request(
+                "POST", "/publish", json={"topic": topic, "message": message}
+            )
+        except ConnectionError:
+            status = "connection"
+        now = loop.time()
+        if status != 200:
+            step.errors[str(status)] = step.errors.get(str(status), 0) + 1
+            return
+        step.publish.record(now - intended)
+        step.service.record(now - started)
+        second = int(intended - step.started)
+        if second not in step.per_second:
+            step.per_second[second] = HdrHistogram()
+        step.per_second[second].record(now - intended)
+        if topic in step.watched:
+            step.watched[topic] += 1
+
+    async def run_step(self, rate, duration, drain):
+        """
+        Publish at ``rate`` messages per second for ``duration`` seconds.
+
+        :param drain: Seconds to wait for subscribers to see the step's messages.
+        :return: The step's result dict.
+        """
+        loop = asyncio.get_running_loop()
+        step = _Step(len(self.steps), rate, self.watched)
+        self.steps.append(step)
+        total = int(rate * duration)
+        interval = 1 / rate
+        step.started = loop.time()
+        wall_started = time.time()
+        in_flight = set()
+        for i in range(total):
+            intended = step.started + i * interval
+            delay = intended - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            while len(in_flight) >= self.max_in_flight:
+                # Wait for a slot; the time spent here still counts from the intended time
+                await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            step.max_send_lag = max(step.max_send_lag, loop.time() - intended)
+            task = asyncio.create_task(
+                self._send(step, self.topics.choose(self.rng), intended, wall_started + i * interval)
+            )
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.wait(in_flight)
+        step.elapsed = loop.time() - step.started
+
+        deadline = loop.time() + drain
+        while step.delivered < step.expected_deliveries() and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        return self.result(step)
+
+    async def subscribe(self, topic):
+        """Follow a topic's sequence cursor, recording each new message's delivery latency."""
+        after = None
+        while True:
+            params = {} if after is None else {"after": after}
+            try:
+                _, status, body = await self.pool.request("GET", f"/data/{topic}", params=params)
+            except ConnectionError:
+                status, body = None, None
+            if status != 200 or not isinstance(body, dict):
+                await asyncio.sleep(self.poll_interval)
+                continue
+            now = time.time()
+            for message in body.get("messages", []):
+                try:
+                    payload = json.loads(message)
+                    message_id, sent, index = payload["id"], payload["sent"], payload["step"]
+                except (ValueError, TypeError, KeyError):
+                    continue
+                if message_id in self.seen or index >= len(self.steps):
+                    continue
+                self.seen.add(message_id)
+                step = self.steps[index]
+                step.delivery.record(now - sent)
+                step.delivered += 1
+            if body.get("next_after") is not None:
+                after = body["next_after"]
+            if not body.get("messages"):
+                await asyncio.sleep(self.poll_interval)
+
+    def result(self, step):
+        """Summarize a step as a JSON-serializable dict."""
+        published = step.publish.total
+        return {
+            "step": step.index,
+            "target_rate": step.rate,
+            "published": published,
+            "errors": step.errors,
+            "duration_s": round(step.elapsed, 3),
+            "throughput_msg_s": round(published / step.elapsed, 1) if step.elapsed else 0.0,
+            "max_send_lag_ms": round(step.max_send_lag * 1000, 3),
+            "publish_latency": step.publish.summary(),
+            "service_time": step.service.summary(),
+            "delivered": step.delivered,
+            "expected_deliveries": step.expected_deliveries(),
+            "delivery_latency": step.delivery.summary(),
+            "per_second": [
+                {
+                    "second": second,
+                    "count": histogram.total,
+                    "p99_ms": round(histogram.value_at(99) * 1000, 3),
+                    "max_ms": round(histogram.max / 1000, 3),
+                }
+                for second, histogram in sorted(step.per_second.items())
+            ],
+        }
+
+
+def is_saturated(result, slo_ms, min_ratio=0.95):
+    """
+    A step is saturated if the brokers could not keep up with the target
+    rate, or the corrected p99 publish latency exceeded the SLO.
+    """
+    if result["throughput_msg_s"] < result["target_rate"] * min_ratio:
+        return True
+    if sum(result["errors"].values()) > result["published"] * (1 - min_ratio):
+        return True
+    return result["publish_latency"]["p99_ms"] > slo_ms
+
+
+async def run_bench(
+    pool,
+    prefix,
+    rates,
+    duration,
+    topics=100,
+    zipf_exponent=1.0,
+    subscribe_topics=8,
+    max_in_flight=1000,
+    message_size=100,
+    slo_ms=100.0,
+    drain=5.0,
+    seed=None,
+    report=print,
+):
+    """
+    Run rate steps until one saturates the brokers.
+
+    :param rates: Target rates in messages per second, tried in order.
+    :param duration: Seconds per step.
+    :param slo_ms: Corrected p99 publish latency above which a step is saturated.
+    :param report: Called with each step's result dict as it finishes.
+    :return: Summary dict with the highest sustained rate and the saturating rate.
+    """
+    generator = LoadGenerator(
+        pool,
+        ZipfTopics(prefix, topics, zipf_exponent),
+        subscribe_topics=subscribe_topics,
+        max_in_flight=max_in_flight,
+        message_size=message_size,
+        seed=seed,
+    )
+    subscribers = [asyncio.create_task(generator.subscribe(topic)) for topic in generator.watched]
+    sustained, saturation = None, None
+    try:
+        for rate in rates:
+            result = await generator.run_step(rate, duration, drain)
+            result["saturated"] = is_saturated(result, slo_ms)
+            report(result)
+            if result["saturated"]:
+                saturation = rate
+                break
+            sustained = rate
+    finally:
+        for task in subscribers:
+            task.cancel()
+        await asyncio.gather(*subscribers, return_exceptions=True)
+    return {"max_sustained_rate": sustained, "saturation_rate": saturation, "slo_p99_ms": slo_ms}
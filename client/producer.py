@@ -0,0 +1,141 @@
+import asyncio
+import gzip
+import json
+import uuid
+
+
+class BatchingProducer:
+    """
+    Long-lived producer that buffers messages per topic and publishes them in
+    batches through a BrokerPool.
+
+    A topic's batch is flushed when it reaches ``batch_size`` messages,
+    ``batch_bytes`` bytes, or has lingered for ``linger_ms`` milliseconds,
+    whichever comes first. Each ``send`` returns a future resolving to the
+    broker's ack for that message.
+    """
+
+    def __init__(
+        self,
+        pool,
+        batch_size=500,
+        batch_bytes=256 * 1024,
+        linger_ms=5,
+        compression=None,
+        max_in_flight=4,
+    ):
+        """
+        :param pool: BrokerPool used to send batches.
+        :param batch_size: Maximum messages per batch.
+        :param batch_bytes: Maximum encoded message bytes per batch.
+        :param linger_ms: Maximum time a message waits for its batch to fill.
+        :param compression: None or "gzip".
+        :param max_in_flight: Maximum batches awaiting a broker response.
+        """
+        if compression not in (None, "gzip"):
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.pool = pool
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.linger = linger_ms / 1000
+        self.compression = compression
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.buffers = {}  # Topic -> list of (entry, future)
+        self.buffer_bytes = {}  # Topic -> encoded size of the buffered messages
+        self.linger_timers = {}  # Topic -> TimerHandle
+        self.pending = set()  # Flush tasks not yet finished
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+    async def send(self, topic, message, key=None):
+        """
+        Buffer a message for publishing.
+
+        Waits only when the topic's batch is full and ``max_in_flight``
+        batches are already outstanding, which bounds memory under load.
+
+        :return: Future resolving to the ack dict (message_id, partition, status).
+        """
+        future = asyncio.get_running_loop().create_future()
+        entry = {"message": message, "message_id": str(uuid.uuid4())}
+        if key is not None:
+            entry["key"] = key
+
+        buffer = self.buffers.setdefault(topic, [])
+        buffer.append((entry, future))
+        self.buffer_bytes[topic] = self.buffer_bytes.get(topic, 0) + len(
+            str(message).encode("utf-8")
+        )
+
+        if len(buffer) >= self.batch_size or self.buffer_bytes[topic] >= self.batch_bytes:
+            await self._flush_topic(topic)
+        elif topic not in self.linger_timers:
+            self.linger_timers[topic] = asyncio.get_running_loop().call_later(
+                self.linger, self._linger_expired, topic
+            )
+        return future
+
+    def _linger_expired(self, topic):
+        """Flush a topic whose oldest buffered message has waited ``linger_ms``."""
+        self.linger_timers.pop(topic, None)
+        task = asyncio.create_task(self._flush_topic(topic))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _flush_topic(self, topic):
+        """Take the topic's buffer and send it once an in-flight slot is free."""
+        timer = self.linger_timers.pop(topic, None)
+        if timer:
+            timer.cancel()
+        batch = self.buffers.pop(topic, [])
+        self.buffer_bytes.pop(topic, None)
+        if not batch:
+            return
+        await self.in_flight.acquire()
+        task = asyncio.create_task(self._send_batch(topic, batch))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _send_batch(self, topic, batch):
+        """Publish one batch and resolve the futures of its messages."""
+        try:
+            body = json.dumps(
+                {"topic": topic, "messages": [entry for entry, _ in batch]}
+            ).encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+            if self.compression == "gzip":
+                body = gzip.compress(body)
+                headers["Content-Encoding"] = "gzip"
+
+            _, status, response = await self.pool.request(
+                "POST", "/publish_batch", data=body, headers=headers
+            )
+            if status != 200 or not isinstance(response, dict):
+                raise ConnectionError(f"Batch publish failed (HTTP {status}): {response}")
+            acks = {ack["message_id"]: ack for ack in response.get("acks", [])}
+            for entry, future in batch:
+                if not future.done():
+                    future.set_result(
+                        acks.get(entry["message_id"], {"message_id": entry["message_id"], "status": "unknown"})
+                    )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.in_flight.release()
+
+    async def flush(self):
+        """Send every buffered message and wait for all batches to complete."""
+        for topic in list(self.buffers):
+            await self._flush_topic(topic)
+        while self.pending:
+            await asyncio.gather(*list(self.pending), return_exceptions=True)
+
+    async def close(self):
+        """Flush outstanding messages before the producer is discarded."""
+        await self.flush()
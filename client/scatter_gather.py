@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+
+def _order(record):
+    """Topic order: by sequence number, unnumbered legacy records first."""
+    sequence = record.get("sequence")
+    return (sequence is not None, sequence or 0, record["timestamp"], record["message_id"])
+
+
+def _parse_cursor(value):
+    """Per-partition positions of a broker's ``next_after`` (``"<partition>:<sequence>,..."``)."""
+    if not value:
+        return {}
+    return {int(p): int(sequence) for p, sequence in (position.split(":") for position in value.split(","))}
+
+
+async def _get_records(pool, stats, topic, params):
+    """
+    Read a topic from one broker.
+
+    :return: Tuple of (records, next_after, high_water).
+    """
+    started = time.monotonic()
+    stats.outstanding += 1
+    try:
+        async with pool.session_for(stats.url).get(f"/data/{topic}", params=params) as response:
+            if response.status != 200:
+                raise ConnectionError(f"HTTP {response.status}")
+            body = await response.json()
+        pool.record_success(stats, time.monotonic() - started)
+        high_water = {int(p): version for p, version in (body.get("high_water") or {}).items()}
+        return body.get("records", []), body.get("next_after"), high_water
+    except Exception:
+        pool.record_failure(stats)
+        raise
+    finally:
+        stats.outstanding -= 1
+
+
+async def _hedged_get(pool, stats, topic, params, hedge_after):
+    """
+    Read from one broker; if it has not answered after ``hedge_after``
+    seconds, send the same request to another broker as well. The first
+    answer wins.
+
+    :return: Tuple of (records, next_after, high_water, URL of the hedge broker or None).
+    """
+    first = asyncio.create_task(_get_records(pool, stats, topic, params))
+    if hedge_after is None:
+        return (*await first, None)
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    alternate = None if done else pool.pick(exclude={stats.url})
+    if alternate is None:
+        return (*await first, None)
+
+    second = asyncio.create_task(_get_records(pool, alternate, topic, params))
+    pending = {first, second}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return (*task.result(), alternate.url)
+        # Both attempts failed; surface the first error
+        return (*first.result(), alternate.url)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def scatter_gather_fetch(pool, topic, after=None, deadline=2.0, hedge_percentile=None):
+    """
+    Read a topic from every broker concurrently, each broker reading a
+    different share of the partitions, and merge the answers.
+
+    Broker ``i`` of ``n`` is asked for ``shard=i/n``: the partitions whose
+    number modulo ``n`` is ``i``. Every partition is therefore read once,
+    and each broker returns the next page of its own partitions. The
+    returned ``next_after`` moves each partition's cursor to the last
+    record read from it; the partitions of a broker that timed out or
+    failed keep their position, so the next fetch reads them again.
+
+    Staleness is reported per broker from the high-water marks (highest
+    sequence numbers) of its shard's partitions, compared with the merged
+    cursor. Sequence numbers skip ahead between blocks and terms, so the
+    lag is reported as positions rather than a message count: ``read_to``
+    holds the merged cursor of each of its partitions, ``lagging_partitions``
+    lists those whose high-water mark is past it, and ``stale_partitions``
+    lists those whose high-water mark is below the cursor the fetch started
+    from, i.e. the broker has not yet seen messages already read elsewhere.
+
+    :param pool: BrokerPool whose brokers are queried.
+    :param topic: Topic to read.
+    :param after: Cursor (``next_after`` of the previous fetch) to read after.
+    :param deadline: Seconds to wait for answers; slower brokers are reported as timed out.
+    :param hedge_percentile: If set (e.g. 95), a broker that has not answered
+                             within that percentile of recent latencies has
+                             its share requested from another broker too.
+    :return: Dict with the merged ``messages`` (records in topic sequence
+             order), the ``next_after`` cursor and per-broker ``brokers`` status
+             and staleness.
+    """
+    hedge_after = (
+        pool.latency_percentile(hedge_percentile) if hedge_percentile is not None else None
+    )
+    now = time.monotonic()
+    brokers = [stats for stats in pool.brokers.values() if stats.is_healthy(now)] or list(pool.brokers.values())
+    started = time.monotonic()
+    tasks = {}
+    for index, stats in enumerate(brokers):
+        params = {"shard": f"{index}/{len(brokers)}"}
+        if after is not None:
+            params["after"] = after
+        tasks[asyncio.create_task(_hedged_get(pool, stats, topic, params, hedge_after))] = (index, stats)
+    done, pending = await asyncio.wait(tasks, timeout=deadline) if tasks else (set(), set())
+    for task in pending:
+        task.cancel()
+
+    report = {}
+    merged = {}
+    cursor = {}
+    shard_high_water = {}  # Broker URL -> its shard's partition -> high-water mark
+    # Where the fetch started per partition; a plain number applies to every partition
+    start = _parse_cursor(after) if after and ":" in after else {}
+    start_default = int(after) if after and ":" not in after else 0
+    for task, (index, stats) in tasks.items():
+        shard = f"{index}/{len(brokers)}"
+        if task in pending:
+            report[stats.url] = {"status": "timeout", "shard": shard}
+            continue
+        if task.exception() is not None:
+            report[stats.url] = {"status": "error", "shard": shard, "error": str(task.exception())}
+            continue
+        records, next_after, high_water, hedged_to = task.result()
+        shard_high_water[stats.url] = high_water
+        for record in records:
+            merged.setdefault(record["message_id"], record)
+        # A broker only moves its own partitions; the others come back as sent
+        for p, sequence in _parse_cursor(next_after).items():
+            if p % len(brokers) == index:
+                cursor[p] = sequence
+            else:
+                cursor.setdefault(p, sequence)
+        report[stats.url] = {
+            "status": "ok",
+            "shard": shard,
+            "hedged_to": hedged_to,
+            "latency": stats.latency,
+            "count": len(records),
+        }
+
+    next_after = ",".join(f"{p}:{sequence}" for p, sequence in sorted(cursor.items())) or after
+    for url, high_water in shard_high_water.items():
+        read_to = {p: cursor.get(p, start.get(p, start_default)) for p in high_water}
+        report[url]["high_water"] = high_water
+        report[url]["read_to"] = read_to
+        report[url]["lagging_partitions"] = sorted(
+            p for p, version in high_water.items() if version is not None and version > read_to[p]
+        )
+        report[url]["stale_partitions"] = sorted(
+            p for p, version in high_water.items() if (version or 0) < start.get(p, start_default)
+        )
+    return {
+        "topic": topic,
+        "messages": sorted(merged.values(), key=_order),
+        "next_after": next_after,
+        "brokers": report,
+        "elapsed": time.monotonic() - started,
+    }
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+# Cluster bootstrap benchmark.
+#
+# Starts the registry and all brokers at the same moment (the brokers retry
+# registration until the registry answers) and measures how long it takes
+# until every broker's /ready endpoint reports ready. Repeats for several
+# rounds and prints one JSON line per round plus a summary.
+
+BROKER_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "broker"))
+
+
+def start_process(args):
+    """Start a service in a scratch directory so its app.log and database stay out of the tree."""
+    return subprocess.Popen(
+        [sys.executable] + args,
+        cwd=tempfile.mkdtemp(),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def ready_state(port):
+    """Return a broker's /ready body, or None if it is not answering yet."""
+    try:
+        return requests.get(f"http://127.0.0.1:{port}/ready", timeout=0.5).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def bootstrap(args):
+    """Start a cluster and return the seconds until every broker is ready."""
+    registry_url = f"http://127.0.0.1:{args.registry_port}"
+    ports = [args.base_port + i for i in range(args.brokers)]
+    started = time.monotonic()
+    processes = [
+        start_process([os.path.join(BROKER_DIR, "registry.py"), "--port", str(args.registry_port)])
+    ]
+    for broker_id, port in enumerate(ports, start=1):
+        processes.append(
+            start_process(
+                [
+                    os.path.join(BROKER_DIR, "broker.py"),
+                    "--broker_id", str(broker_id),
+                    "--port", str(port),
+                    "--registry", registry_url,
+                    "--advertise", f"http://127.0.0.1:{port}",
+                ]
+            )
+        )
+    try:
+        pending = set(ports)
+        deadline = started + args.timeout
+        while pending and time.monotonic() < deadline:
+            for port in list(pending):
+                state = ready_state(port)
+                if state and state["ready"]:
+                    pending.discard(port)
+            time.sleep(0.02)
+        if pending:
+            raise RuntimeError(
+                f"Not ready after {args.timeout}s: { {p: ready_state(p) for p in pending} }"
+            )
+        return time.monotonic() - started
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main(args):
+    times = []
+    for round_number in range(args.rounds):
+        elapsed = bootstrap(args)
+        times.append(elapsed)
+        print(json.dumps({"round": round_number + 1, "brokers": args.brokers, "ready_s": round(elapsed, 3)}))
+    times.sort()
+    print(
+        json.dumps(
+            {
+                "rounds": len(times),
+                "brokers": args.brokers,
+                "min_s": round(times[0], 3),
+                "median_s": round(times[len(times) // 2], 3),
+                "max_s": round(times[-1], 3),
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cluster time-to-ready.")
+    parser.add_argument("--brokers", type=int, default=10, help="Number of brokers")
+    parser.add_argument("--rounds", type=int, default=3, help="Bootstraps to measure")
+    parser.add_argument("--base_port", type=int, default=3000, help="Port of broker 1")
+    parser.add_argument("--registry_port", type=int, default=4000, help="Registry port")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for readiness")
+    main(parser.parse_args())
@@ -0,0 +1,369 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+# Multi-broker benchmark harness.
+#
+# Runs a stub registry inside this process and starts N brokers on localhost,
+# all on ephemeral ports, so it never collides with a running cluster. Once
+# every broker is ready it drives a publish workload (closed loop, a fixed
+# number of concurrent publishers) and a subscribe workload (cursor-following
+# pollers, one per topic and subscriber), then prints one JSON object:
+# throughput, publish latency percentiles, end-to-end delivery latency and
+# the inter-broker requests the brokers received during the run, taken from
+# their /metrics. Use --output to keep results for comparison across commits.
+# Every subscriber must receive every message published to its topic; if
+# any are lost the result says how many, a warning is printed and the exit
+# status is 1.
+
+BROKER_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "broker", "broker.py"))
+PEER_REQUESTS = re.compile(r'^broker_peer_requests_total\{route="([^"]*)"\} (\S+)$', re.MULTILINE)
+
+
+def free_port():
+    """Return a port the OS considers free right now."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, pct):
+    """Return the given percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+
+def summarize_ms(values):
+    """Latency summary in milliseconds."""
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "p999_ms": round(percentile(values, 99.9) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def git_commit():
+    """Commit the benchmark ran against, for comparing results."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(BROKER_SCRIPT),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StubRegistry:
+    """
+    Minimal in-process registry: registration, the /members feed (always a
+    full list with addresses), removals and load reports. No /dcnews proxy.
+    """
+
+    def __init__(self):
+        self.members = {}  # Broker ID -> advertised address
+        self.version = 0
+        self.changed = asyncio.Event()
+
+    def _bump(self):
+        self.version += 1
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def register(self, request):
+        data = await request.json()
+        broker_id = int(data["broker_id"])
+        if self.members.get(broker_id) != data.get("address"):
+            self.members[broker_id] = data.get("address")
+            self._bump()
+        return web.Response(text="Registered")
+
+    async def remove(self, request):
+        if self.members.pop(int(request.match_info["broker_id"]), None) is not None:
+            self._bump()
+        return web.Response(text="Removed")
+
+    async def members_feed(self, request):
+        since = int(request.query.get("since", -1))
+        wait = float(request.query.get("wait", 0))
+        if since == self.version and wait > 0:
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response(
+            {
+                "version": self.version,
+                "reset": True,
+                "members": list(self.members),
+                "addresses": {b: a for b, a in self.members.items() if a},
+            }
+        )
+
+    async def load(self, request):
+        await request.read()
+        return web.Response(text="Recorded")
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/register", self.register)
+        app.router.add_delete("/remove/{broker_id}", self.remove)
+        app.router.add_get("/members", self.members_feed)
+        app.router.add_post("/load", self.load)
+        # Don't wait out the brokers' /members long polls on cleanup
+        runner = web.AppRunner(app, access_log=None, shutdown_timeout=1.0)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+
+def start_brokers(count, registry_url, partitions, replication_factor):
+    """Start brokers in scratch directories; return ``(processes, ports)``."""
+    processes, ports = [], []
+    secret = secrets.token_hex(16)  # Brokers prove requests to each other with it
+    for broker_id in range(1, count + 1):
+        port = free_port()
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable, BROKER_SCRIPT,
+                    "--broker_id", str(broker_id),
+                    "--port", str(port),
+                    "--registry", registry_url,
+                    "--advertise", f"http://127.0.0.1:{port}",
+                    "--partitions", str(partitions),
+                    "--replication_factor", str(replication_factor),
+                    "--peer_secret", secret,
+                ],
+                cwd=tempfile.mkdtemp(),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        )
+        ports.append(port)
+    return processes, ports
+
+
+async def wait_ready(session, ports, timeout):
+    """Poll /ready on every broker until all are ready."""
+    deadline = time.monotonic() + timeout
+    pending = set(ports)
+    while pending:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Brokers on ports {sorted(pending)} not ready after {timeout}s")
+        for port in list(pending):
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/ready") as response:
+                    if response.status == 200:
+                        pending.discard(port)
+            except aiohttp.ClientError:
+                pass
+        await asyncio.sleep(0.05)
+
+
+async def peer_requests(session, ports):
+    """Sum each broker's broker_peer_requests_total counters by route."""
+    totals = {}
+    for port in ports:
+        async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+            text = await response.text()
+        for route, value in PEER_REQUESTS.findall(text):
+            totals[route] = totals.get(route, 0) + float(value)
+    return totals
+
+
+async def publisher(session, ports, topics, count, latencies, errors, published_ids):
+    """Publish ``count`` messages one after another to random brokers."""
+    for _ in range(count):
+        topic = random.choice(topics)
+        port = random.choice(ports)
+        message_id = str(uuid.uuid4())
+        message = json.dumps({"id": message_id, "sent": time.time()})
+        started = time.perf_counter()
+        try:
+            async with session.post(
+                f"http://127.0.0.1:{port}/publish", json={"topic": topic, "message": message}
+            ) as response:
+                await response.read()
+                ok = response.status == 200
+        except aiohttp.ClientError:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - started)
+            published_ids[topic].add(message_id)
+        else:
+            errors.append(port)
+
+
+async def subscriber(session, ports, topic, poll_interval, received, seen, delivery, stop):
+    """
+    Follow a topic's sequence cursor on one broker, recording delivery
+    latency. ``received`` collects the IDs this subscriber got, ``seen``
+    those any subscriber got.
+    """
+    port = random.choice(ports)
+    after = None
+    while not stop.is_set():
+        params = {} if after is None else {"after": after}
+        try:
+            async with session.get(f"http://127.0.0.1:{port}/data/{topic}", params=params) as response:
+                body = await response.json() if response.status == 200 else {}
+        except (aiohttp.ClientError, ValueError):
+            body = {}
+        now = time.time()
+        for message in body.get("messages", []):
+            try:
+                payload = json.loads(message)
+            except ValueError:
+                continue
+            received.add(payload["id"])
+            if payload["id"] not in seen:
+                seen.add(payload["id"])
+                delivery.append(now - payload["sent"])
+        if body.get("next_after") is not None:
+            after = body["next_after"]
+        if not body.get("messages"):
+            await asyncio.sleep(poll_interval)
+
+
+async def run(args):
+    registry = StubRegistry()
+    registry_port = free_port()
+    registry_runner = await registry.start(registry_port)
+    processes, ports = start_brokers(
+        args.brokers, f"http://127.0.0.1:{registry_port}", args.partitions, args.replication_factor
+    )
+    topics = [f"bench{i}" for i in range(args.topics)]
+    connector = aiohttp.TCPConnector(limit=args.publishers + args.subscribers * args.topics + 10)
+    try:
+        async with aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=10)
+        ) as session:
+            await wait_ready(session, ports, args.ready_timeout)
+            before = await peer_requests(session, ports)
+
+            latencies, errors, delivery, seen = [], [], [], set()
+            published_ids = {topic: set() for topic in topics}
+            received = [(topic, set()) for topic in topics for _ in range(args.subscribers)]
+            stop = asyncio.Event()
+            subscribers = [
+                asyncio.create_task(
+                    subscriber(session, ports, topic, args.poll_interval, ids, seen, delivery, stop)
+                )
+                for topic, ids in received
+            ]
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(
+                    publisher(
+                        session,
+                        ports,
+                        topics,
+                        args.messages // args.publishers + (i < args.messages % args.publishers),
+                        latencies,
+                        errors,
+                        published_ids,
+                    )
+                    for i in range(args.publishers)
+                )
+            )
+            elapsed = time.perf_counter() - started
+
+            def missing():
+                """Published messages some subscriber of their topic has not received."""
+                lost = set()
+                for topic, ids in received:
+                    lost |= published_ids[topic] - ids
+                return lost
+
+            # Give subscribers time to catch up before stopping them
+            drain_deadline = time.monotonic() + args.drain
+            while missing() and time.monotonic() < drain_deadline:
+                await asyncio.sleep(0.1)
+            lost = len(missing())
+            stop.set()
+            await asyncio.gather(*subscribers)
+
+            after = await peer_requests(session, ports)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        await registry_runner.cleanup()
+
+    inter_broker = {
+        route: int(after.get(route, 0) - before.get(route, 0))
+        for route in sorted(set(after) | set(before))
+        if after.get(route, 0) - before.get(route, 0) > 0
+    }
+    published = len(latencies)
+    return {
+        "commit": git_commit(),
+        "config": vars(args),
+        "published": published,
+        "errors": len(errors),
+        "duration_s": round(elapsed, 3),
+        "throughput_msg_s": round(published / elapsed, 1) if elapsed else 0.0,
+        "publish_latency": summarize_ms(latencies),
+        "delivered": len(seen),
+        "lost": lost,
+        "loss_ratio": round(lost / published, 6) if published else 0.0,
+        "delivery_latency": summarize_ms(delivery),
+        "inter_broker_requests": {
+            "total": sum(inter_broker.values()),
+            "per_message": round(sum(inter_broker.values()) / published, 2) if published else 0.0,
+            "by_route": inter_broker,
+        },
+    }
+
+
+def main(args):
+    result = asyncio.run(run(args))
+    text = json.dumps(result)
+    print(text)
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write(text + "\n")
+    if result["lost"]:
+        print(
+            f"WARNING: {result['lost']} of {result['published']} published messages "
+            f"({result['loss_ratio']:.2%}) did not reach every subscriber of their topic "
+            f"within {args.drain}s.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark a local multi-broker cluster.")
+    parser.add_argument("--brokers", type=int, default=3, help="Number of brokers")
+    parser.add_argument("--partitions", type=int, default=8, help="Partitions per topic")
+    parser.add_argument("--replication_factor", type=int, default=3, help="Copies of each partition")
+    parser.add_argument("--topics", type=int, default=4, help="Number of topics")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages to publish in total")
+    parser.add_argument("--publishers", type=int, default=16, help="Concurrent publishers")
+    parser.add_argument("--subscribers", type=int, default=1, help="Subscribers per topic (0 to disable)")
+    parser.add_argument("--poll_interval", type=float, default=0.05, help="Subscriber idle poll interval in seconds")
+    parser.add_argument("--drain", type=float, default=10, help="Seconds to let subscribers catch up")
+    parser.add_argument("--ready_timeout", type=float, default=60, help="Seconds to wait for readiness")
+    parser.add_argument("--output", help="Append the JSON result to this file")
+    main(parser.parse_args())
@@ -0,0 +1,12 @@
+# tests/conftest.py
+
+import os
+import sys
+
+# Broker and client modules import each other by bare name, as when run as scripts
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ("broker", "client"):
+    sys.path.insert(0, os.path.join(ROOT, directory))
+
+# Manual scripts against a running cluster (python tests/<script>.py), not unit tests
+collect_ignore = ["test_broker.py", "test_cursor_reads.py", "test_leader_election.py", "test_publish.py"]
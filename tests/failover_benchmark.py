@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+# Leader failover benchmark.
+#
+# Starts a registry and a few brokers on localhost, waits until every broker
+# follows the same leader, kills the leader with SIGKILL and measures how long
+# the survivors take to agree on a new leader with a higher term. Repeats for
+# several rounds, restarting the killed broker in between.
+
+BROKER_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "broker"))
+
+
+def start_process(args, workdir):
+    """Start a service in its own directory so its app.log and database stay out of the tree."""
+    return subprocess.Popen(
+        [sys.executable] + args,
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def start_broker(broker_id, base_port, registry_url):
+    port = base_port + broker_id - 1
+    return start_process(
+        [
+            os.path.join(BROKER_DIR, "broker.py"),
+            "--broker_id", str(broker_id),
+            "--port", str(port),
+            "--registry", registry_url,
+            "--advertise", f"http://127.0.0.1:{port}",
+        ],
+        tempfile.mkdtemp(),
+    )
+
+
+def leader_views(ports):
+    """Return each reachable broker's (leader, term), keyed by port."""
+    views = {}
+    for port in ports:
+        try:
+            status = requests.get(f"http://127.0.0.1:{port}/leader", timeout=0.5).json()
+            views[port] = (status["leader"], status["term"])
+        except (requests.RequestException, ValueError):
+            pass
+    return views
+
+
+def wait_for_agreement(ports, min_term=0, timeout=60):
+    """Poll until every broker in ``ports`` follows the same leader in a term above ``min_term``."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        views = leader_views(ports)
+        agreed = set(views.values())
+        if len(views) == len(ports) and len(agreed) == 1:
+            leader, term = agreed.pop()
+            if leader is not None and term > min_term:
+                return leader, term
+        time.sleep(0.05)
+    raise RuntimeError(f"No agreement on a leader within {timeout}s: {leader_views(ports)}")
+
+
+def main(args):
+    registry_url = f"http://127.0.0.1:{args.registry_port}"
+    registry = start_process(
+        [os.path.join(BROKER_DIR, "registry.py"), "--port", str(args.registry_port)],
+        tempfile.mkdtemp(),
+    )
+    time.sleep(1)
+    brokers = {
+        broker_id: start_broker(broker_id, args.base_port, registry_url)
+        for broker_id in range(1, args.brokers + 1)
+    }
+    ports = {broker_id: args.base_port + broker_id - 1 for broker_id in brokers}
+    results = []
+    try:
+        leader, term = wait_for_agreement(list(ports.values()))
+        for round_number in range(args.rounds):
+            brokers[leader].send_signal(signal.SIGKILL)
+            brokers[leader].wait()
+            killed_at = time.monotonic()
+            survivors = [port for broker_id, port in ports.items() if broker_id != leader]
+            new_leader, new_term = wait_for_agreement(survivors, min_term=term)
+            results.append(
+                {
+                    "round": round_number + 1,
+                    "killed": leader,
+                    "new_leader": new_leader,
+                    "term": new_term,
+                    "failover_s": round(time.monotonic() - killed_at, 3),
+                }
+            )
+            print(json.dumps(results[-1]))
+
+            # Bring the killed broker back and let it follow the new leader
+            brokers[leader] = start_broker(leader, args.base_port, registry_url)
+            leader, term = wait_for_agreement(list(ports.values()), min_term=new_term - 1)
+    finally:
+        for process in list(brokers.values()) + [registry]:
+            process.terminate()
+            process.wait()
+
+    times = sorted(result["failover_s"] for result in results)
+    print(
+        json.dumps(
+            {
+                "rounds": len(times),
+                "min_s": times[0],
+                "median_s": times[len(times) // 2],
+                "max_s": times[-1],
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure leader failover time.")
+    parser.add_argument("--brokers", type=int, default=3, help="Number of brokers")
+    parser.add_argument("--rounds", type=int, default=3, help="Leader kills to measure")
+    parser.add_argument("--base_port", type=int, default=3000, help="Port of broker 1")
+    parser.add_argument("--registry_port", type=int, default=4000, help="Registry port")
+    main(parser.parse_args())
@@ -0,0 +1,143 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+
+# Load test for the registry's /dcnews proxy.
+#
+# Starts the registry, a stub broker that answers /publish and /data/{topic}
+# after a fixed delay, registers the stub, and fires concurrent requests at
+# /dcnews. Reports throughput and latency percentiles, i.e. how many requests
+# the registry can keep in flight to a slow broker.
+
+REGISTRY_SCRIPT = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "broker", "registry.py")
+)
+
+
+def percentile(sorted_values, pct):
+    """Return the given percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+
+async def start_stub_broker(port, delay):
+    """Run a broker stand-in that answers after ``delay`` seconds."""
+
+    async def publish(request):
+        await request.read()
+        await asyncio.sleep(delay)
+        return web.json_response({"status": "success"})
+
+    async def get_data(request):
+        await asyncio.sleep(delay)
+        topic = request.match_info["topic"]
+        return web.json_response({"topic": topic, "messages": ["stub"] * 5})
+
+    app = web.Application()
+    app.router.add_post("/publish", publish)
+    app.router.add_get("/data/{topic}", get_data)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def wait_for_registry(session, registry_url, timeout=10):
+    """Poll the registry until it answers /members."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{registry_url}/members") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Registry did not start in time.")
+
+
+async def run_load(registry_url, total, concurrency, method):
+    """Send ``total`` requests to /dcnews with at most ``concurrency`` in flight."""
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def one(i):
+            nonlocal failures
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    if method == "POST":
+                        request = session.post(
+                            f"{registry_url}/dcnews",
+                            json={"topic": "load", "message": f"message {i}"},
+                        )
+                    else:
+                        request = session.get(f"{registry_url}/dcnews", params={"topic": "load"})
+                    async with request as response:
+                        await response.read()
+                        if response.status != 200:
+                            failures += 1
+                            return
+                    latencies.append(time.monotonic() - started)
+                except aiohttp.ClientError:
+                    failures += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "failures": failures,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def main(args):
+    registry_url = f"http://127.0.0.1:{args.registry_port}"
+    registry = subprocess.Popen(
+        [sys.executable, REGISTRY_SCRIPT, "--port", str(args.registry_port)],
+        cwd=tempfile.mkdtemp(),  # Keep the registry's app.log out of the tree
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # The registry routes to localhost:300{id-1}; broker 1 listens on 3000.
+    stub = await start_stub_broker(3000, args.delay)
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_for_registry(session, registry_url)
+            async with session.post(f"{registry_url}/register", json={"broker_id": 1}):
+                pass
+
+        for method in ("POST", "GET"):
+            result = await run_load(registry_url, args.requests, args.concurrency, method)
+            print(f"{method} /dcnews: {result}")
+    finally:
+        await stub.cleanup()
+        registry.terminate()
+        registry.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the registry's /dcnews proxy.")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per method")
+    parser.add_argument("--concurrency", type=int, default=200, help="Requests in flight")
+    parser.add_argument("--delay", type=float, default=0.05, help="Stub broker delay in seconds")
+    parser.add_argument("--registry_port", type=int, default=4000, help="Registry port")
+    asyncio.run(main(parser.parse_args()))
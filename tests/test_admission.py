@@ -0,0 +1,61 @@
+# tests/test_admission.py
+
+from types import SimpleNamespace
+
+import pytest
+
+from admission import AdmissionControl, TokenBucket
+
+
+def test_bucket_starts_full_and_refills_at_rate():
+    bucket = TokenBucket(rate=10, burst=5)
+    now = bucket.updated
+    for _ in range(5):
+        assert bucket.take(1, now) == 0
+    assert bucket.take(1, now) == pytest.approx(0.1)
+    assert bucket.take(1, now + 0.05) == pytest.approx(0.05)
+    assert bucket.take(1, now + 0.1) == 0
+    # Refill stops at the burst size
+    bucket.take(0, now + 60)
+    assert bucket.tokens == 5
+
+
+def test_refill_on_time_despite_float_residue():
+    bucket = TokenBucket(rate=10, burst=1)
+    bucket.tokens, bucket.updated = 0, 1234.7
+    # (1234.8 - 1234.7) * 10 is just under 1
+    assert bucket.take(1, 1234.8) == 0
+
+
+def test_batches_larger_than_burst_go_into_debt():
+    bucket = TokenBucket(rate=10, burst=5)
+    now = bucket.updated
+    assert bucket.take(20, now) == 0
+    assert bucket.tokens == -15
+    # Waits for the debt to be paid and a full burst
+    assert bucket.take(5, now) == pytest.approx(2.0)
+    assert bucket.take(5, now + 2.0) == 0
+
+
+def request(remote, **headers):
+    return SimpleNamespace(remote=remote, headers=headers)
+
+
+def test_publishers_are_keyed_by_address_unless_proxied():
+    admission = AdmissionControl(lambda: 0, trusted_proxies=["10.0.0.1"])
+    spoofed = {"X-Publisher-Id": "someone-else", "X-Forwarded-For": "1.2.3.4"}
+    assert admission.publisher_of(request("10.0.0.9", **spoofed)) == "10.0.0.9"
+    assert admission.publisher_of(request("10.0.0.1", **{"X-Forwarded-For": "6.6.6.6, 10.0.0.7"})) == "10.0.0.7"
+    assert admission.publisher_of(request("10.0.0.1", **{"X-Publisher-Id": "feed-1"})) == "feed-1"
+    assert admission.publisher_of(request("10.0.0.1")) == "10.0.0.1"
+
+
+def test_rate_limits_refuse_with_retry_after():
+    admission = AdmissionControl(lambda: 0, publisher_rate=1, publisher_burst=2)
+    client = request("10.0.0.9")
+    assert admission.check_rate(client, "news") is None
+    assert admission.check_rate(client, "news") is None
+    response = admission.check_rate(client, "news")
+    assert response.status == 429
+    assert response.headers["Retry-After"] == "1"
+    assert admission.check_rate(request("10.0.0.8"), "news") is None
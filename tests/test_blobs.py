@@ -0,0 +1,38 @@
+# tests/test_blobs.py
+
+import asyncio
+import hashlib
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from blobs import BlobStore
+from peers import PEER_HEADER, PeerDirectory
+
+
+def test_only_peers_may_push_blobs(tmp_path):
+    store = BlobStore(str(tmp_path), PeerDirectory(1))
+    body = b"x" * 1000
+    digest = hashlib.sha256(body).hexdigest()
+
+    async def run():
+        app = web.Application()
+        app.router.add_put("/blobs/{digest}", store.handle_put)
+        server = TestServer(app, host="127.0.0.1")
+        await server.start_server()
+        try:
+            async with ClientSession() as session:
+                url = server.make_url(f"/blobs/{digest}")
+                async with session.put(url, data=body) as resp:
+                    refused = resp.status
+                stored_before = store.exists(digest)
+                async with session.put(url, data=body, headers={PEER_HEADER: "2"}) as resp:
+                    accepted = resp.status
+        finally:
+            await server.close()
+        return refused, stored_before, accepted
+
+    refused, stored_before, accepted = asyncio.run(run())
+    assert (refused, stored_before) == (403, False)
+    assert accepted == 201
+    assert store.exists(digest)
@@ -0,0 +1,97 @@
+# tests/test_cursor_reads.py
+# Starts real brokers, so it is not collected by pytest; run it by hand
+
+import asyncio
+import random
+import time
+import uuid
+
+import aiohttp
+
+from cluster_benchmark import StubRegistry, free_port, start_brokers, wait_ready
+
+BROKERS = 3
+TOPIC = "cursor"
+
+
+async def publish_all(session, ports, count):
+    """Publish ``count`` messages to random brokers, singly and in batches; return their IDs."""
+    published = set()
+
+    async def publish_one():
+        message_id = str(uuid.uuid4())
+        async with session.post(
+            f"http://127.0.0.1:{random.choice(ports)}/publish",
+            json={"topic": TOPIC, "message": message_id, "message_id": message_id},
+        ) as response:
+            assert response.status == 200, await response.text()
+        published.add(message_id)
+
+    async def publish_batch(size):
+        ids = [str(uuid.uuid4()) for _ in range(size)]
+        async with session.post(
+            f"http://127.0.0.1:{random.choice(ports)}/publish_batch",
+            json={"topic": TOPIC, "messages": [{"message": i, "message_id": i} for i in ids]},
+        ) as response:
+            assert response.status == 200, await response.text()
+            assert all(ack["status"] == "success" for ack in (await response.json())["acks"])
+        published.update(ids)
+
+    # In rounds, so readers catch up between them and their cursors move past
+    # the numbers handed out so far
+    for _ in range(count // 20):
+        await asyncio.gather(*(publish_one() for _ in range(10)), publish_batch(10))
+        await asyncio.sleep(0.05)
+    return published
+
+
+async def follow(session, port, expected, stop):
+    """Follow the topic's cursor on one broker while publishes go on; return what it read."""
+    received, after = [], None
+    while True:
+        params = {} if after is None else {"after": after}
+        async with session.get(f"http://127.0.0.1:{port}/data/{TOPIC}", params=params) as response:
+            body = await response.json()
+        received.extend(body["messages"])
+        after = body.get("next_after") or after
+        if not body["messages"]:
+            if stop.is_set() and set(received) >= expected():
+                return received
+            await asyncio.sleep(0.02)
+
+
+async def run():
+    registry = StubRegistry()
+    registry_port = free_port()
+    runner = await registry.start(registry_port)
+    processes, ports = start_brokers(BROKERS, f"http://127.0.0.1:{registry_port}", 8, 2)
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+            await wait_ready(session, ports, 60)
+            published, stop = set(), asyncio.Event()
+            readers = [asyncio.create_task(follow(session, port, lambda: published, stop)) for port in ports]
+            published |= await publish_all(session, ports, 400)
+            stop.set()
+            deadline = time.monotonic() + 20
+            done, pending = await asyncio.wait(readers, timeout=max(0, deadline - time.monotonic()))
+            for reader in pending:
+                reader.cancel()
+            assert not pending, "A reader did not receive every published message"
+            return published, [reader.result() for reader in readers]
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        await runner.cleanup()
+
+
+def test_cursor_reads_every_message_once_on_every_broker():
+    published, received = asyncio.run(run())
+    for messages in received:
+        assert sorted(messages) == sorted(published)
+
+
+if __name__ == "__main__":
+    test_cursor_reads_every_message_once_on_every_broker()
+    print("Every broker's cursor reads returned every message exactly once.")
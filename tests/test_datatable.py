@@ -0,0 +1,23 @@
+# tests/test_datatable.py
+
+from datatable import DataStore
+
+
+def test_schema_statements_run_once_per_table(tmp_path):
+    store = DataStore(str(tmp_path / "data_store.db"))
+    store.store_message("news", "first", "m1", partition=0, sequence=1)
+    statements = []
+    store.conn.set_trace_callback(statements.append)
+    store.store_message("news", "second", "m2", partition=0, sequence=2)
+    store.store_messages("news", [{"message": "third", "message_id": "m3", "partition": 1, "sequence": 3}])
+    assert not [s for s in statements if s.lstrip().startswith(("CREATE", "ALTER", "PRAGMA"))]
+    store.close()
+
+
+def test_dropped_table_is_created_again(tmp_path):
+    store = DataStore(str(tmp_path / "data_store.db"))
+    store.store_message("news", "first", "m1", partition=0, sequence=1)
+    store.delete_topic("news")
+    assert store.store_message("news", "again", "m2", partition=0, sequence=1)
+    assert [record["message_id"] for record in store.get_records("news")] == ["m2"]
+    store.close()
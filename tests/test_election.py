@@ -0,0 +1,53 @@
+# tests/test_election.py
+
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from aiohttp.test_utils import make_mocked_request
+
+from election import MAX_TERM_STEP, LeaderElection
+from sequencing import MAX_TERM
+
+
+def election(members=(1, 2, 3)):
+    return LeaderElection(1, [2, 3], SimpleNamespace(members=set(members), seeded=True))
+
+
+def announce(node, body, sender=None):
+    headers = {} if sender is None else {"X-Broker-Id": str(sender)}
+    request = make_mocked_request("POST", "/leader_announcement", headers=headers)
+
+    async def read_json():
+        return body
+
+    request.json = read_json
+    response = asyncio.run(node.handle_announcement(request))
+    return response.status, json.loads(response.body)
+
+
+def test_announcements_need_a_proven_peer_announcing_itself():
+    node = election()
+    assert announce(node, {"leader_id": 3, "term": 1})[0] == 403
+    assert announce(node, {"leader_id": 3, "term": 1}, sender=2)[0] == 403
+    assert announce(node, {"leader_id": 3, "term": 1}, sender=3)[0] == 200
+    assert (node.leader, node.term) == (3, 1)
+
+
+def test_non_members_are_rejected():
+    node = election(members=(1, 2))
+    assert announce(node, {"leader_id": 3, "term": 1}, sender=3)[0] == 409
+    assert node.leader is None
+
+
+def test_terms_are_bounded():
+    node = election()
+    assert announce(node, {"leader_id": 3, "term": MAX_TERM + 1}, sender=3)[0] == 400
+    assert announce(node, {"leader_id": 3, "term": "7"}, sender=3)[0] == 400
+    assert announce(node, {"leader_id": 3, "term": 5}, sender=3)[0] == 200
+    # While a lease is current the term may only step ahead so far
+    assert node.lease_expires > time.monotonic()
+    assert announce(node, {"leader_id": 3, "term": 6 + MAX_TERM_STEP}, sender=3)[0] == 400
+    assert announce(node, {"leader_id": 3, "term": 5 + MAX_TERM_STEP}, sender=3)[0] == 200
+    assert node.term == 5 + MAX_TERM_STEP
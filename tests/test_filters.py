@@ -0,0 +1,125 @@
+# tests/test_filters.py
+
+import pytest
+
+from filters import Filter, FilterError, FilterIndex, SubscriptionFilters, as_document
+
+
+def index_of(*filters):
+    index = FilterIndex()
+    for compiled in filters:
+        index.add(compiled)
+    return index
+
+
+def test_index_matches_like_direct_evaluation():
+    filters = [
+        Filter("news", {"section": "world"}),
+        Filter("news", {"region": {"in": ["eu", "us"]}, "priority": {"gte": 3}}),
+        Filter("news", {"priority": {"gt": 2, "lt": 5}}),
+        Filter("news", {"headline": {"match": ["storm", "flood"]}}),
+        Filter("news", {"meta.source": "reuters", "section": {"in": ["world", "sport"]}}),
+        Filter("news", {}),
+    ]
+    index = index_of(*filters)
+    documents = [
+        {"section": "world", "region": "eu", "priority": 3, "headline": "Storm hits coast"},
+        {"section": "sport", "region": "asia", "priority": 5, "meta": {"source": "reuters"}},
+        {"section": "world", "priority": "3", "headline": "Floods recede"},
+        {"region": ["us", "ca"], "priority": 8.5},
+        {"priority": True},
+        {},
+    ]
+    for document in documents:
+        expected = {f.id for f in filters if f.matches(document)}
+        assert index.match(document) == expected
+
+
+def test_ranges_and_kinds():
+    gt = Filter("t", {"n": {"gt": 2}})
+    lte = Filter("t", {"n": {"lte": 2}})
+    word = Filter("t", {"s": {"gte": "m"}})
+    index = index_of(gt, lte, word)
+    assert index.match({"n": 2}) == {lte.id}
+    assert index.match({"n": 2.5}) == {gt.id}
+    assert index.match({"n": "3"}) == set()  # Strings never satisfy numeric bounds
+    assert index.match({"s": "m"}) == {word.id}
+    assert index.match({"s": "a"}) == set()
+    assert Filter("t", {"b": 1}).id not in index_of(Filter("t", {"b": 1})).match({"b": True})
+
+
+def test_remove_frees_predicates():
+    first = Filter("t", {"a": 1, "b": {"match": "storm"}})
+    second = Filter("t", {"a": 1})
+    index = index_of(first, second)
+    index.remove(first.id)
+    assert len(index) == 1
+    assert index.match({"a": 1, "b": "storm"}) == {second.id}
+    index.remove(second.id)
+    assert index.fields == {}
+    assert index.match({"a": 1}) == set()
+
+
+def test_same_filter_in_any_key_order_has_one_id():
+    first = Filter("t", {"a": 1, "b": {"lt": 3, "gt": 0}})
+    second = Filter("t", {"b": {"gt": 0, "lt": 3}, "a": 1})
+    assert first.id == second.id
+    index = index_of(first)
+    index.add(second)
+    index.remove(second.id)
+    assert len(index) == 0 and index.fields == {}
+
+
+@pytest.mark.parametrize("spec", [
+    [], {"a": {"between": [1, 2]}}, {"a": {"in": []}}, {"a": {"match": ["..."]}}, {"a": {"gt": [1]}}, {"a": {}},
+])
+def test_malformed_filters_are_rejected(spec):
+    with pytest.raises(FilterError):
+        Filter("t", spec)
+
+
+def test_non_json_messages_match_as_text():
+    compiled = Filter("t", {"message": {"match": "storm"}})
+    assert compiled.matches(as_document("A storm is coming"))
+    assert as_document('{"a": 1}') == {"a": 1}
+    assert as_document("[1, 2]") == {"message": [1, 2]}
+
+
+def test_matches_are_indexed_by_sequence():
+    filters = SubscriptionFilters(directory=None, max_matches=3)
+    compiled = filters.register("news", {"section": "world"})
+    for sequence, section in [(5, "world"), (2, "world"), (9, "sport"), (7, "world"), (11, "world")]:
+        filters.on_stored("news", 0, sequence, f'{{"section": "{section}"}}')
+    filters.on_stored("news", 1, 4, '{"section": "world"}')
+    # Only the latest max_matches are kept, sorted however they arrived
+    assert filters.sequences(compiled.id, 0) == [5, 7, 11]
+    assert filters.sequences(compiled.id, 0, after=5) == [7, 11]
+    assert filters.sequences(compiled.id, 0, after=5, limit=1) == [7]
+    assert filters.sequences(compiled.id, 1) == [4]
+    assert filters.version(compiled.id, 0) == 11
+    assert filters.version(compiled.id, 2) is None
+    assert sum(filters.match_counts[compiled.id].values()) == 5
+    assert filters.sequences("unknown", 0) == []
+
+
+def test_register_is_idempotent_and_unregister_drops_matches():
+    filters = SubscriptionFilters(directory=None)
+    compiled = filters.register("news", {"section": "world"})
+    assert filters.register("news", {"section": "world"}) is compiled
+    assert filters.get(compiled.id, "other") is None
+    assert filters.unregister(compiled.id)
+    assert not filters.active("news")
+    assert not filters.unregister(compiled.id)
+
+
+def test_filters_follow_the_topic_table_name():
+    # "Breaking News" is stored in the table breaking_news, whatever spelling published it
+    filters = SubscriptionFilters(directory=None)
+    compiled = filters.register("Breaking News", {"section": "world"})
+    assert filters.active("breaking-news")
+    filters.on_stored("breaking_news", 0, 3, '{"section": "world"}')
+    filters.on_stored("BREAKING NEWS", 0, 8, '{"section": "world"}')
+    assert filters.sequences(compiled.id, 0) == [3, 8]
+    assert filters.get(compiled.id, "breaking-news") is compiled
+    assert filters.unregister(compiled.id)
+    assert not filters.active("Breaking News")
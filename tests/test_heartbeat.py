@@ -0,0 +1,62 @@
+# tests/test_heartbeat.py
+
+import pytest
+
+from heartbeat import PhiAccrualFailureDetector
+
+
+def steady_detector(interval=1.0, beats=20):
+    detector = PhiAccrualFailureDetector(first_interval=interval)
+    now = detector.last_heartbeat
+    for _ in range(beats):
+        now += interval
+        detector.heartbeat(now)
+    return detector, now
+
+
+def test_phi_is_near_zero_right_after_a_heartbeat():
+    detector, now = steady_detector()
+    assert detector.phi(now) < 0.05
+
+
+def test_phi_is_about_a_coin_flip_at_the_mean_interval():
+    detector, now = steady_detector()
+    # The logistic approximation gives exactly -log10(0.5) at the mean
+    assert detector.phi(now + 1.0) == pytest.approx(0.301, abs=0.01)
+
+
+def test_phi_grows_with_silence():
+    detector, now = steady_detector()
+    values = [detector.phi(now + elapsed) for elapsed in (0.5, 1.0, 2.0, 3.0, 4.0)]
+    assert values == sorted(values)
+    assert values[-1] > 8  # Past the default threshold after 4 missed beats
+
+
+def test_acceptable_pause_delays_suspicion():
+    strict, now = steady_detector()
+    lenient = PhiAccrualFailureDetector(first_interval=1.0, acceptable_pause=2.0)
+    lenient.intervals, lenient.last_heartbeat = strict.intervals, strict.last_heartbeat
+    assert lenient.phi(now + 3.0) < strict.phi(now + 3.0)
+
+
+def test_touch_resets_silence_without_sampling():
+    detector, now = steady_detector()
+    samples = list(detector.intervals)
+    for step in range(1, 50):
+        detector.touch(now + step * 0.01)
+    assert list(detector.intervals) == samples
+    assert detector.phi(now + 0.5) < 0.05
+    # A touch from the past never moves the last contact back
+    detector.touch(now - 10)
+    assert detector.last_heartbeat == pytest.approx(now + 0.49)
+
+
+def test_irregular_heartbeats_widen_the_distribution():
+    regular, now = steady_detector()
+    irregular = PhiAccrualFailureDetector(first_interval=1.0)
+    at = irregular.last_heartbeat
+    for interval in [0.2, 2.0] * 10:
+        at += interval
+        irregular.heartbeat(at)
+    # Same mean interval, but a long gap is less surprising
+    assert irregular.phi(at + 3.0) < regular.phi(now + 3.0)
@@ -0,0 +1,91 @@
+# tests/test_load_generator.py
+
+import math
+import random
+
+import pytest
+
+from load_generator import HdrHistogram, ZipfTopics, is_saturated
+
+
+def exact_percentile(values, percentile):
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(len(ordered) * percentile / 100)) - 1]
+
+
+def test_empty_histogram_reports_zero():
+    histogram = HdrHistogram()
+    assert histogram.value_at(99) == 0.0
+    assert histogram.summary()["count"] == 0
+
+
+def test_small_values_are_exact():
+    histogram = HdrHistogram()
+    for micros in range(1, 101):
+        histogram.record(micros / 1_000_000)
+    assert histogram.value_at(50) == pytest.approx(50e-6)
+    assert histogram.value_at(100) == pytest.approx(100e-6)
+
+
+def test_every_value_falls_in_a_bucket_that_holds_it():
+    histogram = HdrHistogram()
+    previous_index = -1
+    for value in range(0, 1 << 16):
+        index = histogram._index(value)
+        assert index >= previous_index  # Buckets are ordered like values
+        assert value <= histogram._highest_equivalent(index)
+        if index > 0:
+            assert histogram._highest_equivalent(index - 1) < value
+        previous_index = index
+
+
+@pytest.mark.parametrize("significant_bits", [6, 8, 10])
+def test_percentiles_stay_within_precision(significant_bits):
+    rng = random.Random(7)
+    # Microseconds to seconds, heavy tailed like real latencies
+    values = [rng.lognormvariate(math.log(0.005), 1.5) for _ in range(20000)]
+    histogram = HdrHistogram(significant_bits)
+    for value in values:
+        histogram.record(value)
+    error = 2 ** -(significant_bits - 1)
+    for percentile in (1, 50, 90, 99, 99.9, 100):
+        exact = int(exact_percentile(values, percentile) * 1_000_000) / 1_000_000
+        reported = histogram.value_at(percentile)
+        # Reported as the top of the bucket: never below, at most one bucket above
+        assert exact <= reported <= exact * (1 + error) + 1e-6
+
+
+def test_summary_is_in_milliseconds():
+    histogram = HdrHistogram()
+    for value in (0.001, 0.002, 0.003, 0.004):
+        histogram.record(value)
+    summary = histogram.summary()
+    assert summary["count"] == 4
+    assert summary["mean_ms"] == pytest.approx(2.5)
+    assert summary["max_ms"] == pytest.approx(4.0)
+    assert summary["p50_ms"] == pytest.approx(2.0, rel=0.01)
+
+
+def test_zipf_topics_favour_the_hottest():
+    topics = ZipfTopics("t", 10, exponent=1.2)
+    rng = random.Random(3)
+    picks = [topics.choose(rng) for _ in range(5000)]
+    assert picks.count("t0") > picks.count("t1") > picks.count("t9")
+    assert topics.hottest(2) == ["t0", "t1"]
+    uniform = ZipfTopics("t", 4, exponent=0)
+    counts = [sum(pick == f"t{rank}" for pick in (uniform.choose(rng) for _ in range(4000))) for rank in range(4)]
+    assert max(counts) - min(counts) < 300
+
+
+def test_saturation_by_throughput_errors_or_latency():
+    result = {
+        "target_rate": 100,
+        "throughput_msg_s": 99,
+        "published": 1000,
+        "errors": {"timeout": 0},
+        "publish_latency": {"p99_ms": 40},
+    }
+    assert not is_saturated(result, slo_ms=50)
+    assert is_saturated({**result, "throughput_msg_s": 90}, slo_ms=50)
+    assert is_saturated({**result, "errors": {"timeout": 60}}, slo_ms=50)
+    assert is_saturated(result, slo_ms=30)
@@ -0,0 +1,91 @@
+# tests/test_membership.py
+
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, make_mocked_request
+
+from membership import ALIVE, SUSPECT, Membership
+from peers import PeerDirectory
+
+SECRET = "cluster-secret"
+
+
+def member(broker_id, address=None, secret=SECRET):
+    return Membership(broker_id, address=address, directory=PeerDirectory(broker_id, secret=secret))
+
+
+def test_addresses_are_only_taken_from_their_owner():
+    node = member(1)
+    update = member(2, address="http://10.0.0.2:3001")._self_update()
+    node._apply(update)
+    assert node.directory.address_of(2) == "http://10.0.0.2:3001"
+
+    # Someone else claims broker 2 moved
+    forged = dict(update, incarnation=update["incarnation"] + 1, address="http://127.0.0.1:3999")
+    node._apply(forged)
+    assert node.states[2]["incarnation"] == forged["incarnation"]
+    assert node.directory.address_of(2) == "http://10.0.0.2:3001"
+
+    # Relayed updates keep the owner's signature, so a third broker accepts them
+    relayed = node._full_state()[1]
+    third = member(3)
+    third._apply(relayed)
+    assert third.directory.address_of(2) == "http://10.0.0.2:3001"
+
+
+def test_a_restarted_broker_may_move():
+    node = member(1)
+    node._apply(member(2, address="http://10.0.0.2:3001")._self_update())
+    moved = member(2, address="http://10.0.0.7:3001")
+    moved.incarnation += 1
+    node._apply(moved._self_update())
+    assert node.states[2]["status"] == ALIVE
+    assert node.directory.address_of(2) == "http://10.0.0.7:3001"
+
+
+def ping(node, body, sender=None):
+    headers = {} if sender is None else {"X-Broker-Id": str(sender)}
+    request = make_mocked_request("POST", "/swim/ping", headers=headers)
+
+    async def read_json():
+        return body
+
+    request.json = read_json
+    return asyncio.run(node.handle_ping(request)).status
+
+
+def test_only_peers_may_gossip_and_only_as_themselves():
+    node = member(1)
+    body = {"from": 2, "updates": [member(2, address="http://127.0.0.1:3999")._self_update()]}
+    assert ping(node, body) == 403
+    assert ping(node, body, sender=3) == 403
+    assert 2 not in node.states
+    assert ping(node, body, sender=2) == 200
+    assert 2 in node.states
+
+
+def test_confirmed_deaths_are_removed_from_the_registry():
+    removed = []
+
+    async def remove(request):
+        removed.append(int(request.match_info["broker_id"]))
+        return web.Response(text="Removed")
+
+    async def run():
+        app = web.Application()
+        app.router.add_delete("/remove/{broker_id}", remove)
+        registry = TestServer(app, host="127.0.0.1")
+        await registry.start_server()
+        try:
+            node = Membership(1, registry_url=str(registry.make_url("")).rstrip("/"), suspect_timeout=0)
+            node.states[4] = {"status": SUSPECT, "incarnation": 0, "address": None, "changed_at": 0}
+            await node.expire_suspects()
+            await asyncio.gather(*node._deregistrations)
+            return node
+        finally:
+            await registry.close()
+
+    node = asyncio.run(run())
+    assert removed == [4]
+    assert 4 not in node.members
@@ -0,0 +1,31 @@
+# tests/test_partition_cache.py
+
+import asyncio
+import time
+
+from aiohttp.test_utils import make_mocked_request
+
+from partition_cache import PartitionCache
+from peers import PEER_HEADER, PeerDirectory
+
+
+def invalidate(cache, headers):
+    request = make_mocked_request("POST", "/partitions/invalidate", headers=headers)
+
+    async def json():
+        return {"partitions": [["news", 0]]}
+
+    request.json = json
+    return asyncio.run(cache.handle_invalidate(request)).status
+
+
+def test_only_peers_may_invalidate_cached_partitions():
+    cache = PartitionCache(PeerDirectory(1))
+    cache.put("news", 0, None, cache.generation("news", 0), '"tag"', 7, [], time.monotonic())
+
+    assert invalidate(cache, {}) == 403
+    entry, fresh = cache.get("news", 0)
+    assert entry.version == 7 and fresh
+
+    assert invalidate(cache, {PEER_HEADER: "2"}) == 200
+    assert cache.get("news", 0) == (None, False)
@@ -0,0 +1,64 @@
+# tests/test_partitioning.py
+
+from partitioning import ConsistentHashRing, PartitionPlacement
+
+KEYS = [f"news:{partition}" for partition in range(200)]
+
+
+def placements(ring, count=1):
+    return {key: ring.get_nodes(key, count) for key in KEYS}
+
+
+def test_replicas_are_distinct_and_capped_by_members():
+    ring = ConsistentHashRing([1, 2, 3, 4])
+    for key in KEYS:
+        owners = ring.get_nodes(key, 3)
+        assert len(owners) == len(set(owners)) == 3
+        assert set(owners) <= {1, 2, 3, 4}
+    assert sorted(ring.get_nodes("news:0", 10)) == [1, 2, 3, 4]
+    assert ConsistentHashRing().get_nodes("news:0", 3) == []
+
+
+def test_placement_does_not_depend_on_join_order():
+    assert placements(ConsistentHashRing([1, 2, 3, 4]), 2) == placements(ConsistentHashRing([4, 2, 3, 1]), 2)
+
+
+def test_adding_a_broker_only_moves_keys_to_it():
+    before = placements(ConsistentHashRing([1, 2, 3, 4]))
+    ring = ConsistentHashRing([1, 2, 3, 4, 5])
+    after = placements(ring)
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert moved
+    assert all(after[key] == [5] for key in moved)
+    # Roughly its fair share, not a reshuffle
+    assert len(moved) < len(KEYS) / 2
+
+
+def test_removing_a_broker_only_moves_its_keys():
+    ring = ConsistentHashRing([1, 2, 3, 4, 5])
+    before = placements(ring)
+    ring.remove_node(3)
+    after = placements(ring)
+    for key in KEYS:
+        if before[key] != [3]:
+            assert after[key] == before[key]
+        else:
+            assert after[key] != [3]
+
+
+def test_replica_sets_keep_surviving_owners_in_order():
+    ring = ConsistentHashRing([1, 2, 3, 4, 5])
+    before = placements(ring, 3)
+    ring.set_nodes([1, 2, 4, 5])
+    for key, owners in placements(ring, 3).items():
+        survivors = [node for node in before[key] if node != 3]
+        assert owners[: len(survivors)] == survivors
+
+
+def test_partition_placement_uses_the_stored_table_name():
+    placement = PartitionPlacement(1, num_partitions=8, replication_factor=2)
+    placement.update_members({1, 2, 3})
+    for partition in range(8):
+        assert placement.replicas_for("Top-News", partition) == placement.replicas_for("top_news", partition)
+    assert placement.partition_for("Top News", "key") == placement.partition_for("top_news", "key")
+    assert all(0 <= placement.partition_for("news", key) < 8 for key in KEYS)
@@ -0,0 +1,110 @@
+# tests/test_peers.py
+
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from peers import NONCE_HEADER, PEER_HEADER, TIMESTAMP_HEADER, PeerDirectory, request_signature
+
+SECRET = "cluster-secret"
+
+
+async def run_against_broker(exchange, secret=SECRET):
+    """Start a broker stub that reports who it believes sent each request, then run ``exchange``."""
+    server_directory = PeerDirectory(2, secret=SECRET)
+    seen = []
+
+    async def echo(request):
+        seen.append(dict(request.headers))
+        return web.json_response({"sender": request.headers.get(PEER_HEADER), "body": (await request.read()).decode()})
+
+    app = web.Application(middlewares=[server_directory.middleware])
+    app.router.add_route("*", "/{tail:.*}", echo)
+    server = TestServer(app, host="127.0.0.1")
+    await server.start_server()
+    client_directory = PeerDirectory(1, secret=secret)
+    client_directory.set_address(2, str(server.make_url("")))
+    try:
+        return await exchange(client_directory, str(server.make_url("")).rstrip("/"), seen)
+    finally:
+        await client_directory.close()
+        await server.close()
+
+
+async def post(session, url, **kwargs):
+    async with session.post(url, **kwargs) as response:
+        return response.status, (await response.json()) if response.status == 200 else None
+
+
+def test_signed_requests_are_believed():
+    async def exchange(directory, base, seen):
+        first = await post(directory.session(2), directory.url(2, "/replicate?topic=a b"), json={"x": 1})
+        async with directory.session(2).get(directory.url(2, "/data/news?after=3")) as response:
+            second = await response.json()
+        return first, second
+
+    (status, body), second = asyncio.run(run_against_broker(exchange))
+    assert status == 200
+    assert body == {"sender": "1", "body": '{"x": 1}'}
+    assert second["sender"] == "1"
+
+
+def test_wrong_secret_is_handled_as_a_client():
+    async def exchange(directory, base, seen):
+        return await post(directory.session(2), directory.url(2, "/publish"), json={})
+
+    status, body = asyncio.run(run_against_broker(exchange, secret="guess"))
+    assert (status, body["sender"]) == (200, None)
+
+
+def test_replayed_and_stale_signatures_are_handled_as_a_client():
+    async def exchange(directory, base, seen):
+        await post(directory.session(2), directory.url(2, "/publish"), data=b"payload")
+        captured = {name: value for name, value in seen[0].items() if name.lower().startswith("x-broker")}
+        async with aiohttp.ClientSession() as attacker:
+            replayed = await post(attacker, f"{base}/publish", data=b"payload", headers=captured)
+            stale_time = f"{time.time() - 3600:.3f}"
+            stale = dict(captured, **{TIMESTAMP_HEADER: stale_time, NONCE_HEADER: "fresh"})
+            stale["X-Broker-Auth"] = request_signature(
+                SECRET, 1, "POST", "/publish", stale_time, "fresh", captured["X-Broker-Content-SHA256"]
+            )
+            old = await post(attacker, f"{base}/publish", data=b"payload", headers=stale)
+        return replayed, old
+
+    replayed, old = asyncio.run(run_against_broker(exchange))
+    assert replayed[1]["sender"] is None
+    assert old[1]["sender"] is None
+
+
+def test_tampered_body_is_refused():
+    async def exchange(directory, base, seen):
+        await post(directory.session(2), directory.url(2, "/publish"), data=b"payload")
+        async with aiohttp.ClientSession() as attacker:
+            # Correctly signed for the original body, sent with another one
+            headers = {name: value for name, value in seen[0].items() if name.lower().startswith("x-broker")}
+            timestamp = f"{time.time():.3f}"
+            headers.update({TIMESTAMP_HEADER: timestamp, NONCE_HEADER: "n2"})
+            headers["X-Broker-Auth"] = request_signature(
+                SECRET, 1, "POST", "/publish", timestamp, "n2", headers["X-Broker-Content-SHA256"]
+            )
+            return await post(attacker, f"{base}/publish", data=b"tampered", headers=headers)
+
+    status, _ = asyncio.run(run_against_broker(exchange))
+    assert status == 401
+
+
+def test_streamed_bodies_are_only_unsigned_on_blob_routes():
+    async def exchange(directory, base, seen):
+        async def chunks():
+            yield b"blob"
+
+        blob = await post(directory.session(2), directory.url(2, "/blobs/abc"), data=chunks())
+        other = await post(directory.session(2), directory.url(2, "/publish"), data=chunks())
+        return blob, other
+
+    blob, other = asyncio.run(run_against_broker(exchange))
+    assert blob[1]["sender"] == "1"
+    assert other[1]["sender"] is None
@@ -0,0 +1,148 @@
+# tests/test_producer.py
+
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from producer import BatchingProducer
+
+
+class FakePool:
+    """Stands in for BrokerPool, acking every message of a batch."""
+
+    def __init__(self, status=200):
+        self.status = status
+        self.batches = []  # (topic, message_ids) per request, in send order
+        self.gate = None  # When set, requests wait for it
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def request(self, method, path, data=None, headers=None):
+        assert (method, path) == ("POST", "/publish_batch")
+        if headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        body = json.loads(data)
+        ids = [entry["message_id"] for entry in body["messages"]]
+        self.batches.append((body["topic"], ids))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.gate is not None:
+                await self.gate.wait()
+        finally:
+            self.in_flight -= 1
+        if self.status != 200:
+            return 1, self.status, {"status": "error"}
+        acks = [{"message_id": message_id, "partition": i, "status": "success"} for i, message_id in enumerate(ids)]
+        return 1, 200, {"acks": acks[::-1]}  # Order must not matter
+
+
+def test_linger_flushes_a_partial_batch():
+    async def run():
+        pool = FakePool()
+        producer = BatchingProducer(pool, batch_size=100, linger_ms=20)
+        futures = [await producer.send("news", f"m{i}") for i in range(3)]
+        await asyncio.sleep(0.005)
+        assert pool.batches == []
+        acks = await asyncio.wait_for(asyncio.gather(*futures), 1)
+        assert len(pool.batches) == 1
+        return pool, acks
+
+    pool, acks = asyncio.run(run())
+    assert [ack["message_id"] for ack in acks] == pool.batches[0][1]
+
+
+def test_count_threshold_flushes_without_waiting_for_linger():
+    async def run():
+        pool = FakePool()
+        producer = BatchingProducer(pool, batch_size=3, linger_ms=10000)
+        futures = [await producer.send("news", f"m{i}") for i in range(7)]
+        await asyncio.gather(*futures[:6])
+        full = [len(ids) for _, ids in pool.batches]
+        await producer.close()
+        return full, [len(ids) for _, ids in pool.batches]
+
+    full, after_close = asyncio.run(run())
+    assert full == [3, 3]
+    assert after_close == [3, 3, 1]
+
+
+def test_byte_threshold_flushes():
+    async def run():
+        pool = FakePool()
+        producer = BatchingProducer(pool, batch_size=100, batch_bytes=10, linger_ms=10000)
+        first = await producer.send("news", "x" * 6)
+        second = await producer.send("news", "y" * 6)
+        await asyncio.wait_for(asyncio.gather(first, second), 1)
+        return pool.batches
+
+    batches = asyncio.run(run())
+    assert [len(ids) for _, ids in batches] == [2]
+
+
+def test_topics_are_batched_separately():
+    async def run():
+        pool = FakePool()
+        async with BatchingProducer(pool, batch_size=100, linger_ms=10000, compression="gzip") as producer:
+            await producer.send("news", "a")
+            await producer.send("sports", "b")
+            await producer.send("news", "c")
+        return pool.batches
+
+    batches = asyncio.run(run())
+    assert sorted((topic, len(ids)) for topic, ids in batches) == [("news", 2), ("sports", 1)]
+
+
+def test_in_flight_batches_are_capped():
+    async def run():
+        pool = FakePool()
+        pool.gate = asyncio.Event()
+        producer = BatchingProducer(pool, batch_size=1, linger_ms=10000, max_in_flight=2)
+        await producer.send("news", "a")
+        await producer.send("news", "b")
+        # A third full batch waits for a free slot
+        third = asyncio.create_task(producer.send("news", "c"))
+        await asyncio.sleep(0.01)
+        blocked = not third.done()
+        pool.gate.set()
+        await asyncio.wait_for(third, 1)
+        await producer.close()
+        return blocked, pool.max_in_flight, len(pool.batches)
+
+    blocked, max_in_flight, batches = asyncio.run(run())
+    assert blocked
+    assert max_in_flight == 2
+    assert batches == 3
+
+
+def test_futures_resolve_to_their_own_ack():
+    async def run():
+        pool = FakePool()
+        async with BatchingProducer(pool, batch_size=100, linger_ms=10000) as producer:
+            futures = [await producer.send("news", f"m{i}", key=f"k{i}") for i in range(5)]
+        return pool.batches[0][1], [future.result() for future in futures]
+
+    sent_ids, acks = asyncio.run(run())
+    assert [ack["message_id"] for ack in acks] == sent_ids
+    assert [ack["partition"] for ack in acks] == list(range(5))
+
+
+def test_failed_batch_fails_every_future():
+    async def run():
+        pool = FakePool(status=503)
+        producer = BatchingProducer(pool, batch_size=2, linger_ms=10000)
+        futures = [await producer.send("news", f"m{i}") for i in range(2)]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert len(results) == 2
+    for result in results:
+        assert isinstance(result, ConnectionError)
+        assert "HTTP 503" in str(result)
+
+
+def test_unsupported_compression_is_refused():
+    with pytest.raises(ValueError):
+        BatchingProducer(FakePool(), compression="zstd")
@@ -0,0 +1,26 @@
+# tests/test_profiling.py
+
+from types import SimpleNamespace
+
+from profiling import AdminGuard
+
+
+def request(remote, **headers):
+    return SimpleNamespace(remote=remote, headers=headers)
+
+
+def test_admin_routes_need_token_peer_or_loopback():
+    guard = AdminGuard(token="s3cret", peer_secret="peers")
+    assert guard.allowed(request("127.0.0.1"))
+    assert guard.allowed(request("10.0.0.2", **{"X-Broker-Id": "2"}))
+    assert guard.allowed(request("10.0.0.9", Authorization="Bearer s3cret"))
+    assert not guard.allowed(request("10.0.0.9"))
+    assert not guard.allowed(request("10.0.0.9", Authorization="Bearer wrong"))
+
+
+def test_unproven_peers_and_missing_token_are_refused():
+    guard = AdminGuard()
+    # Without a peer secret anyone can name a broker
+    assert not guard.allowed(request("10.0.0.2", **{"X-Broker-Id": "2"}))
+    assert not guard.allowed(request("10.0.0.9", Authorization="Bearer "))
+    assert guard.allowed(request("::1"))
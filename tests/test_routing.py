@@ -0,0 +1,64 @@
+# tests/test_routing.py
+
+import asyncio
+import socket
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+import registry
+from routing import BrokerLoad, LeastLoadedPolicy, TopicAffinityPolicy, WeightedRoundRobinPolicy
+
+
+def test_unreported_brokers_are_not_chosen():
+    # Broker 2 has no fresh report; it may be dead, however idle it looks
+    loads = {1: BrokerLoad(1, in_flight=50), 3: BrokerLoad(3, in_flight=80)}
+    assert {LeastLoadedPolicy().choose([1, 2, 3], loads) for _ in range(20)} == {1}
+    wrr = WeightedRoundRobinPolicy()
+    assert {wrr.choose([1, 2, 3], loads) for _ in range(20)} == {1, 3}
+    affinity = TopicAffinityPolicy()
+    assert all(affinity.choose([1, 2, 3], loads, f"t{i}") != 2 for i in range(20))
+
+
+def test_any_broker_is_chosen_before_the_first_reports():
+    assert LeastLoadedPolicy().choose([1, 2], {}) in (1, 2)
+    assert WeightedRoundRobinPolicy().choose([1, 2], {}) in (1, 2)
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def test_publish_moves_on_from_an_unreachable_broker():
+    async def publish(request):
+        return web.json_response({"status": "success", "body": await request.json()})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/publish", publish)
+        broker = TestServer(app, host="127.0.0.1")
+        await broker.start_server()
+        registry.members.update({1, 2})
+        registry.addresses.update({1: unused_url(), 2: str(broker.make_url("")).rstrip("/")})
+        # Broker 1 last reported itself idle, so it is always tried first
+        registry.loads.update({1: BrokerLoad(1), 2: BrokerLoad(2, in_flight=100)})
+        front = TestServer(registry.create_app(), host="127.0.0.1")
+        await front.start_server()
+        try:
+            async with ClientSession() as session:
+                results = []
+                for i in range(5):
+                    async with session.post(front.make_url("/dcnews"), json={"n": i}) as resp:
+                        results.append((resp.status, await resp.json()))
+                return results
+        finally:
+            await front.close()
+            await broker.close()
+            registry.members.clear()
+            registry.addresses.clear()
+            registry.loads.clear()
+
+    results = asyncio.run(run())
+    assert results == [(200, {"status": "success", "body": {"n": i}}) for i in range(5)]
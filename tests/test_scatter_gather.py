@@ -0,0 +1,109 @@
+# tests/test_scatter_gather.py
+
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from broker_pool import BrokerPool
+from scatter_gather import scatter_gather_fetch
+
+
+def record(partition, sequence):
+    return {
+        "message_id": f"{partition}-{sequence}",
+        "message": f"m{partition}.{sequence}",
+        "timestamp": 0,
+        "partition": partition,
+        "sequence": sequence,
+    }
+
+
+def broker(answers):
+    """A broker answering each shard of GET /data/{topic} with a canned page."""
+
+    async def get_data(request):
+        answer = answers.get(request.query.get("shard"))
+        if answer is None:
+            return web.json_response({"status": "error"}, status=500)
+        assert request.query["after"] == "0:2,1:1,2:0,3:5"
+        return web.json_response(answer)
+
+    app = web.Application()
+    app.router.add_get("/data/{topic}", get_data)
+    return TestServer(app, host="127.0.0.1")
+
+
+def test_shards_are_merged_and_staleness_reported():
+    # Four partitions; broker 0 reads 0 and 2, broker 1 reads 1 and 3
+    answers = {
+        "0/2": {
+            "records": [record(0, 3), record(2, 1)],
+            "next_after": "0:3,1:1,2:1,3:5",
+            "high_water": {"0": 6, "2": 1},
+        },
+        "1/2": {
+            "records": [record(1, 2)],
+            "next_after": "0:2,1:2,2:0,3:5",
+            # Partition 3 has only seen up to 4, but the reader is already at 5
+            "high_water": {"1": 4, "3": 4},
+        },
+    }
+
+    async def run():
+        servers = [broker(answers), broker(answers)]
+        for server in servers:
+            await server.start_server()
+        urls = [str(server.make_url("")).rstrip("/") for server in servers]
+        try:
+            async with BrokerPool(urls) as pool:
+                result = await scatter_gather_fetch(pool, "news", after="0:2,1:1,2:0,3:5")
+        finally:
+            for server in servers:
+                await server.close()
+        return urls, result
+
+    urls, result = asyncio.run(run())
+    assert [r["message_id"] for r in result["messages"]] == ["2-1", "1-2", "0-3"]
+    assert result["next_after"] == "0:3,1:2,2:1,3:5"
+
+    first, second = (result["brokers"][url] for url in urls)
+    assert (first["shard"], first["status"]) == ("0/2", "ok")
+    assert first["high_water"] == {0: 6, 2: 1}
+    assert first["read_to"] == {0: 3, 2: 1}
+    assert first["lagging_partitions"] == [0]
+    assert first["stale_partitions"] == []
+    assert second["high_water"] == {1: 4, 3: 4}
+    assert second["read_to"] == {1: 2, 3: 5}
+    assert second["lagging_partitions"] == [1]
+    assert second["stale_partitions"] == [3]
+
+
+def test_failed_broker_keeps_its_partitions_and_has_no_staleness():
+    answers = {
+        "0/2": {
+            "records": [record(0, 3)],
+            "next_after": "0:3,1:1,2:0,3:5",
+            "high_water": {"0": 3, "2": 0},
+        },
+    }
+
+    async def run():
+        servers = [broker(answers), broker(answers)]
+        for server in servers:
+            await server.start_server()
+        urls = [str(server.make_url("")).rstrip("/") for server in servers]
+        try:
+            async with BrokerPool(urls) as pool:
+                result = await scatter_gather_fetch(pool, "news", after="0:2,1:1,2:0,3:5")
+        finally:
+            for server in servers:
+                await server.close()
+        return urls, result
+
+    urls, result = asyncio.run(run())
+    assert result["next_after"] == "0:3,1:1,2:0,3:5"
+    failed = result["brokers"][urls[1]]
+    assert failed["status"] == "error"
+    assert "lagging_partitions" not in failed
+    assert result["brokers"][urls[0]]["lagging_partitions"] == []
@@ -0,0 +1,41 @@
+# tests/test_sequencing.py
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+from sequencing import MAX_TERM, TERM_SHIFT, SequenceAllocator, SequenceRangeError
+
+
+def allocator(term, leader=1):
+    return SequenceAllocator(1, SimpleNamespace(leader=leader, term=term, renew_interval=1.0))
+
+
+def test_blocks_start_at_the_term_and_do_not_overlap():
+    sequencer = allocator(term=3)
+    assert sequencer.allocate("news", 10) == (3 << TERM_SHIFT, (3 << TERM_SHIFT) + 10, 3)
+    # Topics sharing a table share a counter
+    assert sequencer.allocate("News", 5)[0] == (3 << TERM_SHIFT) + 10
+    assert allocator(term=3, leader=2).allocate("news", 10) is None
+
+
+def test_numbers_of_the_highest_term_fit_sqlite():
+    start, end, _ = allocator(term=MAX_TERM).allocate("news", 1000)
+    assert end <= 2**63 - 1
+    with pytest.raises(SequenceRangeError):
+        allocator(term=MAX_TERM + 1).allocate("news", 1)
+
+
+def test_a_term_cannot_spill_into_the_next():
+    sequencer = allocator(term=1)
+    sequencer.allocate("news", (1 << TERM_SHIFT) - 1)
+    with pytest.raises(SequenceRangeError):
+        sequencer.allocate("news", 2)
+
+
+def test_only_peers_may_allocate():
+    request = make_mocked_request("POST", "/sequence/allocate")
+    response = asyncio.run(allocator(term=1).handle_allocate(request))
+    assert response.status == 403